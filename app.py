@@ -1,5 +1,19 @@
+import os
+import threading
+import time
+from config.config import NUMBA_CACHE_PATH, FAST_START, DEBUG, SERVER_PORT
+
+_start = time.perf_counter()
+
+# Compiled numba kernels (UMAP) are cached on disk, must be set before numba is imported
+os.environ.setdefault("NUMBA_CACHE_DIR", str(NUMBA_CACHE_PATH))
+
 from dash import Dash, html, dcc, page_container, get_asset_url
 import dash_bootstrap_components as dbc
+import startup
+from monitoring import configure_logging, instrument_app
+
+configure_logging()
 
 app = Dash(__name__,
            use_pages=True,
@@ -54,6 +68,22 @@ app.layout = html.Div([
     "padding": "20px"
 })
 
+# Timing of every callback request and the Prometheus /metrics route
+instrument_app(app)
+
+startup.record("app (dash, pages)", time.perf_counter() - _start)
+
+# Development server, the production server loads wsgi.py (see gunicorn.conf.py)
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8050, debug=True) # when creating docker
+    port, debug = SERVER_PORT, DEBUG
+
+    # The debug reloader runs this script twice, only the child process serves requests
+    if not debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        if FAST_START:
+            # Heavy analysis modules are imported once the server is listening
+            threading.Thread(target=startup.warm_up, kwargs={"port": port}, daemon=True).start()
+        else:
+            startup.warm_up()
+
+    app.run(host="0.0.0.0", port=port, debug=debug) # when creating docker
     # app.run( port=8050, debug=True)
\ No newline at end of file
@@ -0,0 +1,117 @@
+// Client-side threshold recoloring for the volcano and MA plots.
+// The server sends the point arrays once per result / p-value type (see dge_pipeline/dashboard.py),
+// slider changes are handled here without a round-trip. The download link follows the same thresholds.
+// For large results the server sends at most a fixed number of genes as individual points and aggregates
+// all others, the genes with p >= points.p_limit, into a density layer drawn below the points.
+// The gene selected in the results table is drawn as its own marker.
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    dge: {
+        threshold_figure: function (points, fcThresh, pThresh, selected) {
+            if (!points) {
+                return {data: [], layout: {title: {text: "No data"}}};
+            }
+
+            var groups = {
+                "False": {x: [], y: [], text: []},
+                "True": {x: [], y: [], text: []}
+            };
+            for (var i = 0; i < points.x.length; i++) {
+                var significant = Math.abs(points.lfc[i]) > fcThresh && points.p[i] < pThresh;
+                var group = groups[significant ? "True" : "False"];
+                group.x.push(points.x[i]);
+                group.y.push(points.y[i]);
+                group.text.push(points.genes[i]);
+            }
+
+            var colors = {"False": "gray", "True": "red"};
+            var data = ["False", "True"].map(function (name) {
+                return {
+                    type: points.trace_type,
+                    mode: "markers",
+                    name: name,
+                    legendgroup: name,
+                    x: groups[name].x,
+                    y: groups[name].y,
+                    text: groups[name].text,
+                    marker: {color: colors[name]},
+                    hovertemplate: "significant=" + name + "<br>" + points.hovertemplate + "<extra></extra>"
+                };
+            });
+
+            var annotations = [];
+            if (points.density) {
+                // genes of the density layer can only pass p-value thresholds above p_limit
+                var exact = pThresh <= points.p_limit;
+                data.unshift({
+                    type: "heatmap",
+                    name: exact ? "not significant" : "p >= " + points.p_limit.toPrecision(3),
+                    x: points.density.x,
+                    y: points.density.y,
+                    z: points.density.z,
+                    colorscale: [[0, "#e0e0e0"], [1, "#404040"]],
+                    showscale: false,
+                    hoverongaps: false,
+                    hovertemplate: "%{z} " + (exact ? "not significant genes" : "genes with " + points.pval_type + " >= "
+                        + points.p_limit.toPrecision(3) + " (not colored)") + "<extra></extra>"
+                });
+                if (!exact) {
+                    annotations.push({
+                        text: "Genes with " + points.pval_type + " >= " + points.p_limit.toPrecision(3)
+                            + " are drawn as density and not colored",
+                        xref: "paper", yref: "paper", x: 0, y: 1.08, showarrow: false, font: {size: 11}
+                    });
+                }
+            }
+
+            if (selected && selected[points.x_column] !== null && selected[points.y_column] !== null) {
+                var selectedSignificant = Math.abs(selected.log2FoldChange) > fcThresh
+                    && selected[points.pval_type] < pThresh;
+                data.push({
+                    type: "scatter",
+                    mode: "markers",
+                    name: selected.gene,
+                    x: [selected[points.x_column]],
+                    y: [selected[points.y_column]],
+                    text: [selected.gene],
+                    marker: {color: selectedSignificant ? "red" : "gray", symbol: "star", size: 16,
+                             line: {color: "black", width: 1}},
+                    hovertemplate: "selected<br>" + points.hovertemplate + "<extra></extra>"
+                });
+            }
+
+            var shapes = [];
+            if (points.plot === "volcano") {
+                var line = function (axis, value, color) {
+                    var shape = {type: "line", line: {dash: "dot", color: color}};
+                    shape[axis + "ref"] = axis;
+                    shape[axis + "0"] = value;
+                    shape[axis + "1"] = value;
+                    var other = axis === "x" ? "y" : "x";
+                    shape[other + "ref"] = other + " domain";
+                    shape[other + "0"] = 0;
+                    shape[other + "1"] = 1;
+                    return shape;
+                };
+                shapes = [
+                    line("x", fcThresh, "blue"),
+                    line("x", -fcThresh, "blue"),
+                    line("y", -Math.log10(pThresh), "green")
+                ];
+            }
+
+            var layout = Object.assign({}, points.layout, {shapes: shapes, annotations: annotations});
+            return {data: data, layout: layout};
+        },
+
+        // Link of the streamed download route (see dge_pipeline/export.py register_download_route)
+        download_url: function (resultKey, format, rows, top, fcThresh, pThresh, pvalType) {
+            if (!resultKey) {
+                return null;
+            }
+            var query = new URLSearchParams({
+                format: format, rows: rows, fc: fcThresh, p: pThresh, pval_type: pvalType, top: top || 100
+            });
+            return "/download/dge/" + resultKey + "?" + query.toString();
+        }
+    }
+});
@@ -0,0 +1 @@
+'''Stage-level pipeline benchmarks, usage in benchmarks/__main__.py.'''
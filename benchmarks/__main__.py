@@ -0,0 +1,164 @@
+'''
+Stage-level benchmarks of the EDA and DGE pipelines on synthetic negative-binomial data, e.g.
+
+    python -m benchmarks run --sizes small medium 30000x200 --repeat 3 --output bench.json
+    python -m benchmarks run --sizes xlarge --skip dge_fit
+    python -m benchmarks compare baseline.json bench.json
+'''
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from importlib.metadata import version, PackageNotFoundError
+from pathlib import Path
+
+from config.config import ROOT, OUTPUT_PATH, NUMBA_CACHE_PATH
+
+os.environ.setdefault("NUMBA_CACHE_DIR", str(NUMBA_CACHE_PATH))
+
+PACKAGES = ["numpy", "pandas", "scipy", "scikit-learn", "umap-learn", "pydeseq2", "pyarrow"]
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def package_versions():
+    versions = {}
+    for package in PACKAGES:
+        try:
+            versions[package] = version(package)
+        except PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+
+def run(args):
+    from .stages import run_stages, parse_size
+    from eda_pipeline.eda import warm_up_umap
+
+    sizes = [(size, *parse_size(size)) for size in args.sizes]
+
+    # numba compilation of the UMAP kernels is a one-off startup cost, not part of the UMAP stage
+    start = time.perf_counter()
+    warm_up_umap()
+    warm_up_seconds = time.perf_counter() - start
+
+    commit, dirty = git_commit()
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit,
+        "dirty": dirty,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "packages": package_versions(),
+        "settings": {"seed": args.seed, "repeat": args.repeat, "n_cpus": args.n_cpus, "memory": not args.no_memory,
+                     "skip": args.skip, "umap_warm_up_seconds": round(warm_up_seconds, 2)},
+        "results": [],
+    }
+
+    for size, n_genes, n_samples in sizes:
+        runs = []
+        for repetition in range(args.repeat):
+            print(f"{size} ({n_genes} genes x {n_samples} samples), run {repetition + 1}/{args.repeat}")
+            dataset, records = run_stages(n_genes, n_samples, skip=args.skip, seed=args.seed, n_cpus=args.n_cpus,
+                                          memory=not args.no_memory)
+            runs.append(records)
+
+        # fastest time and largest memory peak of the repetitions
+        stages = []
+        for stage_records in zip(*runs):
+            peaks = [record["peak_mb"] for record in stage_records if record["peak_mb"] is not None]
+            stages.append({"stage": stage_records[0]["stage"],
+                           "seconds": min(record["seconds"] for record in stage_records),
+                           "seconds_all": [record["seconds"] for record in stage_records],
+                           "peak_mb": max(peaks) if peaks else None,
+                           "max_rss_mb": max(record["max_rss_mb"] for record in stage_records)})
+        report["results"].append({"size": size, **dataset, "stages": stages,
+                                  "total_seconds": round(sum(stage["seconds"] for stage in stages), 4)})
+
+    output = Path(args.output or OUTPUT_PATH / "benchmarks" / f"{time.strftime('%Y%m%d-%H%M%S')}-{(commit or 'unknown')[:8]}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Benchmark results: {output.resolve()}")
+
+
+def compare(args):
+    '''
+    Prints the stage times and memory peaks of two benchmark files side by side.
+    '''
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(args.current, "r", encoding="utf-8") as f:
+        current = json.load(f)
+
+    print(f"baseline {baseline.get('commit') or '?'} ({baseline['created']}), "
+          f"current {current.get('commit') or '?'} ({current['created']})")
+    baseline_results = {result["size"]: result for result in baseline["results"]}
+    slower = False
+    for result in current["results"]:
+        if result["size"] not in baseline_results:
+            continue
+        baseline_stages = {stage["stage"]: stage for stage in baseline_results[result["size"]]["stages"]}
+        print(f"\n{result['size']} ({result['n_genes']} genes x {result['n_samples']} samples)")
+        print(f"  {'stage':<14} {'baseline s':>11} {'current s':>11} {'ratio':>7} {'baseline MB':>12} {'current MB':>11}")
+        for stage in result["stages"]:
+            if stage["stage"] not in baseline_stages:
+                continue
+            old = baseline_stages[stage["stage"]]
+            ratio = stage["seconds"] / old["seconds"] if old["seconds"] else float("nan")
+            flag = ""
+            if ratio > 1 + args.threshold:
+                flag, slower = " slower", True
+            elif ratio < 1 - args.threshold:
+                flag = " faster"
+            print(f"  {stage['stage']:<14} {old['seconds']:11.3f} {stage['seconds']:11.3f} {ratio:7.2f} "
+                  f"{old['peak_mb'] if old['peak_mb'] is not None else '-':>12} "
+                  f"{stage['peak_mb'] if stage['peak_mb'] is not None else '-':>11}{flag}")
+    return 1 if slower and args.fail_on_slower else 0
+
+
+def main():
+    from .stages import OPTIONAL_STAGES, SIZES
+
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Stage-level pipeline benchmarks.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="benchmark the stages on synthetic data")
+    run_parser.add_argument("--sizes", nargs="+", default=["small", "medium"],
+                            help=f"named sizes ({', '.join(f'{name}={g}x{s}' for name, (g, s) in SIZES.items())}) "
+                                 f"or GENESxSAMPLES")
+    run_parser.add_argument("--skip", nargs="+", default=[], choices=OPTIONAL_STAGES, help="stages not to run")
+    run_parser.add_argument("--repeat", type=int, default=1, help="runs per size, the fastest is reported")
+    run_parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic data")
+    run_parser.add_argument("--n-cpus", type=int, default=1, help="CPUs used by PyDESeq2")
+    run_parser.add_argument("--no-memory", action="store_true", help="time only, without memory sampling")
+    run_parser.add_argument("--output", help="result file, by default <results>/benchmarks/<time>-<commit>.json")
+
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="relative change reported")
+    compare_parser.add_argument("--fail-on-slower", action="store_true", help="exit with 1 if a stage got slower")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        sys.exit(compare(args))
+
+
+if __name__ == "__main__":
+    main()
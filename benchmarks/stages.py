@@ -0,0 +1,185 @@
+import resource
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+from .synthetic import synthetic_dataset, count_file_bytes, GENE_COLUMN, CONTRAST_COLUMN
+
+STAGES = ["parsing", "cleaning", "cpm", "pca", "umap", "correlation", "dge_fit", "wald", "serialization"]
+# Cleaning and CPM feed every later stage and always run
+OPTIONAL_STAGES = [stage for stage in STAGES if stage not in ("cleaning", "cpm")]
+# Skipping a stage skips the stages using its result
+DEPENDENT_STAGES = {"pca": ["umap"], "dge_fit": ["wald"]}
+
+# Named sizes (genes, samples), any other size can be given as GENESxSAMPLES
+SIZES = {
+    "small": (10000, 6),
+    "medium": (20000, 48),
+    "large": (60000, 500),
+    "xlarge": (60000, 2000),
+}
+
+MB = 1024 ** 2
+
+
+def parse_size(size):
+    '''
+    Returns:
+        (n_genes, n_samples) of a named size or of 'GENESxSAMPLES'
+    '''
+    if size in SIZES:
+        return SIZES[size]
+    try:
+        n_genes, n_samples = (int(value) for value in size.lower().split("x"))
+    except ValueError:
+        raise ValueError(f"Unknown size '{size}', expected one of {', '.join(SIZES)} or GENESxSAMPLES.")
+    return n_genes, n_samples
+
+
+def max_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / MB if sys.platform == "darwin" else max_rss / 1024
+
+
+def current_rss_bytes():
+    # Linux only, None elsewhere
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return None
+
+
+class StageTimer:
+    '''
+    Times stages and records the peak resident memory they add on top of the memory in use before.
+    The resident set size is sampled by a thread every SAMPLE_INTERVAL seconds, which (unlike
+    tracemalloc) does not slow down Python-heavy stages such as the PyDESeq2 fit and includes native
+    allocations (BLAS, pyarrow). Memory of worker processes (PyDESeq2 with several CPUs) is not included.
+    '''
+    SAMPLE_INTERVAL = 0.005
+
+    def __init__(self, memory=True):
+        self.memory = memory and current_rss_bytes() is not None
+        self.records = []
+
+    def _sample(self, stop, peak):
+        while not stop.wait(self.SAMPLE_INTERVAL):
+            peak[0] = max(peak[0], current_rss_bytes())
+
+    def run(self, stage, func, *args, **kwargs):
+        if self.memory:
+            before = current_rss_bytes()
+            peak, stop = [before], threading.Event()
+            sampler = threading.Thread(target=self._sample, args=(stop, peak), daemon=True)
+            sampler.start()
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            peak_mb = None
+            if self.memory:
+                stop.set()
+                sampler.join()
+                peak_mb = round((max(peak[0], current_rss_bytes()) - before) / MB, 2)
+        self.records.append({"stage": stage, "seconds": round(seconds, 4), "peak_mb": peak_mb,
+                             "max_rss_mb": round(max_rss_mb(), 1)})
+        print(f"  {stage:<14} {seconds:9.3f} s" + (f" {peak_mb:10.1f} MB" if peak_mb is not None else ""))
+        return result
+
+
+def run_stages(n_genes, n_samples, skip=(), seed=0, n_cpus=1, memory=True):
+    '''
+    Runs the pipeline stages once on a synthetic dataset, in the order the EDA and DGE run them.
+
+    Args:
+        n_genes, n_samples: size of the count matrix
+        skip: stages not to run (see OPTIONAL_STAGES, DEPENDENT_STAGES)
+        seed: seed of the synthetic data
+        n_cpus: CPUs used by PyDESeq2
+        memory: record the peak memory of each stage
+
+    Returns:
+        dataset description and list of stage records ('stage', 'seconds', 'peak_mb', 'max_rss_mb')
+    '''
+    from config.config import PCA_FAST_MIN_SAMPLES, PCA_N_COMPONENTS
+    from eda_pipeline.main import preprocess
+    from eda_pipeline.normalisation import NormalizedCounts, is_sparse
+    from eda_pipeline.eda import perform_pca, perform_umap
+    from eda_pipeline.correlation import sample_correlation
+    from eda_pipeline.parsing import parse_count_matrix
+    from dge_pipeline.dge import prepare_dge_data, fit_deseq_model, run_wald_tests, clean_dge_df
+    from dge_pipeline.filtering import filter_low_counts
+    from storage.dataset_cache import write_parquet
+
+    skip = set(skip)
+    for stage, dependents in DEPENDENT_STAGES.items():
+        if stage in skip:
+            skip.update(dependents)
+
+    count_matrix, design_matrix = synthetic_dataset(n_genes, n_samples, seed=seed)
+    dataset = {"n_genes": n_genes, "n_samples": n_samples, "seed": seed,
+               "zero_fraction": round(float((count_matrix.to_numpy() == 0).mean()), 4)}
+    timer = StageTimer(memory=memory)
+
+    if "parsing" not in skip:
+        raw = count_file_bytes(count_matrix)
+        dataset["file_bytes"] = len(raw)
+        del count_matrix
+
+        def parse():
+            parsed = parse_count_matrix(raw, GENE_COLUMN).set_index(GENE_COLUMN)
+            parsed.index.name = None
+            return parsed
+
+        count_matrix = timer.run("parsing", parse)
+        del raw
+
+    count_matrix, _, _ = timer.run("cleaning", preprocess, count_matrix, design_matrix)
+    dataset["sparse"] = is_sparse(count_matrix)
+    design_plotting = design_matrix[[CONTRAST_COLUMN]].rename(columns={CONTRAST_COLUMN: "condition"})
+
+    def normalise():
+        normalized = NormalizedCounts(count_matrix, dtype=np.float32)
+        normalized.library_sizes
+        normalized.log_cpm
+        return normalized
+
+    normalized = timer.run("cpm", normalise)
+    if "pca" not in skip:
+        pca_result = timer.run("pca", perform_pca, normalized, design_plotting, n_components=PCA_N_COMPONENTS,
+                               fast=n_samples >= PCA_FAST_MIN_SAMPLES)
+        if "umap" not in skip:
+            timer.run("umap", perform_umap, normalized, design_plotting, embedding=pca_result)
+    if "correlation" not in skip:
+        timer.run("correlation", sample_correlation, normalized)
+    del normalized
+
+    results = {}
+    if "dge_fit" not in skip:
+        def fit():
+            filtered, _ = filter_low_counts(count_matrix)
+            count_matrix_t, design_prepped = prepare_dge_data(filtered, design_matrix.copy())
+            return fit_deseq_model(count_matrix_t, design_prepped, n_cpus=n_cpus)
+
+        dds = timer.run("dge_fit", fit)
+        if "wald" not in skip:
+            contrast = [CONTRAST_COLUMN, "g1", "g0"]
+            results = timer.run("wald", run_wald_tests, dds, [contrast], n_cpus=n_cpus)
+        del dds
+
+    if "serialization" not in skip:
+        def serialize():
+            with tempfile.TemporaryDirectory() as directory:
+                write_parquet(count_matrix, Path(directory) / "processed_count_matrix.parquet")
+                for i, result in enumerate(results.values()):
+                    write_parquet(clean_dge_df(result), Path(directory) / f"dge_results_{i}.parquet")
+
+        timer.run("serialization", serialize)
+
+    return dataset, timer.records
@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+
+GENE_COLUMN = "gene_id"
+CONTRAST_COLUMN = "condition"
+
+
+def synthetic_dataset(n_genes, n_samples, n_groups=2, de_fraction=0.1, log2_fold_change_sd=1.0, seed=0,
+                      chunk_genes=5000):
+    '''
+    Seeded RNA-seq like count and design matrices. Counts are negative-binomial with log-normal gene means
+    (many lowly expressed genes, a long tail of highly expressed ones), a dispersion trend
+    alpha = 0.1 + 1 / mean, log-normal size factors and a fraction of differentially expressed genes
+    between the groups. Counts are drawn in chunks of genes so the peak memory stays close to the
+    size of the uint32 matrix.
+
+    Args:
+        n_genes: number of genes
+        n_samples: number of samples, assigned to the groups in turn
+        n_groups: number of levels of the 'condition' design column (g0 is the reference)
+        de_fraction: fraction of genes with a fold change in the non-reference groups
+        log2_fold_change_sd: standard deviation of the log2 fold changes
+        seed: random seed, the same arguments always give the same matrices
+        chunk_genes: genes drawn at once
+
+    Returns:
+        counts: genes x samples uint32 count matrix
+        design: design matrix indexed by sample with the 'condition' column
+    '''
+    rng = np.random.default_rng(seed)
+    groups = np.arange(n_samples) % n_groups
+
+    base_means = np.exp(rng.normal(3.0, 2.0, n_genes)).clip(0.1, 1e5)
+    dispersions = (0.1 + 1.0 / base_means) * np.exp(rng.normal(0.0, 0.5, n_genes))
+    size_factors = np.exp(rng.normal(0.0, 0.25, n_samples))
+
+    # log2 fold change of every gene in every group, zero for the reference group and non-DE genes
+    fold_changes = rng.normal(0.0, log2_fold_change_sd, (n_genes, n_groups))
+    fold_changes[:, 0] = 0.0
+    fold_changes[rng.random(n_genes) >= de_fraction] = 0.0
+
+    counts = np.empty((n_genes, n_samples), dtype=np.uint32)
+    for start in range(0, n_genes, chunk_genes):
+        stop = min(start + chunk_genes, n_genes)
+        means = base_means[start:stop, None] * size_factors[None, :] * np.exp2(fold_changes[start:stop][:, groups])
+        size = 1.0 / dispersions[start:stop, None]
+        counts[start:stop] = np.minimum(rng.negative_binomial(size, size / (size + means)), np.iinfo(np.uint32).max)
+
+    genes = [f"ENSG{i:011d}" for i in range(n_genes)]
+    samples = [f"S{i + 1:05d}" for i in range(n_samples)]
+    count_matrix = pd.DataFrame(counts, index=genes, columns=samples)
+    design_matrix = pd.DataFrame({CONTRAST_COLUMN: [f"g{group}" for group in groups]}, index=samples)
+    return count_matrix, design_matrix
+
+
+def count_file_bytes(count_matrix, sep="\t"):
+    '''
+    The count matrix as an uploaded file would hold it: delimited text with the genes in GENE_COLUMN.
+    '''
+    return count_matrix.to_csv(sep=sep, index_label=GENE_COLUMN).encode("utf-8")
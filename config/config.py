@@ -1,5 +1,69 @@
+import os
 from pathlib import Path
 
 ROOT = Path(__file__).resolve().parent.parent
 
-OUTPUT_PATH = ROOT / "results"
+# Analysis results: one directory per run with parquet files and a manifest.json (see storage/run_store.py)
+OUTPUT_PATH = Path(os.environ.get("DGE_OUTPUT_PATH", ROOT / "results"))
+
+# Server-side dataset cache (dcc.Store components only hold the cache key). The parquet files are shared
+# by all server processes, e.g. DGE_CACHE_PATH=/dev/shm/dge_cache keeps them in shared memory.
+CACHE_PATH = Path(os.environ.get("DGE_CACHE_PATH", ROOT / "cache"))
+CACHE_MEMORY_LIMIT = int(os.environ.get("DGE_CACHE_MEMORY_LIMIT", 2 * 1024 ** 3))  # bytes of frames kept in memory per process
+CACHE_DISK_LIMIT = 20 * 1024 ** 3  # bytes of parquet files kept on disk
+
+# Count matrices are memory-mapped (see storage/mmap_store.py), all processes share them in the page cache
+COUNTS_STORE_PATH = CACHE_PATH / "counts"
+COUNTS_DISK_LIMIT = 20 * 1024 ** 3  # bytes of matrix files kept on disk
+
+# Background jobs (state files shared by all server processes)
+JOBS_PATH = CACHE_PATH / "jobs"
+# DGE jobs running at a time, each fits with N_CPUS (8) CPUs. Further jobs wait in the queue.
+JOBS_MAX_CONCURRENT = int(os.environ.get("DGE_JOBS_MAX_CONCURRENT", max(1, (os.cpu_count() or 1) // 8)))
+
+# Low-count gene pre-filter applied before fitting the DGE model
+PREFILTER_MIN_TOTAL_COUNTS = 10  # minimum counts of a gene summed over all samples
+PREFILTER_MIN_CPM = None  # optionally require this CPM ...
+PREFILTER_MIN_SAMPLES = None  # ... in at least this many samples (default: smallest group)
+
+# PCA: fast mode (top variable genes + randomized solver) from this many samples on
+PCA_FAST_MIN_SAMPLES = 100
+PCA_N_TOP_GENES = 2000
+PCA_N_COMPONENTS = 10
+
+# UMAP runs on the top principal components, the kNN graph is cached per embedding
+UMAP_N_PCS = 10
+UMAP_KNN_MAX_NEIGHBORS = 50
+
+# Compiled numba kernels (UMAP) are cached here between server starts
+NUMBA_CACHE_PATH = CACHE_PATH / "numba"
+
+# Count matrices with at least this fraction of zeros are held sparse (CSC) in the EDA, None to stay dense.
+# Sparse columns keep a 4 byte position per non-zero entry, so they only pay off for zero-heavy data.
+SPARSE_MIN_ZERO_FRACTION = 0.7
+
+# Sample correlation heatmap: 'pearson' or 'spearman'
+CORRELATION_METHOD = "pearson"
+
+# Fast start: heavy analysis modules are imported in a background thread once the server listens
+FAST_START = os.environ.get("DGE_FAST_START", "1") != "0"
+
+# Development server (python app.py) with debugger and reloader, the production server is gunicorn.conf.py
+DEBUG = os.environ.get("DGE_DEBUG", "1") != "0"
+SERVER_PORT = int(os.environ.get("DGE_PORT", 8050))
+
+# Production server (gunicorn -c gunicorn.conf.py wsgi:server): worker processes x threads serving requests
+SERVER_WORKERS = int(os.environ.get("DGE_WORKERS", min(4, os.cpu_count() or 1)))
+SERVER_THREADS = int(os.environ.get("DGE_THREADS", 4))
+SERVER_TIMEOUT = 600  # seconds a request may take (the EDA runs in its callback)
+
+# Background writer persisting run results (see storage/writer.py)
+WRITER_THREADS = 2
+WRITER_QUEUE_SIZE = 8  # frames waiting to be written, producers block when the queue is full
+
+# Logging and metrics (see monitoring.py), served in the Prometheus text format on /metrics
+LOG_LEVEL = os.environ.get("DGE_LOG_LEVEL", "INFO")
+METRICS_PATH = CACHE_PATH / "metrics"  # metrics of finished job processes and of the server workers
+METRICS_WORKER_INTERVAL = 5  # seconds between saves of a server worker's metrics
+METRICS_LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800]
+METRICS_PAYLOAD_BUCKETS = [1024 * 4 ** i for i in range(12)]  # 1 KiB to 4 GiB
@@ -0,0 +1,30 @@
+'''
+Batch DGE analysis without the dashboard, e.g.
+
+    python -m dge_pipeline --counts counts.tsv.gz --design design.csv --gene-column gene_id \
+        --contrast condition treatment control
+    python -m dge_pipeline --manifest jobs.json --workers 2 --cpus-per-job 4
+'''
+from jobs.batch import batch_argument_parser, load_jobs, run_batch
+
+
+def main():
+    parser = batch_argument_parser("Differential gene expression analysis of one or many count / design matrix pairs.")
+    parser.add_argument("--contrast", dest="contrasts", nargs=3, action="append",
+                        metavar=("VARIABLE", "TESTED", "CONTROL"), help="contrast to test, can be repeated")
+    parser.add_argument("--all-pairwise", metavar="VARIABLE", help="test all pairwise comparisons of the variable")
+    parser.add_argument("--min-total-counts", type=int, help="low-count pre-filter: minimum total counts per gene")
+    parser.add_argument("--min-cpm", type=float, help="low-count pre-filter: minimum CPM in the smallest group")
+    args = parser.parse_args()
+
+    # Imported here: the pool workers limit their thread pools before the analysis modules are loaded
+    from dge_pipeline.main import run_dge_batch_job
+
+    jobs = load_jobs(args, ["contrasts", "all_pairwise", "min_total_counts", "min_cpm"])
+    summaries = run_batch(run_dge_batch_job, jobs, workers=args.workers, cpus_per_job=args.cpus_per_job,
+                          force=args.force, summary_path=args.summary)
+    raise SystemExit(1 if any(s["status"] == "failed" for s in summaries) else 0)
+
+
+if __name__ == "__main__":
+    main()
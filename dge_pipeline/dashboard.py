@@ -1,13 +1,35 @@
-from dash import html, dcc
+from dash import html, dcc, dash_table
+from dash import Input, Output, State, ClientsideFunction, ctx
+import dash_bootstrap_components as dbc
 import numpy as np
-import pandas as pd
-from dash import Input, Output, callback
-import plotly.express as px
+import plotly.graph_objects as go
+from .results import load_result_frame, load_result_table, TABLE_COLUMNS, RANGE_COLUMNS
 
+P_THRESHOLD_MAX = 0.1  # upper bound of the p-value threshold sliders
 
-def dge_dashboard_layout():
+# Level-of-detail rendering: above LOD_POINT_LIMIT genes, only the LOD_POINT_LIMIT genes with the smallest
+# p-values (below P_THRESHOLD_MAX) are drawn as individual markers, all others as a density raster
+LOD_POINT_LIMIT = 10000
+LOD_BINS = (200, 120)
+
+TABLE_PAGE_SIZE = 25
+
+
+def dge_dashboard_layout(info_messages=None):
+
+    info_div = html.Div([
+        html.H4("Info and Status Messages:"),
+        *[html.P(msg) for msg in info_messages or []]
+    ], style={
+        'padding': '10px',
+        'backgroundColor': '#f9f9f9',
+        'border': '1px solid #ddd',
+        'marginBottom': '20px'
+    })
 
     return html.Div([
+    info_div,
+
     # Volcano Plot Section: Controls left, plot right
     html.H4("Volcano Plot Controls", style={"textAlign": "center"}),
     html.Div([
@@ -30,17 +52,17 @@ def dge_dashboard_layout():
                 min=0, max=3, step=0.1, value=1,
                 marks={i: str(i) for i in range(4)},
                 tooltip={"placement": "bottom"},
-                updatemode='mouseup',
+                updatemode='drag',
                 included=True,
             ),
             html.Br(),
             html.Label("P-Value Threshold:"),
             dcc.Slider(
                 id="volcano-p",
-                min=0.001, max=0.1, step=0.001, value=0.05,
+                min=0.001, max=P_THRESHOLD_MAX, step=0.001, value=0.05,
                 marks={0.01: "0.01", 0.05: "0.05", 0.1: "0.1"},
                 tooltip={"placement": "bottom"},
-                updatemode='mouseup',
+                updatemode='drag',
                 included=True,
             )
         ], style={
@@ -54,7 +76,8 @@ def dge_dashboard_layout():
 
         # Right side: plot
         html.Div([
-            dcc.Graph(id="volcano-plot", style={"height": "400px", "width": "100%"})
+            dcc.Graph(id="volcano-plot", style={"height": "400px", "width": "100%"}),
+            dcc.Store(id="volcano-points")
         ], style={"flex": "1"}),
     ], style={"display": "flex", "alignItems": "center", "margin": "20px 0", "width": "100%"}),
 
@@ -79,17 +102,17 @@ def dge_dashboard_layout():
                 min=0, max=3, step=0.1, value=1,
                 marks={i: str(i) for i in range(4)},
                 tooltip={"placement": "bottom"},
-                updatemode='mouseup',
+                updatemode='drag',
                 included=True,
             ),
             html.Br(),
             html.Label("P-Value Threshold:"),
             dcc.Slider(
                 id="ma-p",
-                min=0.001, max=0.1, step=0.001, value=0.05,
+                min=0.001, max=P_THRESHOLD_MAX, step=0.001, value=0.05,
                 marks={0.01: "0.01", 0.05: "0.05", 0.1: "0.1"},
                 tooltip={"placement": "bottom"},
-                updatemode='mouseup',
+                updatemode='drag',
                 included=True,
             )
         ], style={
@@ -102,7 +125,8 @@ def dge_dashboard_layout():
         }),
 
         html.Div([
-            dcc.Graph(id="ma-plot", style={"height": "400px", "width": "100%"})
+            dcc.Graph(id="ma-plot", style={"height": "400px", "width": "100%"}),
+            dcc.Store(id="ma-points")
         ], style={"flex": "1"}),
     ], style={"display": "flex", "alignItems": "center", "margin": "20px 0", "width": "100%"}),
 
@@ -135,6 +159,42 @@ def dge_dashboard_layout():
         ], style={"flex": "1"}),
     ], style={"display": "flex", "alignItems": "center", "margin": "20px 0", "width": "100%"}),
 
+
+    # Results table: only the requested page is sent, paging, sorting and filtering run on the server
+    html.H4("Results Table", style={"textAlign": "center"}),
+    html.Div([
+        html.Div([
+            html.Label("Gene name contains:"),
+            dbc.Input(id="dge-table-search", type="text", debounce=True, placeholder="e.g. BRCA"),
+        ], style={"flex": "1 1 200px"}),
+        *[html.Div([
+            html.Label(f"{column} from / to:"),
+            html.Div([
+                dbc.Input(id=f"dge-table-{column}-min", type="number", debounce=True),
+                dbc.Input(id=f"dge-table-{column}-max", type="number", debounce=True),
+            ], style={"display": "flex", "gap": "5px"}),
+        ], style={"flex": "1 1 200px"}) for column in RANGE_COLUMNS],
+    ], style={"display": "flex", "gap": "20px", "margin": "10px 0"}),
+    html.Div(id="dge-table-count", style={"fontSize": "14px", "color": "#555"}),
+    html.Div("Click a gene in the table to mark it in the volcano and MA plot.",
+             style={"fontSize": "14px", "color": "#555"}),
+    dcc.Store(id="dge-selected-gene"),
+    dash_table.DataTable(
+        id="dge-table",
+        columns=[{"name": "Gene", "id": "Gene"}] + [
+            {"name": column, "id": column, "type": "numeric", "format": {"specifier": ".4g"}}
+            for column in TABLE_COLUMNS],
+        page_current=0,
+        page_size=TABLE_PAGE_SIZE,
+        page_action="custom",
+        sort_action="custom",
+        sort_mode="single",
+        sort_by=[{"column_id": "padj", "direction": "asc"}],
+        style_table={"overflowX": "auto"},
+        style_cell={"textAlign": "center", "padding": "5px"},
+        style_header={"fontWeight": "bold", "backgroundColor": "#f9f9f9"}
+    ),
+
 ])
 
 
@@ -142,84 +202,204 @@ def dge_dashboard_layout():
 
 
 
+def density_layer(x, y, log_x=False):
+    '''
+    Aggregates points into a fixed size 2D histogram, so the payload does not grow with the number of genes.
+
+    Args:
+        x, y: point coordinates
+        log_x: bin x in log10 space (MA plot)
+
+    Returns:
+        dictionary with bin centers and counts (empty bins as None) for a heatmap trace
+
+    '''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if log_x:
+        x = np.log10(x, where=x > 0, out=np.full_like(x, np.nan))
+    finite = np.isfinite(x) & np.isfinite(y)
+
+    counts, x_edges, y_edges = np.histogram2d(x[finite], y[finite], bins=LOD_BINS)
+    x_centers = (x_edges[:-1] + x_edges[1:]) / 2
+    y_centers = (y_edges[:-1] + y_edges[1:]) / 2
+    if log_x:
+        x_centers = 10 ** x_centers
+
+    z = np.where(counts.T > 0, counts.T, np.nan)  # rows = y bins
+    return {
+        "x": x_centers.tolist(),
+        "y": y_centers.tolist(),
+        "z": [[None if np.isnan(v) else int(v) for v in row] for row in z],
+    }
+
+
+def threshold_points(df, x, y, pval_type, plot, layout, log_x=False):
+    '''
+    Collects the point arrays the client-side threshold callback (assets/dge_thresholds.js) needs.
+    Colors and threshold lines are computed in the browser, so slider changes do not reach the server.
+
+    For large results at most LOD_POINT_LIMIT genes are sent as individual (WebGL) points, the genes with
+    the smallest p-values below P_THRESHOLD_MAX. All others are aggregated into a density layer, so the
+    payload does not grow with the number of genes. 'p_limit' is the p-value from which genes are in the
+    density layer, the colors are exact for p-value thresholds up to p_limit.
+
+    Args:
+        df: plot-ready result frame from load_result_frame
+        x, y: columns plotted on the axes
+        pval_type: 'pvalue' or 'padj'
+        plot: 'volcano' or 'ma'
+        layout: figure layout (title, axes, template)
+        log_x: x axis is logarithmic
+
+    Returns:
+        dictionary for the points dcc.Store
+
+    '''
+    df = df[df[pval_type].notna()]
+
+    density, p_limit = None, None
+    if len(df) > LOD_POINT_LIMIT:
+        p = df[pval_type].to_numpy()
+        order = np.argsort(p, kind="stable")
+        n_points = min(LOD_POINT_LIMIT, int(np.searchsorted(p[order], P_THRESHOLD_MAX, side="left")))
+        p_limit = float(min(P_THRESHOLD_MAX, p[order[n_points]]))
+        points = np.zeros(len(df), dtype=bool)
+        points[order[:n_points]] = True
+        background = df[~points]
+        density = density_layer(background[x], background[y], log_x=log_x)
+        df = df[points]
+
+    return {
+        "plot": plot,
+        "x_column": x,
+        "y_column": y,
+        "pval_type": pval_type,
+        "p_limit": p_limit,
+        "trace_type": "scatter" if density is None else "scattergl",
+        "x": df[x].tolist(),
+        "y": df[y].tolist(),
+        "lfc": df["log2FoldChange"].tolist(),
+        "p": df[pval_type].tolist(),
+        "genes": df["Gene Name"].astype(str).tolist(),
+        "hovertemplate": f"Gene Name=%{{text}}<br>{x}=%{{x}}<br>{y}=%{{y}}",
+        "density": density,
+        "layout": layout.to_plotly_json(),
+    }
+
+
 def register_gde_callbacks(app):
 
+    # Point arrays are only rebuilt when the result or the p-value type changes
     @app.callback(
-        Output("volcano-plot", "figure"),
+        Output("volcano-points", "data"),
         Input("dge-result-store", "data"),
-        Input("volcano-fc", "value"),
-        Input("volcano-p", "value"),
         Input("volcano-pval-type", "value")
     )
-    def update_volcano(json_data, fc_thresh, p_thresh, pval_type):
-        if not json_data:
-            return px.scatter(title="No data")
+    def update_volcano(result_key, pval_type):
+        df = load_result_frame(result_key)
+        if df is None:
+            return None
 
-        dge_data = pd.read_json(json_data, orient="split")
-        dge_data = dge_data.dropna(subset=["log2FoldChange", pval_type])
-
-        df = dge_data.copy()
-        df["selected_p"] = df[pval_type]
-        df["-log10p"] = -np.log10(df["selected_p"])
-        df["significant"] = (abs(df["log2FoldChange"]) > fc_thresh) & (df["selected_p"] < p_thresh)
-        df["Gene Name"] = df.index
-
-        fig = px.scatter(
-            df, x="log2FoldChange", y="-log10p",
-            color="significant",
-            hover_data=["Gene Name"],
-            color_discrete_map={True: "red", False: "gray"},
-            title=f"Volcano Plot ({pval_type})"
-        )
-        fig.add_vline(x=fc_thresh, line_dash="dot", line_color="blue")
-        fig.add_vline(x=-fc_thresh, line_dash="dot", line_color="blue")
-        fig.add_hline(y=-np.log10(p_thresh), line_dash="dot", line_color="green")
-        return fig
+        y = f"-log10({pval_type})"
+        layout = go.Figure(layout=go.Layout(
+            title=f"Volcano Plot ({pval_type})",
+            xaxis_title="log2FoldChange", yaxis_title=y,
+            legend_title_text="significant"
+        )).layout
+        return threshold_points(df, "log2FoldChange", y, pval_type, "volcano", layout)
 
     @app.callback(
-        Output("ma-plot", "figure"),
+        Output("ma-points", "data"),
         Input("dge-result-store", "data"),
-        Input("ma-fc", "value"),
-        Input("ma-p", "value"),
         Input("ma-pval-type", "value")
     )
-    def update_ma(json_data, fc_thresh, p_thresh, pval_type):
-        if not json_data:
-            return px.scatter(title="No data")
-
-        dge_data = pd.read_json(json_data, orient="split")
-        dge_data = dge_data.dropna(subset=["log2FoldChange", pval_type])
+    def update_ma(result_key, pval_type):
+        df = load_result_frame(result_key)
+        if df is None:
+            return None
 
-        df = dge_data.copy()
-        df["selected_p"] = df[pval_type]
-        df["significant"] = (abs(df["log2FoldChange"]) > fc_thresh) & (df["selected_p"] < p_thresh)
-        df["Gene name"] = df.index
+        layout = go.Figure(layout=go.Layout(
+            title=f"MA Plot ({pval_type})",
+            xaxis_title="baseMean", xaxis_type="log", yaxis_title="log2FoldChange",
+            legend_title_text="significant"
+        )).layout
+        return threshold_points(df, "baseMean", "log2FoldChange", pval_type, "ma", layout, log_x=True)
 
-        fig = px.scatter(
-            df, x="baseMean", y="log2FoldChange",
-            color="significant", hover_data=["Gene name"],
-            log_x=True,
-            color_discrete_map={True: "red", False: "gray"},
-            title=f"MA Plot ({pval_type})"
+    # Significance colors and threshold lines are recomputed in the browser
+    for plot in ["volcano", "ma"]:
+        app.clientside_callback(
+            ClientsideFunction(namespace="dge", function_name="threshold_figure"),
+            Output(f"{plot}-plot", "figure"),
+            Input(f"{plot}-points", "data"),
+            Input(f"{plot}-fc", "value"),
+            Input(f"{plot}-p", "value"),
+            Input("dge-selected-gene", "data")
         )
-        return fig
+
+    # The gene clicked in the table is drawn as its own marker, also if it is part of the density layer
+    @app.callback(
+        Output("dge-selected-gene", "data"),
+        Input("dge-result-store", "data"),
+        Input("dge-table", "active_cell"),
+        State("dge-table", "data")
+    )
+    def select_gene(result_key, active_cell, rows):
+        df = load_result_frame(result_key)
+        if df is None or ctx.triggered_id != "dge-table" or not active_cell or not rows \
+                or active_cell["row"] >= len(rows):
+            return None
+        gene = rows[active_cell["row"]]["Gene"]
+        if gene not in df.index:
+            return None
+        values = df.loc[gene, ["log2FoldChange", "baseMean", "pvalue", "padj", "-log10(pvalue)", "-log10(padj)"]]
+        return {"gene": str(gene), **{column: None if np.isnan(value) else float(value)
+                                      for column, value in values.items()}}
+
+    @app.callback(
+        Output("dge-table", "data"),
+        Output("dge-table", "page_count"),
+        Output("dge-table", "page_current"),
+        Output("dge-table-count", "children"),
+        Input("dge-result-store", "data"),
+        Input("dge-table", "page_current"),
+        Input("dge-table", "page_size"),
+        Input("dge-table", "sort_by"),
+        Input("dge-table-search", "value"),
+        *[Input(f"dge-table-{column}-{bound}", "value") for column in RANGE_COLUMNS for bound in ("min", "max")]
+    )
+    def update_dge_table(result_key, page_current, page_size, sort_by, search, *bounds):
+        table = load_result_table(result_key)
+        if table is None:
+            return [], 1, 0, ""
+
+        # a new result, filter or sort order starts on the first page
+        if "dge-table.page_current" not in ctx.triggered_prop_ids:
+            page_current = 0
+        ranges = {column: (bounds[2 * i], bounds[2 * i + 1]) for i, column in enumerate(RANGE_COLUMNS)}
+        sort = sort_by[0] if sort_by else {"column_id": "padj", "direction": "asc"}
+        page_size = page_size or TABLE_PAGE_SIZE
+        rows, page, n_matching = table.query(search=(search or "").strip(), ranges=ranges,
+                                             sort_column=sort["column_id"], descending=sort["direction"] == "desc",
+                                             page=page_current or 0, page_size=page_size)
+        page_count = max(1, -(-n_matching // page_size))
+        return rows, page_count, page, f"{n_matching} of {len(table)} genes"
 
     @app.callback(
         Output("pval-dist", "figure"),
         Input("dge-result-store", "data"),
         Input("dist-pval-type", "value")
     )
-    def update_pval_dist(json_data, pval_type):
-        if not json_data:
-            return px.scatter(title="No data")
+    def update_pval_dist(result_key, pval_type):
+        import plotly.express as px  # imported on first use (see startup.py)
 
-        dge_data = pd.read_json(json_data, orient="split")
-        dge_data = dge_data.dropna(subset=["log2FoldChange", pval_type])
+        df = load_result_frame(result_key)
+        if df is None:
+            return px.scatter(title="No data")
 
-        df = dge_data.copy()
         fig = px.histogram(
             df, x=pval_type, nbins=50,
             title=f"P-Value Distribution ({pval_type})",
             labels={pval_type: pval_type}
         )
-        return fig
\ No newline at end of file
+        return fig
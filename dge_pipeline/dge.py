@@ -1,63 +1,187 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from itertools import combinations
 import pandas as pd
-from pydeseq2.dds import DeseqDataSet
-from pydeseq2.ds import DeseqStats
-from pydeseq2.default_inference import DefaultInference
-from config.config import OUTPUT_PATH
+from jobs.manager import JobCancelled
+from eda_pipeline.normalisation import is_sparse
+from monitoring import span, payload_size
+
+logger = logging.getLogger(__name__)
+
+N_CPUS = 8
 
 def prepare_dge_data(count_matrix, design_matrix):
     try:
+        if is_sparse(count_matrix):
+            count_matrix = count_matrix.sparse.to_dense()
         transposed_count_matrix = count_matrix.T
+        # Uploads are parsed into compact unsigned types, PyDESeq2 computes on the raw counts
+        if all(pd.api.types.is_unsigned_integer_dtype(dtype) for dtype in transposed_count_matrix.dtypes):
+            transposed_count_matrix = transposed_count_matrix.astype("int64")
         desired_order = transposed_count_matrix.index
         design_matrix = design_matrix.loc[desired_order]
         return transposed_count_matrix, design_matrix
     except Exception as e:
-        print(f"[prepare_dge_data] Error: {e}")
+        logger.exception("[prepare_dge_data] Error: %s", e)
         return None, None
 
-def run_pydeseq2(count_matrix, design_matrix, contrasts, design_formula=None):
+def report_progress(progress, stage, fraction=None):
+    if progress is not None:
+        progress(stage, fraction)
+
+def fit_deseq_dataset(dds, progress=None):
+    '''
+    Same steps as DeseqDataSet.deseq2(), with progress reported between the stages.
+
+    Args:
+        dds: DeseqDataSet
+        progress: optional callback progress(stage, fraction)
+
+    '''
+    report_progress(progress, "Fitting size factors", 0.1)
+    dds.fit_size_factors(fit_type=dds.size_factors_fit_type, control_genes=dds.control_genes)
+
+    report_progress(progress, "Fitting dispersions", 0.2)
+    dds.fit_genewise_dispersions()
+    dds.fit_dispersion_trend()
+    dds.fit_dispersion_prior()
+    dds.fit_MAP_dispersions()
+
+    report_progress(progress, "Fitting log fold changes", 0.5)
+    dds.fit_LFC()
+    dds.calculate_cooks()
+
+    if dds.refit_cooks:
+        report_progress(progress, "Refitting Cook's outliers", 0.7)
+        dds.refit()
+
+    dds.cooks_outlier()
+
+def contrast_label(contrast):
+    return f"{contrast[0]}: {contrast[1]} vs {contrast[2]}"
+
+def pairwise_contrasts(design_matrix, variable):
+    '''
+    Args:
+        design_matrix: design matrix
+        variable: contrast variable
+
+    Returns:
+        list of all pairwise contrasts [variable, level_2, level_1] between the levels of variable,
+        the later level is tested against the earlier one
+    '''
+    levels = design_matrix[variable].astype("category").cat.categories.tolist()
+    return [[variable, levels[j], levels[i]] for i, j in combinations(range(len(levels)), 2)]
+
+def fit_deseq_model(count_matrix, design_matrix, design_formula=None, progress=None, n_cpus=N_CPUS):
+    '''
+    Builds and fits the DeseqDataSet. Only the Wald tests depend on the contrast,
+    so one fitted model serves all contrasts of the same counts, design and formula.
+    '''
+    # pydeseq2 (and anndata) are heavy, imported on first use (see startup.py)
+    from pydeseq2.dds import DeseqDataSet
+    from pydeseq2.default_inference import DefaultInference
+
+    if design_formula is None:
+        design_formula = "~ " + " + ".join(design_matrix.columns)
+
+    # Ensure categorical
+    for col in design_matrix.columns:
+        design_matrix[col] = design_matrix[col].astype("category")
+
+    dds = DeseqDataSet(
+        counts=count_matrix,
+        metadata=design_matrix,
+        design=design_formula,
+        refit_cooks=True,
+        inference=DefaultInference(n_cpus=n_cpus),
+    )
+    fit_deseq_dataset(dds, progress=progress)
+    return dds
+
+def run_wald_test(dds, contrast, n_cpus=N_CPUS):
+    from pydeseq2.ds import DeseqStats
+    from pydeseq2.default_inference import DefaultInference
 
+    ds = DeseqStats(
+        dds,
+        contrast=contrast,
+        inference=DefaultInference(n_cpus=n_cpus),
+        cooks_filter=True,
+        independent_filter=True,
+        quiet=True,
+    )
+    ds.summary()
+    return ds.results_df
+
+def run_wald_tests(dds, contrasts, progress=None, n_cpus=N_CPUS):
+    '''
+    Runs the Wald tests of several contrasts on one fitted model in parallel.
+    The CPU budget is split between the contrasts tested at the same time.
+
+    Returns:
+        dictionary contrast label -> results data frame
+    '''
+    report_progress(progress, "Running Wald tests", 0.8)
+    n_parallel = max(1, min(len(contrasts), n_cpus))
+    cpus_per_test = max(1, n_cpus // n_parallel)
+
+    with ThreadPoolExecutor(max_workers=n_parallel) as executor:
+        futures = {contrast_label(contrast): executor.submit(run_wald_test, dds, contrast, cpus_per_test)
+                   for contrast in contrasts}
+        return {label: future.result() for label, future in futures.items()}
+
+def run_pydeseq2_contrasts(count_matrix, design_matrix, contrasts, design_formula=None, progress=None, n_cpus=N_CPUS):
+    '''
+    Fits the model once and tests every contrast in contrasts.
+
+    Args:
+        count_matrix: samples x genes count matrix
+        design_matrix: design matrix aligned with count_matrix
+        contrasts: list of contrasts like [variable, level_1, level_2]
+        design_formula: optional design formula, by default all design columns
+        progress: optional callback progress(stage, fraction)
+        n_cpus: number of CPUs used by PyDESeq2
+
+    Returns:
+        dictionary contrast label -> results data frame or None on error
+    '''
     try:
-        if design_formula is None:
-            design_formula = "~ " + " + ".join(design_matrix.columns)
-
-        if len(contrasts) != 3:
-            raise ValueError("Contrasts must be a list like: [variable, level_1, level_2]")
-
-        contrast = contrasts  # [variable, level1, level2]
-        contrast_var = contrast[0]
-
-        if contrast_var not in design_matrix.columns:
-            raise ValueError(f"Contrast variable '{contrast_var}' not found in design matrix.")
-
-        inference = DefaultInference(n_cpus=8)
-
-        # Ensure categorical
-        for col in design_matrix.columns:
-            design_matrix[col] = design_matrix[col].astype("category")
-
-        dds = DeseqDataSet(
-            counts=count_matrix,
-            metadata=design_matrix,
-            design=design_formula,
-            refit_cooks=True,
-            inference=inference,
-        )
-        dds.deseq2()
-
-        ds = DeseqStats(
-            dds,
-            contrast=contrast,
-            inference=inference,
-            cooks_filter=True,
-            independent_filter=True,
-        )
-        ds.summary()
-        return ds.results_df
+        if not contrasts:
+            raise ValueError("At least one contrast has to be provided.")
+
+        for contrast in contrasts:
+            if len(contrast) != 3:
+                raise ValueError("Contrasts must be a list like: [variable, level_1, level_2]")
+            if contrast[0] not in design_matrix.columns:
+                raise ValueError(f"Contrast variable '{contrast[0]}' not found in design matrix.")
+
+        with span("dge.fit", data_in=count_matrix):
+            dds = fit_deseq_model(count_matrix, design_matrix, design_formula=design_formula, progress=progress,
+                                  n_cpus=n_cpus)
+        with span("dge.wald") as stage:
+            results = run_wald_tests(dds, contrasts, progress=progress, n_cpus=n_cpus)
+            stage.payload_out = payload_size(results)
+        return results
 
+    except JobCancelled:
+        raise
     except Exception as e:
-        print(f"[run_pydeseq2] Error: {e}")
+        logger.exception("[run_pydeseq2_contrasts] Error: %s", e)
         return None
 
+def run_pydeseq2(count_matrix, design_matrix, contrasts, design_formula=None, progress=None):
+
+    if len(contrasts) != 3:
+        logger.error("[run_pydeseq2] Error: Contrasts must be a list like: [variable, level_1, level_2]")
+        return None
+
+    results = run_pydeseq2_contrasts(count_matrix, design_matrix, [contrasts], design_formula=design_formula,
+                                     progress=progress)
+    if results is None:
+        return None
+    return results[contrast_label(contrasts)]
+
 def clean_dge_df(df):
     try:
         df = df.copy()
@@ -70,12 +194,5 @@ def clean_dge_df(df):
         df["baseMean"] = pd.to_numeric(df["baseMean"], errors="coerce")
         return df
     except Exception as e:
-        print(f"[clean_dge_df] Error: {e}")
+        logger.exception("[clean_dge_df] Error: %s", e)
         return None
-
-def save_csv_file(data, file_name):
-    try:
-        file_path = OUTPUT_PATH / file_name
-        data.to_csv(file_path, sep=',')
-    except Exception as e:
-        print(f"[save_csv_file] Error: {e}")
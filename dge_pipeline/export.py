@@ -0,0 +1,163 @@
+import io
+import re
+import zlib
+
+EXPORT_CHUNK_ROWS = 50000  # rows serialised at once while streaming
+EXPORT_FORMATS = {
+    "csv.gz": "application/gzip",
+    "tsv": "text/tab-separated-values",
+    "parquet": "application/vnd.apache.parquet",
+}
+EXPORT_ROWS = ["all", "significant", "top"]
+RESULT_KEY_PATTERN = re.compile(r"^[0-9a-f]{24}$")
+RESULT_COLUMNS = ["log2FoldChange", "pvalue", "padj"]  # only frames with these columns are served
+
+
+def filter_results(dge_df, rows="all", fc_threshold=1.0, p_threshold=0.05, pval_type="padj", top=100):
+    '''
+    Selects the exported rows of a DGE result before it is serialised.
+
+    Args:
+        dge_df: cleaned DGE result
+        rows: 'all', 'significant' (|log2FoldChange| > fc_threshold and pval_type < p_threshold,
+            like the volcano plot) or 'top' (the top genes with the smallest padj)
+        fc_threshold, p_threshold, pval_type: significance thresholds
+        top: number of genes of 'top'
+
+    Returns:
+        filtered result (a view of dge_df for 'all')
+    '''
+    if rows == "significant":
+        significant = (dge_df["log2FoldChange"].abs() > fc_threshold) & (dge_df[pval_type] < p_threshold)
+        return dge_df[significant]
+    if rows == "top":
+        return dge_df.nsmallest(max(0, int(top)), "padj")
+    return dge_df
+
+
+def _index_label(dge_df):
+    return dge_df.index.name or "gene"
+
+
+def iter_delimited(dge_df, sep, compress=False, chunk_rows=EXPORT_CHUNK_ROWS):
+    '''
+    Yields the result as delimited text in chunks of chunk_rows rows, optionally gzip compressed,
+    so only one chunk is serialised in memory at a time.
+    '''
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if compress else None
+    for start in range(0, max(len(dge_df), 1), chunk_rows):
+        text = dge_df.iloc[start:start + chunk_rows].to_csv(sep=sep, header=start == 0,
+                                                             index_label=_index_label(dge_df))
+        data = text.encode("utf-8")
+        if compressor is not None:
+            data = compressor.compress(data)
+        if data:
+            yield data
+    if compressor is not None:
+        yield compressor.flush()
+
+
+class _ChunkSink(io.RawIOBase):
+    # File object collecting what the parquet writer wrote since the last take()
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def take(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_parquet(dge_df, chunk_rows=EXPORT_CHUNK_ROWS):
+    '''
+    Yields the result as a parquet file with one row group per chunk of chunk_rows rows.
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    sink = _ChunkSink()
+    data = dge_df.rename_axis(_index_label(dge_df))
+    writer = None
+    for start in range(0, max(len(data), 1), chunk_rows):
+        table = pa.Table.from_pandas(data.iloc[start:start + chunk_rows], preserve_index=True,
+                                     schema=writer.schema if writer is not None else None)
+        if writer is None:
+            writer = pq.ParquetWriter(sink, table.schema)
+        writer.write_table(table)
+        chunk = sink.take()
+        if chunk:
+            yield chunk
+    writer.close()
+    yield sink.take()
+
+
+def iter_export(dge_df, fmt):
+    '''
+    Returns:
+        generator of the serialised result in format fmt (see EXPORT_FORMATS)
+    '''
+    if fmt == "csv.gz":
+        return iter_delimited(dge_df, ",", compress=True)
+    if fmt == "tsv":
+        return iter_delimited(dge_df, "\t")
+    if fmt == "parquet":
+        return iter_parquet(dge_df)
+    raise ValueError(f"Unknown export format '{fmt}', expected one of {', '.join(EXPORT_FORMATS)}.")
+
+
+def export_filename(fmt, rows="all", top=100, name="dge_results"):
+    suffix = {"all": "", "significant": "_significant", "top": f"_top{top}"}[rows]
+    return f"{name}{suffix}.{fmt}"
+
+
+def register_download_route(app):
+    '''
+    Adds the /download/dge/<result_key>?format=&rows=&fc=&p=&pval_type=&top= route to the Flask server
+    (the query parameters of filter_results, the link is built in assets/dge_thresholds.js). The result is
+    read from the dataset cache, filtered and streamed in the requested format, it never passes through
+    a callback. Other cached frames (count and design matrices) are not served.
+    '''
+    from flask import Response, abort, request
+    from storage.dataset_cache import get_frame
+    from monitoring import span
+
+    server = app.server
+
+    @server.route("/download/dge/<result_key>")
+    def download_dge(result_key):
+        fmt = request.args.get("format", "csv.gz")
+        rows = request.args.get("rows", "all")
+        pval_type = request.args.get("pval_type", "padj")
+        if not RESULT_KEY_PATTERN.match(result_key) or fmt not in EXPORT_FORMATS or rows not in EXPORT_ROWS \
+                or pval_type not in ("pvalue", "padj"):
+            abort(400)
+        try:
+            fc_threshold = float(request.args.get("fc", 1.0))
+            p_threshold = float(request.args.get("p", 0.05))
+            top = int(request.args.get("top", 100))
+        except ValueError:
+            abort(400)
+
+        dge_df = get_frame(result_key)
+        if dge_df is None or not all(column in dge_df.columns for column in RESULT_COLUMNS):
+            abort(404)
+        with span("dge.export_filter", data_in=dge_df):
+            dge_df = filter_results(dge_df, rows=rows, fc_threshold=fc_threshold, p_threshold=p_threshold,
+                                    pval_type=pval_type, top=top)
+
+        filename = export_filename(fmt, rows=rows, top=top)
+        return Response(iter_export(dge_df, fmt), mimetype=EXPORT_FORMATS[fmt],
+                        headers={"Content-Disposition": f'attachment; filename="{filename}"'})
@@ -0,0 +1,86 @@
+import numpy as np
+from eda_pipeline.normalisation import is_sparse, sparse_values, select_genes
+from config.config import PREFILTER_MIN_TOTAL_COUNTS, PREFILTER_MIN_CPM, PREFILTER_MIN_SAMPLES
+
+
+def resolve_min_samples(count_matrix, design_matrix, group_column, min_cpm=PREFILTER_MIN_CPM,
+                        min_samples=PREFILTER_MIN_SAMPLES):
+    '''
+    Default of the CPM criterion's min_samples, shared by the EDA report and the DGE pre-filter so both
+    count the same genes.
+
+    Args:
+        count_matrix: count matrix (genes x samples)
+        design_matrix: design matrix, samples as index
+        group_column: design column of the compared groups (the contrast variable)
+        min_cpm, min_samples: pre-filter settings (see low_count_mask)
+
+    Returns:
+        min_samples, the size of the smallest group if it is None and the CPM criterion is enabled
+    '''
+    if not min_cpm or min_samples is not None:
+        return min_samples
+    return int(design_matrix.loc[count_matrix.columns, group_column].value_counts().min())
+
+
+def low_count_mask(count_matrix, min_total_counts=PREFILTER_MIN_TOTAL_COUNTS, min_cpm=PREFILTER_MIN_CPM,
+                   min_samples=PREFILTER_MIN_SAMPLES):
+    '''
+
+    Args:
+        count_matrix: count matrix (genes x samples), dense or sparse
+        min_total_counts: minimum counts of a gene summed over all samples, None to disable
+        min_cpm: minimum CPM a gene must reach in at least min_samples samples, None to disable
+        min_samples: number of samples for the CPM criterion, by default 1 (see resolve_min_samples)
+
+    Returns:
+        keep: boolean array, True for genes passing the pre-filter
+        message: how many genes pass
+
+    '''
+    sparse = is_sparse(count_matrix)
+    counts = sparse_values(count_matrix) if sparse else count_matrix.to_numpy()
+    keep = np.ones(counts.shape[0], dtype=bool)
+
+    if min_total_counts:
+        keep &= np.asarray(counts.sum(axis=1)).ravel() >= min_total_counts
+
+    if min_cpm:
+        # CPM >= min_cpm  <=>  counts >= min_cpm * library size / 1e6, no CPM matrix needed
+        count_thresholds = min_cpm * np.asarray(counts.sum(axis=0)).ravel() / 1e6
+        if sparse:
+            # zeros only pass in empty samples (threshold 0), the non-zero entries are compared directly
+            passing = counts.copy()
+            passing.data = passing.data >= np.repeat(count_thresholds, np.diff(counts.indptr))
+            n_passing = np.asarray(passing.sum(axis=1)).ravel() + (count_thresholds <= 0).sum()
+        else:
+            n_passing = (counts >= count_thresholds).sum(axis=1)
+        keep &= n_passing >= (min_samples or 1)
+
+    n_all_genes = keep.size
+    n_kept = int(keep.sum())
+    criteria = []
+    if min_total_counts:
+        criteria.append(f"at least {min_total_counts} counts in total")
+    if min_cpm:
+        criteria.append(f"CPM >= {min_cpm} in at least {min_samples or 1} samples")
+    message = (f'Low-count pre-filter ({" and ".join(criteria) or "disabled"}): keeping {n_kept} of {n_all_genes} genes, '
+               f'{n_all_genes - n_kept} genes are excluded from DGE model fitting.')
+
+    return keep, message
+
+
+def filter_low_counts(count_matrix, min_total_counts=PREFILTER_MIN_TOTAL_COUNTS, min_cpm=PREFILTER_MIN_CPM,
+                      min_samples=PREFILTER_MIN_SAMPLES):
+    '''
+    Removes genes with too few counts before model fitting. Such genes would get full dispersion
+    and GLM fits only to be discarded later by the independent filtering.
+
+    Returns:
+        filtered count matrix (genes x samples)
+        message: how many genes were kept
+
+    '''
+    keep, message = low_count_mask(count_matrix, min_total_counts=min_total_counts, min_cpm=min_cpm,
+                                   min_samples=min_samples)
+    return select_genes(count_matrix, keep), message
@@ -1,11 +1,66 @@
+import logging
+import re
 from .dge import *
+from .filtering import filter_low_counts, resolve_min_samples
+from config.config import PREFILTER_MIN_TOTAL_COUNTS, PREFILTER_MIN_CPM, PREFILTER_MIN_SAMPLES
+from storage.dataset_cache import get_frame, put_frame
+from storage.run_store import new_run, finish_run, fail_run
+from storage.writer import write_frame, flush, finish_run_when_written
+from eda_pipeline.main import preprocess
+from eda_pipeline.parsing import read_count_file, read_design_file
+from monitoring import span, payload_size
 
+logger = logging.getLogger(__name__)
 
 
-def main(count_matrix, design_matrix, contrast=None, output_name="dge_results.csv", design_formula=None):
+
+def contrast_frame_name(output_name, contrast):
+    slug = re.sub(r"[^A-Za-z0-9_.-]+", "_", f"{contrast[0]}_{contrast[1]}_vs_{contrast[2]}")
+    return f"{output_name}_{slug}"
+
+
+def main_contrasts(count_matrix, design_matrix, contrasts=None, output_name="dge_results", design_formula=None,
+                   progress=None, min_total_counts=PREFILTER_MIN_TOTAL_COUNTS, min_cpm=PREFILTER_MIN_CPM,
+                   min_samples=PREFILTER_MIN_SAMPLES, run_id=None, n_cpus=N_CPUS):
+    '''
+    Runs the DGE analysis for several contrasts with a single model fit.
+
+    Args:
+        count_matrix: genes x samples count matrix
+        design_matrix: design matrix
+        contrasts: list of contrasts like [variable, level_1, level_2]. Automatic contrast if None.
+        output_name: result name in the run store, with several contrasts the contrast is appended to it
+        design_formula: optional design formula
+        progress: optional callback progress(stage, fraction)
+        min_total_counts, min_cpm, min_samples: low-count pre-filter (see filter_low_counts).
+            min_samples defaults to the smallest group of the first contrast variable.
+        run_id: run the results are saved in (storage.run_store.new_run), a new run if None.
+            The results are written in the background (see storage.writer).
+        n_cpus: number of CPUs used by PyDESeq2
+
+    Returns:
+        dictionary contrast label -> cleaned result or None on error
+        info_messages: status and error messages
+
+    '''
+    info_messages = []
     try:
-        print(" Preparing data...")
-        count_matrix_t, design_matrix_prepped = prepare_dge_data(count_matrix, design_matrix)
+        # Low-count pre-filter, one vectorised pass before the matrix is transposed for PyDESeq2
+        report_progress(progress, "Filtering low-count genes", 0.0)
+        group_column = contrasts[0][0] if contrasts else design_matrix.columns[0]
+        min_samples = resolve_min_samples(count_matrix, design_matrix, group_column, min_cpm=min_cpm,
+                                          min_samples=min_samples)
+        with span("dge.filter", data_in=count_matrix) as stage:
+            count_matrix, message_filter = filter_low_counts(count_matrix, min_total_counts=min_total_counts,
+                                                             min_cpm=min_cpm, min_samples=min_samples)
+            stage.payload_out = payload_size(count_matrix)
+        info_messages.append(message_filter)
+        logger.info(message_filter)
+
+        report_progress(progress, "Preparing data", 0.05)
+        with span("dge.prepare", data_in=count_matrix) as stage:
+            count_matrix_t, design_matrix_prepped = prepare_dge_data(count_matrix, design_matrix)
+            stage.payload_out = payload_size(count_matrix_t)
         if count_matrix_t is None or design_matrix_prepped is None:
             raise ValueError(" Data preparation failed.")
 
@@ -16,38 +71,143 @@ def main(count_matrix, design_matrix, contrast=None, output_name="dge_results.cs
         # Auto-generate design formula if not provided
         if design_formula is None:
             design_formula = "~ " + " + ".join(design_matrix_prepped.columns)
-            print(f"Auto design formula: {design_formula}")
+            logger.info("Auto design formula: %s", design_formula)
 
-        if contrast is None:
+        if not contrasts:
             main_var = design_matrix_prepped.columns[0]
             levels = design_matrix_prepped[main_var].cat.categories.tolist()
             if len(levels) == 2:
-                contrast = [main_var, levels[1], levels[0]]
-                print(f"Auto contrast: {contrast[1]} vs {contrast[2]} on '{main_var}'")
+                contrasts = [[main_var, levels[1], levels[0]]]
+                logger.info("Auto contrast: %s vs %s on '%s'", levels[1], levels[0], main_var)
             else:
                 raise ValueError(f"Multiple levels found in '{main_var}': {levels}. Please specify contrast explicitly.")
 
-        # DGE analysis
-        print(" Running PyDESeq2...")
-        dge_result = run_pydeseq2(count_matrix_t, design_matrix_prepped, contrast, design_formula=design_formula)
-        if dge_result is None:
+        # DGE analysis, the model is fitted once for all contrasts
+        logger.info("Running PyDESeq2 (%d contrast(s))...", len(contrasts))
+        dge_results = run_pydeseq2_contrasts(count_matrix_t, design_matrix_prepped, contrasts,
+                                             design_formula=design_formula, progress=progress, n_cpus=n_cpus)
+        if dge_results is None:
             raise ValueError(" PyDESeq2 failed.")
 
         # Cleaning
-        print(" Cleaning results...")
-        dge_result_clean = clean_dge_df(dge_result)
-        if dge_result_clean is None or dge_result_clean.empty:
-            raise ValueError(" DGE result is empty after cleaning.")
+        report_progress(progress, "Cleaning results", 0.9)
+        dge_results_clean = {}
+        with span("dge.clean", data_in=dge_results) as stage:
+            for label, dge_result in dge_results.items():
+                dge_result_clean = clean_dge_df(dge_result)
+                if dge_result_clean is None or dge_result_clean.empty:
+                    raise ValueError(f" DGE result is empty after cleaning ({label}).")
+                dge_results_clean[label] = dge_result_clean
+            stage.payload_out = payload_size(dge_results_clean)
 
-        # Saving
-        print(" Saving results...")
-        save_csv_file(dge_result_clean, output_name)
+        # Saving, one run directory per analysis
+        report_progress(progress, "Saving results", 0.95)
+        try:
+            # only queues the frames, the writer threads persist them (see storage.writer)
+            with span("dge.save", data_in=dge_results_clean):
+                run_id = run_id or new_run("dge", {"contrasts": contrasts, "design_formula": design_formula,
+                                                   "min_total_counts": min_total_counts, "min_cpm": min_cpm,
+                                                   "min_samples": min_samples})
+                for contrast in contrasts:
+                    name = output_name if len(contrasts) == 1 else contrast_frame_name(output_name, contrast)
+                    write_frame(run_id, name, dge_results_clean[contrast_label(contrast)])
+            info_messages.append(f"Results are saved to run '{run_id}'.")
+        except Exception as e:
+            logger.exception("[main] Results could not be saved: %s", e)
+            info_messages.append(f"Error: Results could not be saved: {e}")
 
-        print(" DGE analysis complete.")
-        return dge_result_clean
+        logger.info("DGE analysis complete.")
+        return dge_results_clean, info_messages
 
+    except JobCancelled:
+        raise
     except Exception as e:
-        print(f"[main] Error: {e}")
+        logger.exception("[main] Error: %s", e)
+        info_messages.append(f"Error: {str(e).strip()}")
+        return None, info_messages
+
+
+def main(count_matrix, design_matrix, contrast=None, output_name="dge_results", design_formula=None, progress=None):
+    dge_results, _ = main_contrasts(count_matrix, design_matrix, [contrast] if contrast is not None else None,
+                                    output_name=output_name, design_formula=design_formula, progress=progress)
+    if dge_results is None:
         return None
+    return next(iter(dge_results.values()))
+
+
+def run_dge_job(counts_key, design_key, contrasts=None, progress=None, **prefilter):
+    '''
+    Background job entry point (see jobs.manager.submit). Loads the processed matrices from the
+    dataset cache, runs the DGE analysis for all contrasts and stores the cleaned results.
+
+    Returns:
+        dictionary with 'results' (contrast label -> dataset cache key of the cleaned DGE result),
+        'messages' (info messages of the run) and 'run' (run store id, the results may still be written,
+        the run is finished once they are)
+    '''
+    count_matrix = get_frame(counts_key)
+    design_matrix = get_frame(design_key)
+    if count_matrix is None or design_matrix is None:
+        raise ValueError("Processed data is no longer available on the server. Please run EDA again.")
 
+    run_id = new_run("dge", {"contrasts": contrasts, **prefilter})
+    try:
+        dge_results, info_messages = main_contrasts(count_matrix, design_matrix.copy(), contrasts=contrasts,
+                                                    progress=progress, run_id=run_id, **prefilter)
+        if dge_results is None:
+            raise ValueError(" ".join(["DGE analysis failed."] + info_messages[-1:]))
+    except JobCancelled:
+        fail_run(run_id, "The job was cancelled.")
+        raise
+    except Exception as e:
+        fail_run(run_id, e)
+        raise
+    finish_run_when_written(run_id, messages=info_messages)
+
+    return {
+        "results": {label: put_frame(dge_result) for label, dge_result in dge_results.items()},
+        "messages": info_messages,
+        "run": run_id,
+    }
+
+
+def run_dge_batch_job(job, n_cpus=N_CPUS):
+    '''
+    Batch job entry point (see jobs.batch.run_batch and `python -m dge_pipeline`). The count matrix is
+    cleaned like in the EDA before the DGE analysis.
+
+    Args:
+        job: dictionary with 'counts' and 'design' file paths, 'gene_column', 'output', the contrasts
+            ('contrasts' list of [variable, level_1, level_2] or 'all_pairwise' variable) and optionally
+            the pre-filter settings 'min_total_counts', 'min_cpm', 'min_samples'
+        n_cpus: CPU budget of PyDESeq2
+
+    Returns:
+        info messages of the run
+    '''
+    count_matrix = read_count_file(job["counts"], job.get("gene_column"))
+    design_matrix = read_design_file(job["design"])
+    count_matrix, compatibility, info_messages = preprocess(count_matrix, design_matrix)
+    if not compatibility:
+        raise ValueError(info_messages[-1])
+
+    contrasts = job.get("contrasts")
+    if job.get("all_pairwise"):
+        contrasts = pairwise_contrasts(design_matrix, job["all_pairwise"])
+    prefilter = {key: job[key] for key in ("min_total_counts", "min_cpm", "min_samples") if job.get(key) is not None}
+
+    run_id = new_run("dge", {"counts": job["counts"], "design": job["design"], "gene_column": job.get("gene_column"),
+                             "contrasts": contrasts, **prefilter}, run_id=job["output"])
+    try:
+        dge_results, messages = main_contrasts(count_matrix, design_matrix.copy(), contrasts=contrasts,
+                                               run_id=run_id, n_cpus=n_cpus, **prefilter)
+        info_messages += messages
+        if dge_results is None:
+            raise ValueError(" ".join(["DGE analysis failed."] + info_messages[-1:]))
+    except Exception as e:
+        fail_run(run_id, e)
+        raise
 
+    flush()
+    finish_run(run_id, messages=info_messages)
+    return info_messages
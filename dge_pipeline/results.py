@@ -0,0 +1,174 @@
+import re
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+import numpy as np
+from storage.dataset_cache import get_frame
+
+
+def load_result_frame(result_key):
+    '''
+    Loads a DGE result once per result key and precomputes the columns the plots need,
+    so dashboard callbacks only have to apply thresholds.
+
+    Args:
+        result_key: dataset cache key of the cleaned DGE result
+
+    Returns:
+        result frame with additional '-log10(pvalue)', '-log10(padj)', 'abs_log2FoldChange'
+        and 'Gene Name' columns or None if the result is not available.
+        The frame is shared between callbacks and must not be modified.
+
+    '''
+    if not result_key:
+        return None
+    try:
+        return _prepare_result_frame(result_key)
+    except KeyError:
+        return None
+
+
+@lru_cache(maxsize=8)
+def _prepare_result_frame(result_key):
+    # Missing results raise so that they are not memoized
+    dge_data = get_frame(result_key)
+    if dge_data is None:
+        raise KeyError(result_key)
+
+    df = dge_data.dropna(subset=["log2FoldChange"]).copy()
+    df["-log10(pvalue)"] = -np.log10(df["pvalue"])
+    df["-log10(padj)"] = -np.log10(df["padj"])
+    df["abs_log2FoldChange"] = df["log2FoldChange"].abs()
+    df["Gene Name"] = df.index
+    return df
+
+
+TABLE_COLUMNS = ["baseMean", "log2FoldChange", "lfcSE", "stat", "pvalue", "padj"]
+RANGE_COLUMNS = ["padj", "log2FoldChange", "baseMean"]
+SEARCH_CACHE_SIZE = 32
+
+
+class ResultTable:
+    '''
+    Precomputed sort orders and gene name index of one DGE result, so a table page is answered with
+    a few vectorised passes over position arrays instead of filtering and sorting the frame.
+
+    Sort orders: ascending and descending positions per column (NaN last in both).
+    Range filters: binary search in the sorted values, the matching positions are one slice of the order.
+    Gene search: the lower-case gene names are joined into one string, a substring is found with a single
+    regex scan and its matches are mapped back to rows by their offsets.
+    '''
+
+    def __init__(self, df):
+        self.genes = df.index.astype(str).to_numpy(dtype=object)
+        self.columns = [column for column in TABLE_COLUMNS if column in df.columns]
+        self.values = {column: df[column].to_numpy(dtype=np.float64) for column in self.columns}
+
+        self.orders, self.sorted_values, self.n_valid = {}, {}, {}
+        for column, values in self.values.items():
+            order = np.argsort(values, kind="stable")
+            n_valid = int(np.count_nonzero(~np.isnan(values)))
+            self.orders[column] = (order, np.concatenate([order[:n_valid][::-1], order[n_valid:]]))
+            self.sorted_values[column] = values[order]
+            self.n_valid[column] = n_valid
+        gene_order = np.argsort(self.genes, kind="stable")
+        self.orders["Gene"] = (gene_order, gene_order[::-1])
+
+        names = [gene.lower() for gene in self.genes]
+        self._names = "\n".join(names)
+        self._offsets = np.cumsum([0] + [len(name) + 1 for name in names[:-1]])
+        self._searches = OrderedDict()  # recent gene searches, shared by concurrent callbacks
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.genes)
+
+    def search(self, text):
+        '''
+        Returns:
+            sorted positions of the genes containing text (case-insensitive)
+        '''
+        text = text.lower()
+        with self._lock:
+            if text in self._searches:
+                self._searches.move_to_end(text)
+                return self._searches[text]
+
+        starts = np.fromiter((match.start() for match in re.finditer(re.escape(text), self._names)), dtype=np.int64)
+        positions = np.unique(np.searchsorted(self._offsets, starts, side="right") - 1)
+        with self._lock:
+            self._searches[text] = positions
+            if len(self._searches) > SEARCH_CACHE_SIZE:
+                self._searches.popitem(last=False)
+        return positions
+
+    def range_positions(self, column, low=None, high=None):
+        '''
+        Returns:
+            positions with low <= value <= high (bounds None are open, NaN never matches)
+        '''
+        sorted_values = self.sorted_values[column]
+        start = 0 if low is None else np.searchsorted(sorted_values, low, side="left")
+        stop = self.n_valid[column] if high is None else np.searchsorted(sorted_values, high, side="right")
+        return self.orders[column][0][start:max(start, stop)]
+
+    def query(self, search=None, ranges=None, sort_column="padj", descending=False, page=0, page_size=25):
+        '''
+        Args:
+            search: gene name substring
+            ranges: dictionary column -> (low, high), see range_positions
+            sort_column: 'Gene' or one of TABLE_COLUMNS
+            descending: sort direction
+            page, page_size: requested page, clamped to the last page
+
+        Returns:
+            rows of the page (list of records), page actually returned, number of matching genes
+        '''
+        mask = None
+
+        def restrict(positions):
+            nonlocal mask
+            selected = np.zeros(len(self), dtype=bool)
+            selected[positions] = True
+            mask = selected if mask is None else mask & selected
+
+        if search:
+            restrict(self.search(search))
+        for column, (low, high) in (ranges or {}).items():
+            if column in self.sorted_values and (low is not None or high is not None):
+                restrict(self.range_positions(column, low, high))
+
+        order = self.orders.get(sort_column, self.orders["Gene"])[1 if descending else 0]
+        if mask is not None:
+            order = order[mask[order]]
+
+        n_matching = len(order)
+        page = max(0, min(page, (n_matching - 1) // page_size)) if n_matching else 0
+        positions = order[page * page_size:(page + 1) * page_size]
+
+        rows = [{"Gene": gene} for gene in self.genes[positions]]
+        for column in self.columns:
+            for row, value in zip(rows, self.values[column][positions].tolist()):
+                row[column] = None if value != value else value  # NaN is not valid JSON
+        return rows, page, n_matching
+
+
+def load_result_table(result_key):
+    '''
+    Returns:
+        ResultTable of the DGE result, built once per result key, or None if the result is not available
+    '''
+    if not result_key:
+        return None
+    try:
+        return _build_result_table(result_key)
+    except KeyError:
+        return None
+
+
+@lru_cache(maxsize=8)
+def _build_result_table(result_key):
+    dge_data = get_frame(result_key)
+    if dge_data is None:
+        raise KeyError(result_key)
+    return ResultTable(dge_data)
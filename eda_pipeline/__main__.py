@@ -0,0 +1,25 @@
+'''
+Batch EDA without the dashboard, e.g.
+
+    python -m eda_pipeline --counts counts.tsv.gz --design design.csv --gene-column gene_id --contrast-column condition
+    python -m eda_pipeline --manifest jobs.json --workers 4 --cpus-per-job 2
+'''
+from jobs.batch import batch_argument_parser, load_jobs, run_batch
+
+
+def main():
+    parser = batch_argument_parser("Exploratory data analysis of one or many count / design matrix pairs.")
+    parser.add_argument("--contrast-column", help="design column the samples are grouped by")
+    args = parser.parse_args()
+
+    # Imported here: the pool workers limit their thread pools before the analysis modules are loaded
+    from eda_pipeline.main import run_eda_job
+
+    jobs = load_jobs(args, ["contrast_column"])
+    summaries = run_batch(run_eda_job, jobs, workers=args.workers, cpus_per_job=args.cpus_per_job,
+                          force=args.force, summary_path=args.summary)
+    raise SystemExit(1 if any(s["status"] == "failed" for s in summaries) else 0)
+
+
+if __name__ == "__main__":
+    main()
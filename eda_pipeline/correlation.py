@@ -0,0 +1,125 @@
+import numpy as np
+import pandas as pd
+from config.config import CORRELATION_METHOD
+from .normalisation import NormalizedCounts, is_sparse, sparse_values
+
+
+def rank_columns(values):
+    '''
+    Average ranks of every column (ties get the mean of their ranks), vectorised over all samples.
+
+    Args:
+        values: 2D array (genes x samples)
+
+    Returns:
+        float64 array of ranks with the shape of values
+    '''
+    from scipy.stats import rankdata
+    return rankdata(values, method='average', axis=0)
+
+
+def correlation_values(values, dtype=np.float32):
+    '''
+    Pearson correlation of the columns of values. The columns are standardised once and
+    the correlation matrix is a single BLAS matrix product.
+
+    Args:
+        values: 2D array (genes x samples), not modified
+        dtype: float type of the product, float32 halves memory and doubles GEMM throughput
+
+    Returns:
+        samples x samples float64 array, NaN for constant columns (like pandas)
+    '''
+    standardised = np.array(values, dtype=dtype, copy=True)
+    standardised -= standardised.mean(axis=0, dtype=np.float64).astype(dtype)
+    norms = np.sqrt(np.einsum('ij,ij->j', standardised, standardised, dtype=np.float64))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        standardised /= norms.astype(dtype)
+
+    corr = (standardised.T @ standardised).astype(np.float64)
+    np.clip(corr, -1.0, 1.0, out=corr)
+    np.fill_diagonal(corr, np.where(norms > 0, 1.0, np.nan))
+    return corr
+
+
+def sparse_correlation_values(values):
+    '''
+    Pearson correlation of the columns of a sparse matrix from its Gram matrix, without densifying it:
+    cov = X'X / n - mean mean'.
+
+    Args:
+        values: scipy sparse matrix (genes x samples)
+
+    Returns:
+        samples x samples float64 array, NaN for constant columns
+    '''
+    values = values.astype(np.float64)
+    n_genes = values.shape[0]
+    means = np.asarray(values.sum(axis=0)).ravel() / n_genes
+    covariance = (values.T @ values).toarray() / n_genes - np.outer(means, means)
+    stds = np.sqrt(np.clip(np.diag(covariance), 0.0, None))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corr = covariance / np.outer(stds, stds)
+    np.clip(corr, -1.0, 1.0, out=corr)
+    np.fill_diagonal(corr, np.where(stds > 0, 1.0, np.nan))
+    return corr
+
+
+def clustered_order(corr):
+    '''
+    Sample order of an average linkage hierarchical clustering on the distance 1 - correlation,
+    so that similar samples are next to each other in the heatmap.
+
+    Args:
+        corr: samples x samples correlation array
+
+    Returns:
+        list of positions
+    '''
+    n_samples = corr.shape[0]
+    if n_samples < 3:
+        return list(range(n_samples))
+
+    from scipy.cluster.hierarchy import linkage, leaves_list
+    from scipy.spatial.distance import squareform
+
+    distances = 1.0 - np.nan_to_num(corr, nan=0.0)
+    distances = (distances + distances.T) / 2
+    np.fill_diagonal(distances, 0.0)
+    np.clip(distances, 0.0, 2.0, out=distances)
+    tree = linkage(squareform(distances, checks=False), method='average')
+    return leaves_list(tree).tolist()
+
+
+def sample_correlation(data, method=CORRELATION_METHOD, dtype=np.float32):
+    '''
+    Sample-wise correlation of log-CPM normalised expression.
+
+    Args:
+        data: count matrix unnormalised or NormalizedCounts shared with the other stages
+        method: 'pearson' or 'spearman' (Pearson correlation of the per-sample ranks)
+        dtype: float type of the matrix product
+
+    Returns:
+        samples x samples correlation frame. The hierarchical clustering order of the samples is stored in
+        result.attrs['cluster_order'].
+    '''
+    if method not in ('pearson', 'spearman'):
+        raise ValueError(f"Unknown correlation method '{method}', expected 'pearson' or 'spearman'.")
+
+    normalized = data if isinstance(data, NormalizedCounts) else NormalizedCounts(data)
+    log_cpm_data = normalized.log_cpm
+
+    if is_sparse(log_cpm_data) and method == 'pearson':
+        corr = sparse_correlation_values(sparse_values(log_cpm_data))
+    else:
+        # ranking needs the dense matrix
+        values = log_cpm_data.sparse.to_dense().to_numpy() if is_sparse(log_cpm_data) else log_cpm_data.to_numpy()
+        if method == 'spearman':
+            values = rank_columns(values)
+        corr = correlation_values(values, dtype=dtype)
+
+    result = pd.DataFrame(corr, index=log_cpm_data.columns, columns=log_cpm_data.columns)
+    result.attrs['method'] = method
+    result.attrs['cluster_order'] = [log_cpm_data.columns[i] for i in clustered_order(corr)]
+    return result
@@ -1,9 +1,9 @@
 from dash import html, dcc
-import plotly.express as px
 
 PLOT_STYLE = {'maxWidth': '800px', 'margin': '0 auto', 'paddingBottom': '30px'}
 
 def eda_dashboard_layout(lib_df, pca_result, umap_result, corr_matrix, info_messages):
+    import plotly.express as px  # imported on first use (see startup.py)
 
     info_div = html.Div([
         html.H4("Info and Status Messages:"),
@@ -19,15 +19,22 @@ def eda_dashboard_layout(lib_df, pca_result, umap_result, corr_matrix, info_mess
         layout = html.Div([info_div], style={'padding': '20px'})
         return layout
 
-    # Correlation Heatmap
+    # Correlation Heatmap, samples in hierarchical clustering order
+    order = corr_matrix.attrs.get('cluster_order', list(corr_matrix.columns))
+    method = corr_matrix.attrs.get('method', 'pearson').capitalize()
+    corr_matrix = corr_matrix.loc[order, order]
     corr_fig = px.imshow(
         corr_matrix,
         x=corr_matrix.columns,
         y=corr_matrix.columns,
         color_continuous_scale="Viridis",
-        title="Sample-wise Expression Correlation Heatmap"
+        title=f"Sample-wise Expression Correlation Heatmap ({method}, clustered)"
     )
 
+    # Explained variance of the principal components
+    explained_variance = pca_result.attrs.get('explained_variance_ratio', {})
+    pc_labels = {pc: f"{pc} ({100 * ratio:.1f} %)" for pc, ratio in explained_variance.items()}
+
     # === Layout Components ===
 
     layout = html.Div([
@@ -43,8 +50,14 @@ def eda_dashboard_layout(lib_df, pca_result, umap_result, corr_matrix, info_mess
         html.H2("PCA", style={'textAlign': 'center'}),
         dcc.Graph(figure=px.scatter(
             pca_result, x="PC1", y="PC2", color="condition", hover_name=pca_result.index,
+            labels=pc_labels,
             title="PCA of Samples"
         )),
+        dcc.Graph(figure=px.bar(
+            x=list(explained_variance), y=[100 * ratio for ratio in explained_variance.values()],
+            labels={"x": "Principal Component", "y": "Explained Variance (%)"},
+            title="Explained Variance per Principal Component"
+        )),
 
         html.H2("UMAP", style={'textAlign': 'center'}),
         dcc.Graph(figure=px.scatter(
@@ -1,8 +1,13 @@
+import hashlib
+import warnings
+from collections import OrderedDict
+import numpy as np
 import pandas as pd
-import umap.umap_ as umap
-from sklearn.decomposition import PCA
-from config.config import OUTPUT_PATH
-from .normalisation import log_cpm
+from config.config import PCA_N_TOP_GENES, UMAP_N_PCS, UMAP_KNN_MAX_NEIGHBORS
+from .normalisation import NormalizedCounts, is_sparse, sparse_values, select_genes
+
+KNN_CACHE_SIZE = 16
+_knn_cache = OrderedDict()  # (embedding hash, shape, k) -> (knn_indices, knn_dists)
 
 def check_data_dimensions(data):
     '''
@@ -39,6 +44,8 @@ def clear_not_numerical(data):
     '''
 
     not_numerical_columns = data.select_dtypes(exclude=['number']).columns
+    if not_numerical_columns.empty:
+        return data  # no copy, the matrix may be a memory-mapped view
     clear_data = data.drop(not_numerical_columns, axis=1)
 
     return clear_data
@@ -57,12 +64,11 @@ def clear_nan(data):
 
     '''
 
-    data_copy = data.copy()
-    n_all_genes = data_copy.index.size
-    idx_nan = data_copy.index.notnull()
-    n_of_nan = data_copy.index.isnull().sum()
+    n_all_genes = data.index.size
+    idx_nan = data.index.notnull()
+    n_of_nan = data.index.isnull().sum()
     message = f'From all genes ({n_all_genes}), there are {n_of_nan} not-annotated genes in the data. They are going to be removed.'
-    clear_data = data_copy[idx_nan]
+    clear_data = select_genes(data, idx_nan)
     return clear_data, message
 
 
@@ -81,15 +87,14 @@ def select_unique_genes(data, keep='first'):
 
     '''
 
-    data_copy = data.copy()
-    unique_genes = data_copy.index.unique()
+    unique_genes = data.index.unique()
 
     n_unique_genes = unique_genes.size
-    n_all_genes = data_copy.index.size
+    n_all_genes = data.index.size
 
     message = f'From all annotated ({n_all_genes}), found {n_unique_genes} unique gene labels. Using only {keep} occurrence.'
 
-    deduped_data = data_copy[~data_copy.index.duplicated(keep=keep)]
+    deduped_data = select_genes(data, ~data.index.duplicated(keep=keep))
     return deduped_data, message
 
 
@@ -116,107 +121,206 @@ def check_compatibility(data, design_matrix):
         return True, data, message
 
 def delete_samples(data, samples_names):
-    data_copy = data.copy()
-    data_copy = data_copy.drop(columns=samples_names, errors='ignore')
-    return data_copy
+    return data.drop(columns=samples_names, errors='ignore')
+
+
+def as_normalized(data):
+    if isinstance(data, NormalizedCounts):
+        return data
+    return NormalizedCounts(data)
+
+
+def select_variable_genes(log_cpm_data, n_top_genes=PCA_N_TOP_GENES):
+    '''
+    Selects the most variable genes with one vectorised variance pass.
+
+    Args:
+        log_cpm_data: normalised matrix (genes x samples), dense or sparse
+        n_top_genes: number of genes to keep
 
+    Returns:
+        normalised matrix of the n_top_genes genes with the highest variance, in original order
 
-def perform_pca(data, design_matrix=None):
+    '''
+    if n_top_genes is None or n_top_genes >= log_cpm_data.shape[0]:
+        return log_cpm_data
+
+    if is_sparse(log_cpm_data):
+        # E[x^2] - E[x]^2 over the non-zero entries only
+        values = sparse_values(log_cpm_data).astype(np.float64)
+        n_samples = values.shape[1]
+        means = np.asarray(values.sum(axis=1)).ravel() / n_samples
+        variances = np.asarray(values.multiply(values).sum(axis=1)).ravel() / n_samples - means ** 2
+    else:
+        variances = log_cpm_data.to_numpy().var(axis=1)
+    top_genes = np.sort(np.argpartition(variances, -n_top_genes)[-n_top_genes:])
+    return select_genes(log_cpm_data, top_genes)
+
+
+def perform_pca(data, design_matrix=None, n_components=2, fast=False, n_top_genes=PCA_N_TOP_GENES):
     '''
     Performs PCA dimensionality reduction on log-CPM normalized data.
     Optionally concatenates the result with a design matrix
     Args:
-        data: count matrix unnormalised. Normalisation will be applied later.
+        data: count matrix unnormalised or NormalizedCounts shared with the other stages.
         design_matrix:
+        n_components: number of principal components, limited by the number of samples and genes
+        fast: use only the n_top_genes most variable genes and a randomized solver (large cohorts)
+        n_top_genes: number of genes used in fast mode
 
     Returns:
-        PCA plot
+        PCA plot. The explained variance ratio of the components is stored in
+        result.attrs['explained_variance_ratio'].
 
     '''
 
     # Log normalize the data
-    log_cpm_data = log_cpm(data)
+    log_cpm_data = as_normalized(data).log_cpm
+    if fast:
+        log_cpm_data = select_variable_genes(log_cpm_data, n_top_genes)
+    if is_sparse(log_cpm_data):
+        # only the genes PCA uses are densified
+        log_cpm_data = log_cpm_data.sparse.to_dense()
 
     # Transpose: rows = samples, columns = genes
     log_cpm_transposed = log_cpm_data.T
 
     # Perform PCA
-    pca = PCA(n_components=2)
+    n_components = min(n_components, *log_cpm_transposed.shape)
+    from sklearn.decomposition import PCA  # heavy, imported on first use (see startup.py)
+
+    pca = PCA(n_components=n_components, svd_solver="randomized" if fast else "auto", random_state=42)
     pca_result = pca.fit_transform(log_cpm_transposed)
 
-    pca_df = pd.DataFrame(pca_result, columns=['PC1', 'PC2'], index=log_cpm_transposed.index)
+    columns = [f'PC{i + 1}' for i in range(n_components)]
+    pca_df = pd.DataFrame(pca_result, columns=columns, index=log_cpm_transposed.index)
+
+    pca_df.attrs['explained_variance_ratio'] = dict(zip(columns, pca.explained_variance_ratio_.tolist()))
 
     # Optionally merge with design matrix
-    if design_matrix is not None and not design_matrix.empty:
-        shared_index = design_matrix.index.intersection(pca_df.index)
-        if shared_index.empty:
-            raise ValueError("No shared sample names between PCA result and design matrix.")
-        design_matrix_aligned = design_matrix.loc[shared_index]
-        result = pd.concat([pca_df.loc[shared_index], design_matrix_aligned], axis=1)
-    else:
-        result = pca_df
+    return attach_design(pca_df, design_matrix, "PCA")
+
 
+def attach_design(embedding, design_matrix, name="embedding"):
+    '''
+    Joins the design columns to an embedding (samples x components), only the samples of both are kept.
+
+    Args:
+        embedding: PCA or UMAP result, its attrs are kept
+        design_matrix: design matrix or None to return the embedding unchanged
+        name: embedding name used in the error message
+
+    Returns:
+        embedding with the design columns
+    '''
+    if design_matrix is None or design_matrix.empty:
+        return embedding
+
+    shared_index = design_matrix.index.intersection(embedding.index)
+    if shared_index.empty:
+        raise ValueError(f"No shared sample names between {name} result and design matrix.")
+    result = pd.concat([embedding.loc[shared_index], design_matrix.loc[shared_index]], axis=1)
+    result.attrs = dict(embedding.attrs)
     return result
 
-def perform_umap(data, design_matrix=None):
+def compute_knn(values, n_neighbors):
+    '''
+    Exact k-nearest-neighbour graph of the samples (each sample is its own first neighbour).
+    The graph is computed for UMAP_KNN_MAX_NEIGHBORS neighbours and cached per embedding,
+    so re-embedding with other n_neighbors / min_dist values reuses it.
+
+    Args:
+        values: embedding (samples x components)
+        n_neighbors: number of neighbours to return
+
+    Returns:
+        knn_indices, knn_dists: arrays of shape samples x n_neighbors
+
     '''
-    Performs UMAP dimensionality reduction on log-CPM normalized data.
+    values = np.ascontiguousarray(values, dtype=np.float32)
+    k_max = min(max(n_neighbors, UMAP_KNN_MAX_NEIGHBORS), values.shape[0])
+    key = (hashlib.sha1(values.tobytes()).hexdigest(), values.shape, k_max)
+
+    if key in _knn_cache:
+        _knn_cache.move_to_end(key)
+    else:
+        from sklearn.neighbors import NearestNeighbors
+
+        knn_dists, knn_indices = NearestNeighbors(n_neighbors=k_max).fit(values).kneighbors(values)
+        _knn_cache[key] = (knn_indices.astype(np.int32), knn_dists.astype(np.float32))
+        if len(_knn_cache) > KNN_CACHE_SIZE:
+            _knn_cache.popitem(last=False)
+
+    knn_indices, knn_dists = _knn_cache[key]
+    return knn_indices[:, :n_neighbors], knn_dists[:, :n_neighbors]
+
+
+def perform_umap(data, design_matrix=None, embedding=None, n_pcs=UMAP_N_PCS, n_neighbors=15, min_dist=0.1):
+    '''
+    Performs UMAP dimensionality reduction on the top principal components of log-CPM normalized data.
     Optionally concatenates the result with a design matrix.
 
     Args:
-        data: count matrix unnormalised. Normalisation will be applied later.
+        data: count matrix unnormalised or NormalizedCounts shared with the other stages.
+            Not used if embedding is given.
         design_matrix:
+        embedding: PCA result (perform_pca) to reuse, computed from data if None
+        n_pcs: number of principal components UMAP is fitted on
+        n_neighbors, min_dist: UMAP parameters
 
     Returns:
         UMAP plot
 
     '''
 
-    log_cpm_data = log_cpm(data)
-    log_cpm_transposed = log_cpm_data.T
+    if embedding is None:
+        embedding = perform_pca(data, n_components=n_pcs)
+    pc_columns = [column for column in embedding.columns if str(column).startswith('PC')][:n_pcs]
+    values = embedding[pc_columns].to_numpy(dtype=np.float32)
 
-    # Fit UMAP
-    umap_model = umap.UMAP(n_neighbors=15, min_dist=0.1, random_state=42)
-    umap_result = umap_model.fit_transform(log_cpm_transposed)
+    # Fit UMAP on the cached kNN graph
+    n_neighbors = max(1, min(n_neighbors, values.shape[0] - 1))
+    knn_indices, knn_dists = compute_knn(values, n_neighbors)
+    import umap.umap_ as umap  # heavy (numba), imported on first use (see startup.py)
 
-    umap_df = pd.DataFrame(umap_result, columns=['UMAP1', 'UMAP2'], index=log_cpm_transposed.index)
+    # n_jobs: the fixed random_state runs umap single-threaded anyway
+    umap_model = umap.UMAP(n_neighbors=n_neighbors, min_dist=min_dist, random_state=42, n_jobs=1,
+                           precomputed_knn=(knn_indices, knn_dists))
+    with warnings.catch_warnings():
+        # no search index is passed with the precomputed kNN, it is only needed to transform new data
+        warnings.filterwarnings("ignore", message=r"precomputed_knn\[2\] \(knn_search_index\) is not an NNDescent",
+                                category=UserWarning)
+        umap_result = umap_model.fit_transform(values)
+
+    umap_df = pd.DataFrame(umap_result, columns=['UMAP1', 'UMAP2'], index=embedding.index)
 
     # Merge with design matrix if provided
-    if design_matrix is not None and not design_matrix.empty:
-        shared_index = design_matrix.index.intersection(umap_df.index)
-        if shared_index.empty:
-            raise ValueError("No shared sample names between UMAP result and design matrix.")
-        design_matrix_aligned = design_matrix.loc[shared_index]
-        result = pd.concat([umap_df.loc[shared_index], design_matrix_aligned], axis=1)
-    else:
-        result = umap_df
+    return attach_design(umap_df, design_matrix, "UMAP")
 
-    return result
+
+def warm_up_umap():
+    '''
+    Runs UMAP once on a small random embedding, so numba compiles its kernels (and stores them in
+    NUMBA_CACHE_DIR) before the first user request instead of during it.
+    '''
+    rng = np.random.default_rng(0)
+    embedding = pd.DataFrame(rng.normal(size=(32, 5)), columns=[f'PC{i + 1}' for i in range(5)])
+    perform_umap(None, embedding=embedding, n_neighbors=5)
 
 
 def calculate_library_sizes(count_matrix, design_matrix):
     '''
 
     Args:
-        count_matrix:
+        count_matrix: count matrix or NormalizedCounts shared with the other stages
         design_matrix:
 
     Returns:
 
     '''
-    lib_sizes = count_matrix.sum(axis=0).sort_values(ascending=False)
+    lib_sizes = as_normalized(count_matrix).library_sizes.sort_values(ascending=False)
     lib_df = pd.DataFrame({"Sample": lib_sizes.index, "Library Size": lib_sizes.values}, index=lib_sizes.index)
     lib_df = pd.concat([lib_df, design_matrix], axis=1)
 
     return lib_df
 
-
-def save_csv_file(data, file_name):
-    try:
-        file_path = OUTPUT_PATH / file_name
-        data.to_csv(file_path, sep=',')
-
-    except Exception as e:
-        message = f"[save_csv_file] Error occurred: {str(e)}"
-        print(message)
-        return None
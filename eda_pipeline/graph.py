@@ -0,0 +1,177 @@
+'''
+The EDA as a dependency graph of cached stages.
+
+Every stage result is cached under a key derived from the stage name and the keys of its inputs, so a
+stage only runs again if one of its inputs changed. Frames are kept in the dataset cache (shared by all
+server processes, the preprocessed count matrix memory-mapped), other results in memory. The contrast column only labels the results
+(label_results), changing it reruns none of the stages.
+
+    counts, design -> preprocess -> normalized -> library_sizes
+                                               -> pca -> umap
+                                               -> correlation
+'''
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from monitoring import span, increment, payload_size, PREFIX
+from storage.dataset_cache import get_frame, put_frame
+from config.config import PCA_FAST_MIN_SAMPLES, PCA_N_COMPONENTS
+from .correlation import sample_correlation
+from .eda import perform_pca, perform_umap, calculate_library_sizes, attach_design
+from .normalisation import NormalizedCounts, compact_counts
+
+STAGE_VERSION = 1  # part of every stage key, increase when a stage computes something else
+MEMORY_CACHE_SIZE = 4  # results of in-memory stages kept (e.g. NormalizedCounts of recent datasets)
+
+
+
+class InputUnavailable(Exception):
+    pass
+
+
+_lock = threading.Lock()
+_memory = OrderedDict()  # stage key -> result of the stages stored in memory
+
+
+def _preprocess(count_matrix, design_matrix):
+    # late import, eda_pipeline.main imports this module
+    from .main import preprocess
+
+    count_matrix, compatibility, info_messages = preprocess(count_matrix, design_matrix)
+    # an empty frame stands for no usable count matrix, the cached result is always a frame
+    count_matrix = pd.DataFrame() if count_matrix is None else count_matrix.copy(deep=False)
+    count_matrix.attrs = {"compatibility": bool(compatibility), "info_messages": info_messages}
+    return count_matrix
+
+
+def _normalized(count_matrix):
+    # frames loaded from the parquet cache are dense again
+    return NormalizedCounts(compact_counts(count_matrix), dtype=np.float32)
+
+
+def _pca(count_matrix, normalized):
+    fast = count_matrix.shape[1] >= PCA_FAST_MIN_SAMPLES
+    return perform_pca(normalized, n_components=PCA_N_COMPONENTS, fast=fast)
+
+
+def _umap(pca_result):
+    return perform_umap(None, embedding=pca_result)
+
+
+# stage -> inputs (stages or the input frames 'counts' and 'design'), function of the input results,
+# storage ('cache': frame in the dataset cache, 'mapped': memory-mapped matrix in the dataset cache,
+# 'memory': any object in memory)
+EDA_STAGES = {
+    "preprocess": (("counts", "design"), _preprocess, "mapped"),
+    "normalized": (("preprocess",), _normalized, "memory"),
+    "library_sizes": (("normalized",), lambda normalized: calculate_library_sizes(normalized, None), "cache"),
+    "pca": (("preprocess", "normalized"), _pca, "cache"),
+    "umap": (("pca",), _umap, "cache"),
+    "correlation": (("normalized",), sample_correlation, "cache"),
+}
+EDA_OUTPUTS = ["library_sizes", "pca", "umap", "correlation"]
+
+
+def stage_key(name, input_keys):
+    '''
+    Returns:
+        cache key of a stage result, it changes with the keys of the stage inputs
+    '''
+    hasher = hashlib.sha1(f"eda-stage:{STAGE_VERSION}:{name}".encode("utf-8"))
+    for key in input_keys:
+        hasher.update(b"\0" + str(key).encode("utf-8"))
+    return hasher.hexdigest()[:24]
+
+
+def _cached(key, storage):
+    if storage != "memory":
+        return get_frame(key)
+    with _lock:
+        if key in _memory:
+            _memory.move_to_end(key)
+            return _memory[key]
+    return None
+
+
+def _store(key, result, storage):
+    if storage != "memory":
+        put_frame(result, key=key, mapped=storage == "mapped")
+        return
+    with _lock:
+        _memory[key] = result
+        if len(_memory) > MEMORY_CACHE_SIZE:
+            _memory.popitem(last=False)
+
+
+def run_stages(counts_key, design_key, targets=EDA_OUTPUTS, stop=None):
+    '''
+    Computes the target stages and the stages they depend on, reusing every cached result. The inputs
+    of a cached stage are not loaded.
+
+    Args:
+        counts_key, design_key: dataset cache keys of the uploaded count and design matrix
+        targets: stages to compute
+        stop: optional function stop(name, result) -> True if the stages depending on this result must not run
+
+    Returns:
+        results: dictionary stage -> result of the targets and the stages that had to be loaded
+        keys: dictionary stage -> cache key
+    '''
+    keys = {"counts": counts_key, "design": design_key}
+    results = {}
+    stopped = set()
+
+    def key(name):
+        # keys follow from the input keys alone, no result has to be loaded
+        if name not in keys:
+            keys[name] = stage_key(name, [key(input_name) for input_name in EDA_STAGES[name][0]])
+        return keys[name]
+
+    def resolve(name):
+        if name in results or name in stopped:
+            return
+        if name in ("counts", "design"):
+            results[name] = get_frame(keys[name])
+            if results[name] is None:
+                raise InputUnavailable(f"Input '{name}' is no longer available in the dataset cache.")
+            return
+
+        inputs, compute, storage = EDA_STAGES[name]
+        # a cached result was computed from inputs that did not stop, its inputs are only loaded on a miss
+        result = _cached(key(name), storage)
+        increment(f"{PREFIX}_stage_cache_total", stage=f"eda.{name}", result="miss" if result is None else "hit")
+        if result is None:
+            for input_name in inputs:
+                resolve(input_name)
+                if input_name in stopped:
+                    stopped.add(name)
+                    return
+            input_results = [results[input_name] for input_name in inputs]
+            with span(f"eda.{name}", data_in=input_results) as stage:
+                result = compute(*input_results)
+                stage.payload_out = payload_size(result)
+            _store(keys[name], result, storage)
+        results[name] = result
+        if stop is not None and stop(name, result):
+            stopped.add(name)
+
+    for target in targets:
+        resolve(target)
+    return results, keys
+
+
+def label_results(results, design_matrix, contrast_column):
+    '''
+    Joins the contrast column (as 'condition') to the cached stage results, the only step that depends on it.
+
+    Returns:
+        lib_df, pca_result, umap_result, corr_matrix as shown in the dashboard
+    '''
+    design_matrix_plotting = design_matrix[[contrast_column]].rename(columns={contrast_column: "condition"})
+    lib_df = pd.concat([results["library_sizes"], design_matrix_plotting], axis=1)
+    pca_result = attach_design(results["pca"], design_matrix_plotting, "PCA")
+    umap_result = attach_design(results["umap"], design_matrix_plotting, "UMAP")
+    return lib_df, pca_result, umap_result, results["correlation"]
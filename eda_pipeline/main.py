@@ -1,12 +1,28 @@
+import numpy as np
 from .eda import *
+from .correlation import sample_correlation
+from .normalisation import compact_counts, is_sparse
+from config.config import PCA_FAST_MIN_SAMPLES, PCA_N_COMPONENTS
+from dge_pipeline.filtering import low_count_mask, resolve_min_samples
+from storage.run_store import new_run, finish_run, fail_run, read_manifest, update_parameters
+from storage.writer import write_frame, flush, finish_run_when_written
+from .parsing import read_count_file, read_design_file
+from monitoring import span, payload_size
+from storage.dataset_cache import get_frame
+from .graph import run_stages, label_results, EDA_OUTPUTS, InputUnavailable
 
-def main(count_matrix, design_matrix, contrast_column):
-    info_messages = []
-    # Check if data not empty
-    if count_matrix.empty or design_matrix.empty:
-        info_messages.append('Count or design matrix was provided as an empty dataset. Please check your data before loading.')
-        return count_matrix, design_matrix, None, None, None, None, info_messages
+def preprocess(count_matrix, design_matrix):
+    '''
+    Cleans the count matrix for EDA and DGE: orientation, numerical columns, compact dtypes,
+    annotated and unique genes, samples of the design matrix.
+
+    Returns:
+        count_matrix: cleaned count matrix (genes x samples)
+        compatibility: False if the design matrix contains samples missing in the count matrix
+        info_messages: status messages
 
+    '''
+    info_messages = []
     # Check data dimensions, transform if necessary
     count_matrix = check_data_dimensions(count_matrix)
 
@@ -15,6 +31,12 @@ def main(count_matrix, design_matrix, contrast_column):
     if count_matrix is None:
         info_messages.append("Error: Count matrix contains only non-numerical columns.")
 
+    # Smallest unsigned count type, sparse columns for zero-heavy matrices
+    count_matrix = compact_counts(count_matrix)
+    if is_sparse(count_matrix):
+        info_messages.append(f'Count matrix is zero-heavy, it is held sparse '
+                             f'({count_matrix.sparse.density:.1%} non-zero entries).')
+
     # Clean unannotated genes
     count_matrix, message_nan = clear_nan(count_matrix)
     info_messages.append(message_nan)
@@ -27,31 +49,189 @@ def main(count_matrix, design_matrix, contrast_column):
     compatibility, count_matrix, compatibility_message = check_compatibility(count_matrix, design_matrix)
     info_messages.append(compatibility_message)
 
+    return count_matrix, compatibility, info_messages
+
+
+def filter_report(count_matrix, design_matrix, contrast_column):
+    '''
+    Returns:
+        message how many genes the DGE low-count pre-filter keeps when contrast_column is compared
+    '''
+    min_samples = resolve_min_samples(count_matrix, design_matrix, contrast_column)
+    return low_count_mask(count_matrix, min_samples=min_samples)[1]
+
+
+def main(count_matrix, design_matrix, contrast_column, run_id=None):
+    '''
+    Runs the EDA. The results are persisted in the background (see storage.writer), they are
+    returned as soon as they are computed.
+
+    Args:
+        count_matrix: count matrix
+        design_matrix: design matrix
+        contrast_column: design column the plots are coloured by
+        run_id: run the results are saved in (storage.run_store.new_run), a new run if None
+
+    Returns:
+        count_matrix, design_matrix, lib_df, pca_result, umap_result, corr_matrix, info_messages
+
+    '''
+    info_messages = []
+    # Check if data not empty
+    if count_matrix.empty or design_matrix.empty:
+        info_messages.append('Count or design matrix was provided as an empty dataset. Please check your data before loading.')
+        return count_matrix, design_matrix, None, None, None, None, info_messages
+
+    with span("eda.preprocess", data_in=count_matrix) as stage:
+        count_matrix, compatibility, preprocess_messages = preprocess(count_matrix, design_matrix)
+        stage.payload_out = payload_size(count_matrix)
+    info_messages += preprocess_messages
+
     # If there are samples specified in the design matrix but not in count matrix stop the analysis
     if not compatibility:
         return count_matrix, design_matrix, None, None, None, None, info_messages
     else:
 
+        # Report how many genes the DGE low-count pre-filter will keep
+        info_messages.append(filter_report(count_matrix, design_matrix, contrast_column))
+
         design_matrix_plotting = design_matrix[[contrast_column]].rename(columns={contrast_column: "condition"})
 
         # ============ for visualisation =====================
-        lib_df = calculate_library_sizes(count_matrix, design_matrix_plotting)
-        pca_result = perform_pca(count_matrix, design_matrix_plotting)
-        umap_result = perform_umap(count_matrix, design_matrix_plotting)
-        log_data = log_cpm(count_matrix)
-        corr_matrix = log_data.corr()
-
-        # ============ saving files =====================
-        files_to_save = [
-                (count_matrix, "processed_count_matrix.csv"),
-                (design_matrix, "processed_design_matrix.csv"),
-                (pca_result, "pca_result.csv"),
-                (umap_result, "umap_result.csv")
+        # library sizes and log-CPM are computed once and shared by all plots
+        normalized = NormalizedCounts(count_matrix, dtype=np.float32)
+        with span("eda.library_sizes", data_in=count_matrix) as stage:
+            lib_df = calculate_library_sizes(normalized, design_matrix_plotting)
+            stage.payload_out = payload_size(lib_df)
+        with span("eda.log_cpm", data_in=count_matrix) as stage:
+            stage.payload_out = payload_size(normalized.log_cpm)
+        with span("eda.pca", data_in=normalized.log_cpm) as stage:
+            fast_pca = count_matrix.shape[1] >= PCA_FAST_MIN_SAMPLES
+            pca_result = perform_pca(normalized, design_matrix_plotting, n_components=PCA_N_COMPONENTS, fast=fast_pca)
+            stage.payload_out = payload_size(pca_result)
+        with span("eda.umap", data_in=pca_result) as stage:
+            umap_result = perform_umap(normalized, design_matrix_plotting, embedding=pca_result)
+            stage.payload_out = payload_size(umap_result)
+        with span("eda.correlation", data_in=normalized.log_cpm) as stage:
+            corr_matrix = sample_correlation(normalized)
+            stage.payload_out = payload_size(corr_matrix)
+
+        # ============ saving results =====================
+        frames_to_save = [
+                (count_matrix, "processed_count_matrix"),
+                (design_matrix, "processed_design_matrix"),
+                (pca_result, "pca_result"),
+                (umap_result, "umap_result")
             ]
 
-        for data, file_name in files_to_save:
-            if data is not None:
-                save_csv_file(data, file_name)
+        try:
+            # only queues the frames, the writer threads persist them (see storage.writer)
+            with span("eda.save", data_in=[data for data, _ in frames_to_save]):
+                run_id = run_id or new_run("eda", {"contrast_column": contrast_column})
+                for data, name in frames_to_save:
+                    if data is not None:
+                        write_frame(run_id, name, data)
+            info_messages.append(f"Results are saved to run '{run_id}'.")
+        except Exception as e:
+            info_messages.append(f"Error: Results could not be saved: {e}")
 
         return count_matrix, design_matrix, lib_df, pca_result, umap_result, corr_matrix, info_messages
 
+
+
+def main_incremental(counts_key, design_key, contrast_column, previous_run_id=None):
+    '''
+    Runs the EDA of cached inputs as a dependency graph of cached stages (see eda_pipeline.graph):
+    only stages whose inputs changed are computed, a new contrast column only relabels the results.
+
+    Args:
+        counts_key, design_key: dataset cache keys of the count and design matrix
+        contrast_column: design column the plots are coloured by
+        previous_run_id: run of the previous EDA. If it was computed from the same inputs, the relabelled
+            results are saved to it instead of saving everything to a new run.
+
+    Returns:
+        processed count matrix key (None on error), lib_df, pca_result, umap_result, corr_matrix,
+        info_messages, run_id. Raises InputUnavailable if an input is no longer in the dataset cache.
+
+    '''
+    count_matrix, design_matrix = get_frame(counts_key), get_frame(design_key)
+    if count_matrix is None or design_matrix is None:
+        raise InputUnavailable("Uploaded data is no longer available in the dataset cache.")
+    if count_matrix.empty or design_matrix.empty:
+        message = 'Count or design matrix was provided as an empty dataset. Please check your data before loading.'
+        return None, None, None, None, None, [message], None
+    if not contrast_column or contrast_column not in design_matrix.columns:
+        message = f"Contrast column '{contrast_column or ''}' not found in the design matrix. Please choose one of its columns."
+        return None, None, None, None, None, [message], None
+
+    def incompatible(name, result):
+        return name == "preprocess" and not result.attrs.get("compatibility")
+
+    results, keys = run_stages(counts_key, design_key, targets=["preprocess", *EDA_OUTPUTS], stop=incompatible)
+    preprocessed = results["preprocess"]
+    info_messages = list(preprocessed.attrs.get("info_messages", []))
+    if "pca" not in results:
+        return None, None, None, None, None, info_messages, None
+    # depends on the contrast column, not cached with the preprocess stage
+    info_messages.append(filter_report(preprocessed, design_matrix, contrast_column))
+
+    lib_df, pca_result, umap_result, corr_matrix = label_results(results, design_matrix, contrast_column)
+
+    try:
+        previous = read_manifest(previous_run_id) if previous_run_id else None
+        inputs = {"counts": counts_key, "design": design_key}
+        if previous is not None and all(previous["parameters"].get(name) == key for name, key in inputs.items()):
+            run_id = previous_run_id
+            update_parameters(run_id, contrast_column=contrast_column)
+            frames_to_save = [(pca_result, "pca_result"), (umap_result, "umap_result")]
+        else:
+            run_id = new_run("eda", {**inputs, "contrast_column": contrast_column})
+            frames_to_save = [(preprocessed, "processed_count_matrix"), (design_matrix, "processed_design_matrix"),
+                              (pca_result, "pca_result"), (umap_result, "umap_result")]
+        with span("eda.save", data_in=[data for data, _ in frames_to_save]):
+            for data, name in frames_to_save:
+                write_frame(run_id, name, data)
+        info_messages.append(f"Results are saved to run '{run_id}'.")
+        # a reused run is finished again, its manifest then records the relabelled results
+        finish_run_when_written(run_id, messages=list(info_messages))
+    except Exception as e:
+        run_id = None
+        info_messages.append(f"Error: Results could not be saved: {e}")
+
+    return keys["preprocess"], lib_df, pca_result, umap_result, corr_matrix, info_messages, run_id
+
+
+def run_eda_job(job, n_cpus=None):
+    '''
+    Batch job entry point (see jobs.batch.run_batch and `python -m eda_pipeline`).
+
+    Args:
+        job: dictionary with 'counts' and 'design' file paths, 'gene_column', 'contrast_column' and 'output'
+        n_cpus: CPU budget, applied by the batch runner
+
+    Returns:
+        info messages of the run
+    '''
+    count_matrix = read_count_file(job["counts"], job.get("gene_column"))
+    design_matrix = read_design_file(job["design"])
+    if not job.get("contrast_column") or job["contrast_column"] not in design_matrix.columns:
+        raise ValueError(f"Contrast column '{job.get('contrast_column')}' not found in design matrix.")
+
+    run_id = new_run("eda", {"counts": job["counts"], "design": job["design"], "gene_column": job.get("gene_column"),
+                             "contrast_column": job["contrast_column"]}, run_id=job["output"])
+    try:
+        results = main(count_matrix, design_matrix, job["contrast_column"], run_id=run_id)
+        info_messages = results[-1]
+        if results[2] is None:
+            raise ValueError(" ".join(["EDA failed."] + info_messages[-1:]))
+    except Exception as e:
+        fail_run(run_id, e)
+        raise
+
+    # Correlation matrix and library sizes are only shown in the dashboard, the batch run keeps them too
+    write_frame(run_id, "library_sizes", results[2])
+    write_frame(run_id, "sample_correlation", results[5])
+    flush()
+    finish_run(run_id, messages=info_messages)
+    return info_messages
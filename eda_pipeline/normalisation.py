@@ -1,4 +1,85 @@
+from functools import cached_property
 import numpy as np
+import pandas as pd
+from config.config import SPARSE_MIN_ZERO_FRACTION
+
+UNSIGNED_DTYPES = [np.uint8, np.uint16, np.uint32]
+
+
+def is_sparse(counts_df):
+    """
+    True for count matrices held as sparse columns (see compact_counts)
+    """
+    return len(counts_df.columns) > 0 and all(isinstance(dtype, pd.SparseDtype) for dtype in counts_df.dtypes)
+
+
+def sparse_values(counts_df):
+    """
+    scipy CSC matrix (genes x samples) of a sparse count matrix, only the non-zero entries are copied
+    """
+    return counts_df.sparse.to_coo().tocsc()
+
+
+def select_genes(counts_df, rows):
+    """
+    Row subset of a count matrix. Sparse matrices are sliced as CSR, which keeps their compact dtype
+    (pandas row indexing widens sparse columns to int64).
+
+    Parameters:
+        counts_df (pd.DataFrame): count matrix (genes x samples)
+        rows: boolean mask or positions of the genes to keep
+    """
+    if not is_sparse(counts_df):
+        if isinstance(rows, np.ndarray) and rows.dtype == bool and rows.all():
+            return counts_df  # no copy, the matrix may be a memory-mapped view
+        return counts_df.iloc[rows]
+    values = sparse_values(counts_df).tocsr()[rows]
+    return pd.DataFrame.sparse.from_spmatrix(values, index=counts_df.index[rows], columns=counts_df.columns)
+
+
+def compact_counts(counts_df, min_zero_fraction=SPARSE_MIN_ZERO_FRACTION):
+    """
+    Compact representation of a numerical count matrix. Integral, non-negative counts are stored in
+    the smallest unsigned integer type (at most uint32). Matrices with at least min_zero_fraction zeros
+    are stored as sparse columns, i.e. in CSC layout, and only their non-zero entries are kept.
+
+    Parameters:
+        counts_df (pd.DataFrame): numerical count matrix (genes x samples)
+        min_zero_fraction: fraction of zeros from which the matrix is held sparse, None to stay dense
+
+    Returns:
+        pd.DataFrame: count matrix with the same index and columns
+    """
+    if counts_df.empty or is_sparse(counts_df):
+        return counts_df
+
+    n_zeros, integral, min_value, max_value = 0, True, 0, 0
+    for _, column in counts_df.items():
+        values = column.to_numpy()
+        n_zeros += values.size - np.count_nonzero(values)
+        if integral and np.issubdtype(values.dtype, np.floating):
+            integral = bool(np.isfinite(values).all() and (values == np.floor(values)).all())
+        integral = integral and np.issubdtype(values.dtype, np.number)
+        if integral and values.size:
+            min_value, max_value = min(min_value, values.min()), max(max_value, values.max())
+
+    dtype = None
+    if integral and min_value >= 0:
+        dtype = next((dtype for dtype in UNSIGNED_DTYPES if max_value <= np.iinfo(dtype).max), None)
+
+    sparse = min_zero_fraction is not None and n_zeros >= min_zero_fraction * counts_df.size
+    if not sparse and (dtype is None or all(column_dtype == dtype for column_dtype in counts_df.dtypes)):
+        return counts_df
+
+    columns = {}
+    for position in range(counts_df.shape[1]):
+        values = counts_df.iloc[:, position].to_numpy()
+        if dtype is not None:
+            values = values.astype(dtype, copy=False)
+        columns[position] = pd.arrays.SparseArray(values, fill_value=0) if sparse else values
+    compact_df = pd.DataFrame(columns, index=counts_df.index)
+    compact_df.columns = counts_df.columns
+    return compact_df
 
 def cpm(counts_df):
     """
@@ -22,7 +103,51 @@ def log_cpm(counts_df):
     """
     log(CPM + 1)
     """
-    cpm_data = cpm(counts_df)
-    log_cpm_data = np.log2(cpm_data + 1)
+    return NormalizedCounts(counts_df, dtype=np.float64).log_cpm
+
+
+class NormalizedCounts:
+    """
+    Normalisation of one count matrix, shared by all EDA stages.
+    Library sizes and log(CPM + 1) are computed lazily on first access and then reused.
+    For sparse count matrices log(CPM + 1) stays sparse, as log(0 + 1) = 0.
+
+    Parameters:
+        counts_df (pd.DataFrame): Raw count matrix (genes x samples), dense or sparse (see compact_counts)
+        dtype: float type of the normalised matrix, float32 halves its memory
+    """
+
+    def __init__(self, counts_df, dtype=np.float32):
+        self.counts = counts_df
+        self.dtype = dtype
+
+    @cached_property
+    def sparse(self):
+        return is_sparse(self.counts)
+
+    @cached_property
+    def library_sizes(self):
+        if self.sparse:
+            # summed in uint64, pandas would keep the (possibly overflowing) compact dtype
+            sums = np.asarray(sparse_values(self.counts).sum(axis=0)).ravel()
+            return pd.Series(sums, index=self.counts.columns)
+        return self.counts.sum(axis=0)
+
+    @cached_property
+    def log_cpm(self):
+        if self.sparse:
+            # Only the non-zero entries are scaled and logged
+            values = sparse_values(self.counts).astype(self.dtype)
+            scale = (1e6 / self.library_sizes.to_numpy(dtype=np.float64)).astype(self.dtype)
+            values.data *= np.repeat(scale, np.diff(values.indptr))
+            values.data += 1
+            np.log2(values.data, out=values.data)
+            return pd.DataFrame.sparse.from_spmatrix(values, index=self.counts.index, columns=self.counts.columns)
 
-    return log_cpm_data
+        # One allocation: counts are converted once and scaled / logged in place
+        values = self.counts.to_numpy(dtype=self.dtype, copy=True)
+        scale = 1e6 / self.library_sizes.to_numpy(dtype=np.float64)
+        values *= scale.astype(self.dtype)
+        values += 1
+        np.log2(values, out=values)
+        return pd.DataFrame(values, index=self.counts.index, columns=self.counts.columns)
@@ -0,0 +1,195 @@
+import binascii
+import hashlib
+import io
+import zlib
+import numpy as np
+import pandas as pd
+
+GZIP_MAGIC = b"\x1f\x8b"
+DECODE_CHUNK = 4 * 1024 ** 2  # base64 characters decoded at once, multiple of 4
+SNIFF_BYTES = 1024 ** 2  # decompressed prefix used to detect delimiter, header and column types
+POSSIBLE_DELIMITERS = ['\t', ';', ',', '|', ' ']
+UNSIGNED_DTYPES = [np.uint8, np.uint16, np.uint32, np.uint64]
+
+
+def decode_upload(contents):
+    '''
+    Args:
+        contents: dcc.Upload contents ("data:<type>;base64,<data>")
+
+    Returns:
+        raw file bytes (bytearray), decoded chunk-wise without copying the whole base64 string
+    '''
+    start = contents.index(',') + 1
+    raw = bytearray()
+    for offset in range(start, len(contents), DECODE_CHUNK):
+        raw += binascii.a2b_base64(contents[offset:offset + DECODE_CHUNK])
+    return raw
+
+
+def upload_key(contents, kind):
+    '''
+    Content address of an upload, computed chunk-wise without copying the whole base64 string.
+
+    Args:
+        contents: dcc.Upload contents
+        kind: what the file is parsed as (e.g. 'counts'), the same file parsed differently gets another key
+
+    Returns:
+        short hexadecimal key
+    '''
+    hasher = hashlib.sha1(kind.encode('utf-8'))
+    for offset in range(0, len(contents), DECODE_CHUNK):
+        hasher.update(contents[offset:offset + DECODE_CHUNK].encode('ascii'))
+    return hasher.hexdigest()[:24]
+
+
+def is_gzip(raw):
+    return raw[:2] == GZIP_MAGIC
+
+
+def sniff_prefix(raw, n_bytes=SNIFF_BYTES):
+    '''
+    Returns the first n_bytes of the (decompressed) file, cut after the last complete line.
+    '''
+    if is_gzip(raw):
+        prefix = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(raw, n_bytes)
+    else:
+        prefix = raw[:n_bytes]
+    if len(prefix) == n_bytes and b"\n" in prefix:
+        prefix = prefix[:prefix.rindex(b"\n") + 1]
+    return prefix
+
+
+def identify_file_delimiter(first_line):
+    for delim in POSSIBLE_DELIMITERS:
+        if delim in first_line:
+            return delim
+
+
+def smallest_unsigned_dtype(max_value):
+    for dtype in UNSIGNED_DTYPES:
+        if max_value <= np.iinfo(dtype).max:
+            return dtype
+
+
+def parse_table(raw, **read_csv_kwargs):
+    '''
+    Parses a small delimited file (e.g. the design matrix) from bytes, plain or gzip compressed.
+    '''
+    first_line = sniff_prefix(raw).decode('utf-8').splitlines()[0]
+    delimiter = identify_file_delimiter(first_line)
+    return pd.read_csv(io.BytesIO(raw), delimiter=delimiter, compression='gzip' if is_gzip(raw) else None,
+                       **read_csv_kwargs)
+
+
+def parse_count_matrix(raw, gene_column=None):
+    '''
+    Parses a count matrix from bytes, plain or gzip compressed, with the multithreaded pyarrow CSV reader.
+    The file is streamed (gzip is decompressed on the fly), integer count columns are parsed directly into
+    uint32 and downcast to the smallest unsigned type holding their maximum, so the peak memory stays
+    close to the size of the final matrix.
+
+    Args:
+        raw: file bytes
+        gene_column: name of the gene label column. If given, only this column and the numerical columns
+            are parsed, otherwise all columns are kept.
+
+    Returns:
+        count matrix, the gene column is not set as index here
+
+    '''
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    from pyarrow import csv
+
+    # Sniff delimiter, header and column types from the beginning of the file
+    prefix = sniff_prefix(raw)
+    first_line = prefix.decode('utf-8').splitlines()[0]
+    delimiter = identify_file_delimiter(first_line)
+    sample = pd.read_csv(io.BytesIO(prefix), delimiter=delimiter)
+
+    # pandas conventions: 'Unnamed: i' for empty and 'name.1' for duplicated header fields,
+    # an unnamed first column if the header has one field less than the rows
+    column_names = list(sample.columns)
+    implicit_index = not isinstance(sample.index, pd.RangeIndex)
+    if implicit_index:
+        column_names = [""] + column_names
+        sample = sample.reset_index(names=[""])
+
+    column_types = {}
+    numerical_columns = []
+    for name in column_names:
+        dtype = sample[name].dtype
+        if name == gene_column or not pd.api.types.is_numeric_dtype(dtype):
+            column_types[name] = pa.string()
+            continue
+        numerical_columns.append(name)
+        if pd.api.types.is_integer_dtype(dtype) and sample[name].min() >= 0:
+            column_types[name] = pa.uint32()
+        elif pd.api.types.is_integer_dtype(dtype):
+            column_types[name] = pa.int64()
+        else:
+            column_types[name] = pa.float64()
+
+    if gene_column is not None and gene_column not in column_names:
+        raise KeyError(f"Gene column '{gene_column}' not found in uploaded count matrix.")
+    include_columns = [name for name in column_names
+                       if gene_column is None or name == gene_column or name in numerical_columns]
+
+    def read(types):
+        source = pa.BufferReader(raw)
+        if is_gzip(raw):
+            source = pa.CompressedInputStream(source, "gzip")
+        return csv.read_csv(
+            source,
+            read_options=csv.ReadOptions(column_names=column_names,
+                                         skip_rows=1, use_threads=True),
+            parse_options=csv.ParseOptions(delimiter=delimiter),
+            convert_options=csv.ConvertOptions(column_types=types, include_columns=include_columns),
+        )
+
+    try:
+        table = read(column_types)
+    except pa.ArrowInvalid:
+        # A column does not fit the sniffed type (e.g. decimals or negative values further down),
+        # parse the numerical columns with pyarrow's own type inference instead
+        table = read({name: dtype for name, dtype in column_types.items() if dtype == pa.string()})
+
+    # Downcast integer counts to the smallest unsigned type
+    columns = []
+    for name, column in zip(table.column_names, table.columns):
+        if pa.types.is_integer(column.type) and column.null_count == 0:
+            min_max = pc.min_max(column)
+            min_value, max_value = min_max["min"].as_py(), min_max["max"].as_py()
+            if min_value is not None and min_value >= 0:
+                column = column.cast(pa.from_numpy_dtype(smallest_unsigned_dtype(max_value)))
+        columns.append(column)
+    table = pa.table(columns, names=table.column_names)
+    del columns
+
+    # Arrow buffers are released column by column while the frame is built
+    count_matrix = table.to_pandas(self_destruct=True, split_blocks=True)
+    del table
+    if implicit_index and "" in count_matrix.columns:
+        count_matrix = count_matrix.set_index(count_matrix.columns[0])
+        count_matrix.index.name = None
+    return count_matrix
+
+
+def read_count_file(path, gene_column=None):
+    '''
+    Reads a count matrix file (plain or gzip compressed), the gene column becomes the index.
+    '''
+    with open(path, "rb") as f:
+        raw = f.read()
+    count_matrix = parse_count_matrix(raw, gene_column)
+    if gene_column:
+        count_matrix = count_matrix.set_index(gene_column)
+        count_matrix.index.name = None
+    return count_matrix
+
+
+def read_design_file(path):
+    with open(path, "rb") as f:
+        return parse_table(f.read(), index_col=0)
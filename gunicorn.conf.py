@@ -0,0 +1,53 @@
+'''
+Production server configuration:
+
+    gunicorn -c gunicorn.conf.py wsgi:server
+
+Settings can be changed with the environment variables of config/config.py (DGE_PORT, DGE_WORKERS,
+DGE_THREADS, DGE_CACHE_PATH, ...) or on the gunicorn command line.
+'''
+import os
+import threading
+
+from config.config import SERVER_PORT, SERVER_WORKERS, SERVER_THREADS, SERVER_TIMEOUT
+
+bind = f"0.0.0.0:{SERVER_PORT}"
+workers = SERVER_WORKERS
+threads = SERVER_THREADS  # threads of a worker keep serving polls while one of them runs an EDA
+worker_class = "gthread"
+timeout = SERVER_TIMEOUT
+graceful_timeout = 30
+preload_app = True  # wsgi.py is imported once, the workers are forked from it
+reload = False
+accesslog = "-"
+
+
+def on_starting(server):
+    # metrics of workers of a previous server that were not retired
+    from monitoring import retire_worker_metrics
+    retire_worker_metrics()
+
+
+def post_fork(server, worker):
+    import startup
+    from monitoring import enable_worker_metrics
+
+    enable_worker_metrics()
+    # numba kernels are compiled (or loaded from NUMBA_CACHE_DIR) in the worker, not before the fork
+    threading.Thread(target=startup.warm_up, daemon=True).start()
+
+
+def worker_exit(server, worker):
+    from monitoring import save_worker_metrics
+    from storage.writer import flush
+
+    save_worker_metrics(force=True)
+    flush()
+    # numba kernels run from request threads leave GNU OpenMP threads behind that block the interpreter
+    # shutdown until the master kills the worker, everything is saved at this point
+    os._exit(0)
+
+
+def child_exit(server, worker):
+    from monitoring import retire_worker_metrics
+    retire_worker_metrics(worker.pid)
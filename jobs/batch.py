@@ -0,0 +1,156 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+# Thread pools of the numerical libraries, limited to the CPU budget of a job
+THREAD_ENV_VARIABLES = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "NUMEXPR_NUM_THREADS",
+                        "NUMBA_NUM_THREADS"]
+
+
+def batch_argument_parser(description):
+    '''
+    Command line options shared by `python -m eda_pipeline` and `python -m dge_pipeline`.
+    A single job is described by the options, many jobs by a manifest (JSON list of job objects
+    with the same keys as the options, e.g. {"name": ..., "counts": ..., "design": ...}).
+    '''
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--manifest", help="JSON file listing the jobs, relative paths are resolved against it")
+    parser.add_argument("--counts", help="count matrix file (csv / tsv, optionally gzip compressed)")
+    parser.add_argument("--design", help="design matrix file, first column are the sample names")
+    parser.add_argument("--gene-column", help="column of the count matrix with the gene labels")
+    parser.add_argument("--name", help="job name, by default the count matrix file name")
+    parser.add_argument("--output", help="output directory of the job, by default <results>/batch/<name>")
+    parser.add_argument("--workers", type=int, default=1, help="jobs run in parallel")
+    parser.add_argument("--cpus-per-job", type=int, default=max(1, (os.cpu_count() or 1)), help="CPUs of each job")
+    parser.add_argument("--force", action="store_true", help="run jobs again even if their output is complete")
+    parser.add_argument("--summary", help="summary report file, by default batch_summary.json in the working directory")
+    return parser
+
+
+def load_jobs(args, job_keys):
+    '''
+    Returns:
+        list of job dictionaries from the manifest or the single job described by the options. Jobs
+        sharing a name or an output directory are rejected, they would overwrite each other's results.
+    '''
+    if args.manifest:
+        manifest_path = Path(args.manifest)
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            jobs = json.load(f)
+        if isinstance(jobs, dict):
+            jobs = jobs["jobs"]
+        for job in jobs:
+            for key in ("counts", "design", "output"):
+                if job.get(key):
+                    job[key] = str((manifest_path.parent / job[key]).resolve())
+    else:
+        if not (args.counts and args.design):
+            raise SystemExit("Either --manifest or --counts and --design are required.")
+        jobs = [{key: getattr(args, key) for key in ["counts", "design", "gene_column", "name", "output"] + job_keys}]
+        jobs[0]["counts"], jobs[0]["design"] = str(Path(args.counts).resolve()), str(Path(args.design).resolve())
+
+    from config.config import OUTPUT_PATH
+    for job in jobs:
+        job["name"] = job.get("name") or Path(job["counts"]).name.split(".")[0]
+        job["output"] = str(Path(job.get("output") or OUTPUT_PATH / "batch" / job["name"]).resolve())
+    for key in ("name", "output"):
+        values = [job[key] for job in jobs]
+        duplicates = sorted({value for value in values if values.count(value) > 1})
+        if duplicates:
+            raise SystemExit(f"Jobs must have unique {key}s, duplicated: {', '.join(duplicates)}. "
+                             "Set \"name\" or \"output\" of these jobs in the manifest.")
+    return jobs
+
+
+def _init_worker(n_cpus):
+    # Runs in the worker process before numpy and friends are imported
+    from config.config import NUMBA_CACHE_PATH
+    for variable in THREAD_ENV_VARIABLES:
+        os.environ[variable] = str(n_cpus)
+    os.environ.setdefault("NUMBA_CACHE_DIR", str(NUMBA_CACHE_PATH))  # compiled UMAP kernels are shared
+
+    from monitoring import configure_logging
+    configure_logging()
+
+
+def _run_one(run_job, job, n_cpus):
+    start = time.perf_counter()
+    try:
+        messages = run_job(job, n_cpus)
+        status = "done"
+    except Exception as e:
+        messages = [f"Error: {e}", traceback.format_exc()]
+        status = "failed"
+    finally:
+        # Idle joblib worker pools started by PyDESeq2 would keep the pool worker from exiting
+        if "joblib" in sys.modules:
+            from joblib.externals.loky import get_reusable_executor
+            get_reusable_executor().shutdown(wait=True)
+    return {"name": job["name"], "status": status, "seconds": round(time.perf_counter() - start, 2),
+            "output": job["output"], "messages": messages}
+
+
+def run_batch(run_job, jobs, workers=1, cpus_per_job=1, force=False, summary_path=None):
+    '''
+    Runs jobs across a process pool. Jobs whose output run is complete are skipped unless force is set,
+    so an interrupted batch can simply be started again.
+
+    Args:
+        run_job: importable function run_job(job, n_cpus) returning the job's info messages
+        jobs: list of job dictionaries with at least 'name' and 'output'
+        workers: number of jobs run in parallel
+        cpus_per_job: CPU budget of each job (thread pools and PyDESeq2)
+        force: run completed jobs again
+        summary_path: JSON summary report, by default batch_summary.json
+
+    Returns:
+        list of job summaries ('name', 'status', 'seconds', 'output', 'messages')
+    '''
+    from storage.run_store import is_finished
+
+    summaries = []
+    pending = []
+    for job in jobs:
+        if not force and is_finished(job["output"]):
+            summaries.append({"name": job["name"], "status": "skipped", "seconds": 0.0, "output": job["output"],
+                              "messages": ["Output is complete."]})
+        else:
+            pending.append(job)
+
+    if pending:
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=max(1, workers), mp_context=context,
+                                 initializer=_init_worker, initargs=(cpus_per_job,)) as pool:
+            futures = [pool.submit(_run_one, run_job, job, cpus_per_job) for job in pending]
+            for future in as_completed(futures):
+                summary = future.result()
+                print(f"[{summary['status']}] {summary['name']} ({summary['seconds']} s)")
+                summaries.append(summary)
+
+    order = {job["name"]: i for i, job in enumerate(jobs)}
+    summaries.sort(key=lambda summary: order.get(summary["name"], len(order)))
+
+    summary_path = Path(summary_path or "batch_summary.json")
+    with open(summary_path, "w", encoding="utf-8") as f:
+        json.dump(summaries, f, indent=2)
+
+    print(format_summary(summaries))
+    print(f"Summary report: {summary_path.resolve()}")
+    return summaries
+
+
+def format_summary(summaries):
+    counts = {status: sum(s["status"] == status for s in summaries) for status in ("done", "skipped", "failed")}
+    lines = [f"{'job':<30} {'status':<8} {'seconds':>8}  output"]
+    lines += [f"{s['name']:<30} {s['status']:<8} {s['seconds']:>8.1f}  {s['output']}" for s in summaries]
+    lines.append(f"{len(summaries)} jobs: {counts['done']} done, {counts['skipped']} skipped, {counts['failed']} failed")
+    for s in summaries:
+        if s["status"] == "failed":
+            lines.append(f"{s['name']}: {s['messages'][0]}")
+    return "\n".join(lines)
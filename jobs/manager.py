@@ -0,0 +1,289 @@
+import json
+import logging
+import multiprocessing
+import os
+import pickle
+import signal
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from config.config import JOBS_PATH, JOBS_MAX_CONCURRENT
+
+logger = logging.getLogger(__name__)
+
+# Job states
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+_context = multiprocessing.get_context("spawn")
+_lock = threading.Lock()  # dispatching within this process
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def _status_path(job_id):
+    return JOBS_PATH / job_id / "status.json"
+
+
+def _cancel_path(job_id):
+    # Written by cancel() before the status, it decides the state even if the job process rewrites the status
+    return JOBS_PATH / job_id / "cancelled"
+
+
+def _is_cancelled(job_id):
+    return _cancel_path(job_id).exists()
+
+
+def _job_path(job_id):
+    # pickled (func, args, kwargs), loaded by the job process
+    return JOBS_PATH / job_id / "job.pickle"
+
+
+def _queue_path():
+    # one empty file '<submission time>-<job id>' per queued job, oldest first when sorted
+    return JOBS_PATH / "queue"
+
+
+def _slots_path():
+    # one file per job holding a slot, containing the pid of its process
+    return JOBS_PATH / "slots"
+
+
+def _read_status(job_id):
+    try:
+        with open(_status_path(job_id), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def _write_status(job_id, status):
+    path = _status_path(job_id)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    status["updated"] = time.time()
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(status, f)
+    os.replace(tmp_path, path)  # atomic, pollers never read a partial file
+
+
+def _update_status(job_id, **changes):
+    status = _read_status(job_id) or {"id": job_id}
+    status.update(changes)
+    _write_status(job_id, status)
+    return status
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+@contextmanager
+def _dispatch_lock():
+    # slot accounting, also against other server processes (workers of gunicorn.conf.py)
+    JOBS_PATH.mkdir(parents=True, exist_ok=True)
+    with _lock, open(JOBS_PATH / "dispatch.lock", "w") as lock_file:
+        try:
+            import fcntl
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        except ImportError:
+            pass
+        yield
+
+
+def _slot_pid(job_id):
+    # pid of the job's process once it was started by _dispatch, None before
+    try:
+        return int((_slots_path() / job_id).read_text())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _holds_slot(job_id):
+    # a job holds its slot until it is finished or its process is gone
+    status = _read_status(job_id)
+    pid = _slot_pid(job_id)
+    return bool(status and status["state"] not in FINISHED_STATES and pid and _pid_alive(pid))
+
+
+def _dispatch():
+    '''
+    Starts queued jobs, oldest first, while fewer than JOBS_MAX_CONCURRENT jobs hold a slot. Called on
+    every submission and status poll, so a freed slot is taken by the next request of any server process.
+    '''
+    if not _queue_path().exists() or not any(_queue_path().iterdir()):
+        return
+
+    with _dispatch_lock():
+        _slots_path().mkdir(parents=True, exist_ok=True)
+        n_running = 0
+        for slot in _slots_path().iterdir():
+            if _holds_slot(slot.name):
+                n_running += 1
+                continue
+            status = _read_status(slot.name)
+            if status is not None and status["state"] not in FINISHED_STATES:
+                _update_status(slot.name, state=FAILED, message="The job process exited unexpectedly.")
+            slot.unlink(missing_ok=True)
+
+        for entry in sorted(_queue_path().iterdir()):
+            if n_running >= JOBS_MAX_CONCURRENT:
+                break
+            entry.unlink()
+            job_id = entry.name.split("-", 1)[1]
+            if _is_cancelled(job_id):
+                continue
+            try:
+                process = _context.Process(target=_run_job, args=(job_id,), daemon=False)
+                process.start()
+            except Exception as e:
+                logger.exception("[job %s] Error: %s", job_id, e)
+                _update_status(job_id, state=FAILED, message=f"The job could not be started: {e}")
+                continue
+            (_slots_path() / job_id).write_text(str(process.pid))
+            n_running += 1
+
+
+def _run_job(job_id):
+    '''
+    Entry point of the job process. The job function gets a `progress(stage, fraction)` callback
+    which records the current stage and raises JobCancelled once the job was cancelled.
+    '''
+    if hasattr(os, "setpgrp"):
+        os.setpgrp()  # own process group, cancellation also stops worker processes of the job
+
+    from monitoring import configure_logging
+    configure_logging()
+
+    def progress(stage, fraction=None):
+        if _is_cancelled(job_id):
+            raise JobCancelled()
+        # the state is not rewritten, a concurrent cancel() is never overwritten with RUNNING
+        changes = {"stage": stage}
+        if fraction is not None:
+            changes["progress"] = fraction
+        _update_status(job_id, **changes)
+
+    try:
+        if _is_cancelled(job_id):
+            return
+        with open(_job_path(job_id), "rb") as f:
+            func, args, kwargs = pickle.load(f)
+        _update_status(job_id, state=RUNNING, pid=os.getpid(), started=time.time())
+        result = func(*args, progress=progress, **kwargs)
+        _update_status(job_id, state=DONE, stage="Finished", progress=1.0, result=result)
+    except JobCancelled:
+        pass
+    except Exception as e:
+        logger.exception("[job %s] Error: %s", job_id, e)
+        _update_status(job_id, state=FAILED, message=str(e))
+    finally:
+        # Results queued by the job are written before the process ends, the job is already shown as done
+        try:
+            from storage.writer import flush
+            flush()
+        except Exception as e:
+            logger.exception("[job %s] Error: %s", job_id, e)
+
+        # Stage timings of the job are served by the server processes on /metrics
+        try:
+            from monitoring import save_job_metrics
+            save_job_metrics()
+        except Exception as e:
+            logger.exception("[job %s] Error: %s", job_id, e)
+
+        # Stop idle worker pools (e.g. joblib) started by the job and skip interpreter shutdown,
+        # which would otherwise wait for them
+        sys.stdout.flush()
+        sys.stderr.flush()
+        if hasattr(os, "killpg"):
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            os.killpg(os.getpgrp(), signal.SIGTERM)
+        os._exit(0)
+
+
+def submit(func, *args, **kwargs):
+    '''
+    Runs func(*args, progress=..., **kwargs) in a separate process, so long computations
+    neither block the server nor compete with its callbacks for the GIL.
+    The job state is kept on disk and can be read by any server process. At most JOBS_MAX_CONCURRENT
+    jobs run at a time, further jobs stay queued until a slot is free (see _dispatch).
+
+    Args:
+        func: importable module level function, its return value must be JSON serialisable
+        *args, **kwargs: picklable arguments (prefer dataset cache keys over frames)
+
+    Returns:
+        job id
+
+    '''
+    job_id = uuid.uuid4().hex
+    _write_status(job_id, {"id": job_id, "state": QUEUED, "stage": "Queued", "progress": 0.0,
+                           "result": None, "message": None, "pid": None, "created": time.time()})
+    with open(_job_path(job_id), "wb") as f:
+        pickle.dump((func, args, kwargs), f)
+
+    _queue_path().mkdir(parents=True, exist_ok=True)
+    (_queue_path() / f"{time.time_ns():020d}-{job_id}").touch()
+    _dispatch()
+    return job_id
+
+
+def get_status(job_id):
+    '''
+    Returns:
+        dictionary with 'state', 'stage', 'progress' (0-1), 'result' and 'message' or None for unknown jobs
+    '''
+    multiprocessing.active_children()  # reap finished job processes
+    _dispatch()
+
+    status = _read_status(job_id) if job_id else None
+    if status is None:
+        return None
+
+    if status["state"] != CANCELLED and _is_cancelled(job_id):
+        # the job process updated its status while it was cancelled
+        status = _update_status(job_id, state=CANCELLED, stage="Cancelled", message="The job was cancelled.")
+    elif status["state"] in (QUEUED, RUNNING):
+        # a started job whose process is gone, e.g. it died while importing the job function
+        pid = status.get("pid") or _slot_pid(job_id)
+        if pid and not _pid_alive(pid):
+            status = _update_status(job_id, state=FAILED, message="The job process exited unexpectedly.")
+    return status
+
+
+def cancel(job_id):
+    '''
+    Cancels a queued or running job by terminating its process group, a queued job is never started.
+
+    Returns:
+        True if the job was cancelled, False if it was unknown or already finished
+    '''
+    status = _read_status(job_id) if job_id else None
+    if status is None or status["state"] in FINISHED_STATES:
+        return False
+
+    _cancel_path(job_id).touch()
+    _update_status(job_id, state=CANCELLED, stage="Cancelled", message="The job was cancelled.")
+
+    pid = status.get("pid")
+    if pid:
+        try:
+            if hasattr(os, "killpg"):
+                os.killpg(pid, signal.SIGTERM)
+            else:
+                os.kill(pid, signal.SIGTERM)
+        except (ProcessLookupError, PermissionError):
+            pass
+    return True
@@ -0,0 +1,336 @@
+'''
+Logging, timing spans and Prometheus metrics.
+
+span() times a pipeline stage, instrument_app() times every Dash callback request. Both record latency
+histograms and payload sizes, which are served in the Prometheus text format on /metrics. Job processes
+(jobs.manager) merge their metrics into a file the server processes read when they are scraped, workers of
+the production server (gunicorn.conf.py) save theirs to one file per worker.
+'''
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+from config.config import LOG_LEVEL, METRICS_PATH, METRICS_LATENCY_BUCKETS, METRICS_PAYLOAD_BUCKETS, \
+    METRICS_WORKER_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "dge_app"
+METRIC_HELP = {
+    f"{PREFIX}_stage_seconds": "Duration of pipeline stages.",
+    f"{PREFIX}_stage_payload_bytes": "Size of the data pipeline stages get (in) and return (out).",
+    f"{PREFIX}_callback_seconds": "Duration of Dash callback requests, including (de)serialisation.",
+    f"{PREFIX}_callback_payload_bytes": "Size of Dash callback request (in) and response (out) bodies.",
+    f"{PREFIX}_errors_total": "Pipeline stages and callbacks that failed.",
+    f"{PREFIX}_stage_cache_total": "Cached stage results reused (hit) or computed (miss), see eda_pipeline.graph.",
+    f"{PREFIX}_startup_seconds": "Import and warm-up times of the server start (see startup.py).",
+}
+JOB_METRICS_FILE = "jobs.json"  # metrics of finished processes (jobs and server workers)
+WORKER_METRICS_PATTERN = "worker-*.json"
+
+_lock = threading.Lock()
+_histograms = {}  # (metric, labels) -> [bucket counts, sum, count], labels is a tuple of (name, value) pairs
+_counters = {}  # (metric, labels) -> value
+_worker = {"enabled": False, "saved": 0.0}  # metrics of this server worker are saved to its file
+
+
+def configure_logging(level=LOG_LEVEL):
+    '''
+    Log format of the server, job and batch processes. Pipeline stages log at INFO, callbacks at DEBUG.
+    '''
+    logging.basicConfig(level=level, format="%(asctime)s %(levelname)s [%(processName)s] %(name)s: %(message)s")
+
+
+def _labels(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _buckets(metric):
+    return METRICS_PAYLOAD_BUCKETS if metric.endswith("_bytes") else METRICS_LATENCY_BUCKETS
+
+
+def observe(metric, value, **labels):
+    key = (metric, _labels(labels))
+    buckets = _buckets(metric)
+    with _lock:
+        histogram = _histograms.setdefault(key, [[0] * len(buckets), 0.0, 0])
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                histogram[0][i] += 1
+                break
+        histogram[1] += value
+        histogram[2] += 1
+
+
+def increment(metric, value=1, **labels):
+    key = (metric, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def payload_size(data):
+    '''
+    Returns:
+        approximate size in bytes of frames, arrays, strings and containers of them, None for other objects
+    '''
+    if data is None:
+        return 0
+    if isinstance(data, pd.DataFrame):
+        return int(data.memory_usage(index=True).sum())
+    if isinstance(data, pd.Series):
+        return int(data.memory_usage(index=True))
+    if isinstance(data, np.ndarray):
+        return int(data.nbytes)
+    if isinstance(data, (bytes, bytearray, str)):
+        return len(data)
+    if isinstance(data, (list, tuple)):
+        sizes = [payload_size(item) for item in data]
+        return sum(size for size in sizes if size is not None)
+    if isinstance(data, dict):
+        return payload_size(list(data.values()))
+    return None
+
+
+class Span:
+    def __init__(self, name, kind, payload_in=None):
+        self.name = name
+        self.kind = kind
+        self.payload_in = payload_in
+        self.payload_out = None
+
+
+def record_span(current, seconds, failed=False):
+    observe(f"{PREFIX}_{current.kind}_seconds", seconds, **{current.kind: current.name})
+    for direction, size in (("in", current.payload_in), ("out", current.payload_out)):
+        if size is not None:
+            observe(f"{PREFIX}_{current.kind}_payload_bytes", size, **{current.kind: current.name,
+                                                                       "direction": direction})
+    if failed:
+        increment(f"{PREFIX}_errors_total", kind=current.kind, name=current.name)
+
+    level = logging.INFO if current.kind == "stage" else logging.DEBUG
+    if logger.isEnabledFor(level):
+        logger.log(level, "%s %s: %.3f s%s%s", current.kind, current.name, seconds,
+                   f", in {current.payload_in} B" if current.payload_in is not None else "",
+                   f", out {current.payload_out} B" if current.payload_out is not None else "")
+
+
+@contextmanager
+def span(name, kind="stage", data_in=None):
+    '''
+    Times the block and records its duration and payload sizes, e.g.
+
+        with span("dge.fit", data_in=counts) as s:
+            dds = fit(...)
+            s.payload_out = payload_size(dds.layers)
+
+    Args:
+        name: stage name, used as metric label
+        kind: 'stage' or 'callback'
+        data_in: data the stage gets, its size is recorded (see payload_size)
+    '''
+    current = Span(name, kind, payload_size(data_in) if data_in is not None else None)
+    start = time.perf_counter()
+    failed = False
+    try:
+        yield current
+    except Exception as e:
+        failed = type(e).__name__ != "JobCancelled"  # cancellation is not a failure
+        raise
+    finally:
+        record_span(current, time.perf_counter() - start, failed=failed)
+
+
+def _snapshot():
+    with _lock:
+        return {
+            "histograms": [[metric, list(labels), values[0], values[1], values[2]]
+                           for (metric, labels), values in _histograms.items()],
+            "counters": [[metric, list(labels), value] for (metric, labels), value in _counters.items()],
+        }
+
+
+def _merge(histograms, counters, snapshot):
+    for metric, labels, buckets, total, count in snapshot.get("histograms", []):
+        key = (metric, tuple(tuple(label) for label in labels))
+        if key not in histograms:
+            histograms[key] = [[0] * len(buckets), 0.0, 0]
+        histogram = histograms[key]
+        if len(histogram[0]) == len(buckets):  # bucket bounds changed in between, only sum and count merge
+            histogram[0] = [a + b for a, b in zip(histogram[0], buckets)]
+        histogram[1] += total
+        histogram[2] += count
+    for metric, labels, value in snapshot.get("counters", []):
+        key = (metric, tuple(tuple(label) for label in labels))
+        counters[key] = counters.get(key, 0) + value
+
+
+def _read_snapshot(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _write_snapshot(path, snapshot):
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(snapshot, f)
+    os.replace(tmp_path, path)  # atomic, scrapes never read a partial file
+
+
+def _add_to_finished(snapshots):
+    # merges snapshots into the file of finished processes
+    METRICS_PATH.mkdir(parents=True, exist_ok=True)
+    path = METRICS_PATH / JOB_METRICS_FILE
+    with open(METRICS_PATH / f"{JOB_METRICS_FILE}.lock", "w") as lock_file:
+        try:
+            import fcntl
+            fcntl.flock(lock_file, fcntl.LOCK_EX)  # processes finishing at the same time
+        except ImportError:
+            pass
+        histograms, counters = {}, {}
+        for snapshot in [_read_snapshot(path), *snapshots]:
+            _merge(histograms, counters, snapshot)
+        _write_snapshot(path, {
+            "histograms": [[metric, list(labels), *values] for (metric, labels), values in histograms.items()],
+            "counters": [[metric, list(labels), value] for (metric, labels), value in counters.items()],
+        })
+
+
+def save_job_metrics():
+    '''
+    Merges the metrics of this (job) process into the file shared with the server processes.
+    Called once before the job process exits.
+    '''
+    snapshot = _snapshot()
+    if not snapshot["histograms"] and not snapshot["counters"]:
+        return
+    _add_to_finished([snapshot])
+
+
+def _worker_path(pid=None):
+    return METRICS_PATH / WORKER_METRICS_PATTERN.replace("*", str(pid or os.getpid()))
+
+
+def enable_worker_metrics():
+    '''
+    Called in every worker process of the production server: its metrics are saved to the worker's file
+    (at most every METRICS_WORKER_INTERVAL seconds, see save_worker_metrics), so /metrics of any worker
+    reports the metrics of all of them.
+    '''
+    _worker["enabled"] = True
+
+
+def save_worker_metrics(force=False):
+    if not _worker["enabled"]:
+        return
+    now = time.monotonic()
+    if not force and now - _worker["saved"] < METRICS_WORKER_INTERVAL:
+        return
+    _worker["saved"] = now
+    METRICS_PATH.mkdir(parents=True, exist_ok=True)
+    _write_snapshot(_worker_path(), _snapshot())
+
+
+def retire_worker_metrics(pid=None):
+    '''
+    Moves the metrics of an exited server worker (all worker files if pid is None, e.g. left by a previous
+    server) to the metrics of finished processes, so the counters keep growing after worker restarts.
+    '''
+    paths = [_worker_path(pid)] if pid is not None else list(METRICS_PATH.glob(WORKER_METRICS_PATTERN))
+    paths = [path for path in paths if path.exists()]
+    if not paths:
+        return
+    _add_to_finished([_read_snapshot(path) for path in paths])
+    for path in paths:
+        path.unlink(missing_ok=True)
+
+
+def _format_labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def metrics_text():
+    '''
+    Returns:
+        metrics of this process, of the other server workers, of the finished processes and the startup
+        times in the Prometheus text exposition format
+    '''
+    histograms, counters = {}, {}
+    _merge(histograms, counters, _snapshot())
+    _merge(histograms, counters, _read_snapshot(METRICS_PATH / JOB_METRICS_FILE))
+    if _worker["enabled"]:
+        for path in METRICS_PATH.glob(WORKER_METRICS_PATTERN):
+            if path != _worker_path():
+                _merge(histograms, counters, _read_snapshot(path))
+
+    lines = []
+    for metric in sorted({metric for metric, _ in histograms}):
+        lines += [f"# HELP {metric} {METRIC_HELP.get(metric, metric)}", f"# TYPE {metric} histogram"]
+        bounds = _buckets(metric)
+        for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+            if name != metric:
+                continue
+            cumulative = 0
+            for bound, bucket in zip(bounds, buckets):
+                cumulative += bucket
+                lines.append(f"{metric}_bucket{_format_labels(labels, le=str(bound))} {cumulative}")
+            lines.append(f"{metric}_bucket{_format_labels(labels, le='+Inf')} {count}")
+            lines.append(f"{metric}_sum{_format_labels(labels)} {total:.6f}")
+            lines.append(f"{metric}_count{_format_labels(labels)} {count}")
+
+    for metric in sorted({metric for metric, _ in counters}):
+        lines += [f"# HELP {metric} {METRIC_HELP.get(metric, metric)}", f"# TYPE {metric} counter"]
+        lines += [f"{metric}{_format_labels(labels)} {value:g}"
+                  for (name, labels), value in sorted(counters.items()) if name == metric]
+
+    from startup import STARTUP_TIMES
+    if STARTUP_TIMES:
+        metric = f"{PREFIX}_startup_seconds"
+        lines += [f"# HELP {metric} {METRIC_HELP[metric]}", f"# TYPE {metric} gauge"]
+        lines += [f"{metric}{_format_labels((('step', step),))} {seconds:.6f}" for step, seconds in STARTUP_TIMES.items()]
+    return "\n".join(lines) + "\n"
+
+
+def instrument_app(app):
+    '''
+    Records a callback span for every Dash callback request (named after the callback function,
+    payload sizes are the request and response body sizes) and adds the /metrics route to the Flask server.
+    '''
+    from flask import Response, g, request
+
+    server = app.server
+
+    @server.before_request
+    def start_callback_span():
+        if request.path.endswith("/_dash-update-component"):
+            g.callback_span_start = time.perf_counter()
+
+    @server.after_request
+    def record_callback_span(response):
+        start = g.pop("callback_span_start", None)
+        if start is None:
+            return response
+        body = request.get_json(silent=True) or {}
+        callback = app.callback_map.get(body.get("output"), {}).get("callback")
+        # unknown outputs are not used as label, so requests cannot create arbitrary many series
+        current = Span(getattr(callback, "__name__", "unknown"), "callback", request.content_length or 0)
+        current.payload_out = response.calculate_content_length()
+        record_span(current, time.perf_counter() - start, failed=response.status_code >= 500)
+        save_worker_metrics()
+        return response
+
+    @server.route("/metrics")
+    def metrics():
+        return Response(metrics_text(), mimetype="text/plain; version=0.0.4")
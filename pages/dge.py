@@ -1,11 +1,15 @@
-from dash import html, dcc, callback, Input, Output, State
+from dash import html, dcc, callback, clientside_callback, ClientsideFunction, Input, Output, State
 import dash
-import pandas as pd
-from dge_pipeline.main import main
+from dge_pipeline.main import run_dge_job
+from dge_pipeline.dge import pairwise_contrasts
 from dge_pipeline.dashboard import dge_dashboard_layout, register_gde_callbacks
+from dge_pipeline.export import register_download_route, EXPORT_FORMATS
 from dash_bootstrap_templates import load_figure_template
 import dash_bootstrap_components as dbc
-from io import StringIO
+from jobs.manager import submit, get_status, cancel, QUEUED, RUNNING, DONE, FAILED, CANCELLED
+from storage.dataset_cache import get_frame
+from storage.writer import write_status_message
+from config.config import PREFILTER_MIN_TOTAL_COUNTS, PREFILTER_MIN_CPM
 
 
 load_figure_template('JOURNAL')
@@ -23,6 +27,15 @@ layout = html.Div([
         html.Label("Levels (exactly 2):"),
         dcc.Dropdown(id="contrast-levels", multi=True, placeholder="Choose 2 levels..."),
 
+        dbc.Checkbox(id="all-pairwise", label="Test all pairwise comparisons of the variable", value=False,
+                     style={"marginTop": "10px"}),
+
+        # Low-count pre-filter applied before model fitting
+        html.Label("Minimum total counts per gene:"),
+        dbc.Input(id="prefilter-min-counts", type="number", min=0, step=1, value=PREFILTER_MIN_TOTAL_COUNTS),
+        html.Label("Minimum CPM in the smallest group (optional):"),
+        dbc.Input(id="prefilter-min-cpm", type="number", min=0, step=0.1, value=PREFILTER_MIN_CPM),
+
         html.Div([
             "You will be asked to choose two levels from the contrast column (e.g., 'treatment' vs 'control'). ",
             "The first selected level will be treated as the test condition, and the second as the reference (control). ",
@@ -42,8 +55,24 @@ layout = html.Div([
         "textAlign": "left",
     }),
 
+    # Background job progress
+    html.Div([
+        dbc.Progress(id="dge-progress", value=0, label="", striped=True, animated=True, style={"height": "20px"}),
+        html.Div(id="dge-job-status", style={"marginTop": "5px"}),
+        dbc.Button("Cancel", id="cancel-dge", n_clicks=0, outline=True, color="danger", size="sm", className="mt-2"),
+    ], style={"width": "400px", "margin": "10px auto", "textAlign": "center"}),
+    dcc.Interval(id="dge-job-poll", interval=1000, disabled=True),
+    html.Div(id="dge-save-status", style={"textAlign": "center", "fontSize": "14px", "color": "#555"}),
+    dcc.Interval(id="dge-save-poll", interval=1000, disabled=True),
+
     html.Hr(),
 
+    # Switching between contrasts of one run does not refit the model
+    html.Div([
+        html.Label("Show contrast:"),
+        dcc.Dropdown(id="dge-contrast", clearable=False, placeholder="Run DGE first..."),
+    ], style={"width": "400px", "margin": "0 auto 20px auto", "textAlign": "left"}),
+
     dcc.Loading(
         id="loading-spinner",
         type="circle",
@@ -51,15 +80,30 @@ layout = html.Div([
         fullscreen=False,
     ),
 
+    # Downloads are streamed from the server-side result (see dge_pipeline/export.py)
     html.Div([
-        dbc.Button("Download Results", id="download-button", color="info", className="mt-3"),
-        dcc.Download(id="download-dge")
-    ], style={"textAlign": "center"}),
+        html.Label("Download format:"),
+        dcc.Dropdown(id="download-format", options=list(EXPORT_FORMATS), value="csv.gz", clearable=False),
+        html.Label("Genes:", style={"marginTop": "10px"}),
+        dcc.RadioItems(id="download-rows", options=[
+            {"label": " All genes", "value": "all"},
+            {"label": " Significant at the volcano plot thresholds", "value": "significant"},
+            {"label": " Top genes by padj", "value": "top"},
+        ], value="all"),
+        dbc.Input(id="download-top", type="number", min=1, step=1, value=100, debounce=True),
+        html.Div([
+            html.A(dbc.Button("Download Results", id="download-button", color="info", className="mt-3"),
+                   id="download-link", href=None),
+        ], style={"textAlign": "center"}),
+    ], style={"width": "400px", "margin": "0 auto", "textAlign": "left"}),
 
     # Stores
     dcc.Store(id="new-stored-counts"),
     dcc.Store(id="new-stored-design"),
-    dcc.Store(id="dge-result-store")
+    dcc.Store(id="dge-result-store"),
+    dcc.Store(id="dge-contrast-results"),
+    dcc.Store(id="dge-job"),
+    dcc.Store(id="dge-run")
 ], style={
     "padding": "20px"
 })
@@ -68,10 +112,10 @@ layout = html.Div([
     Output("contrast-variable", "options"),
     Input("new-stored-design", "data")
 )
-def populate_contrast_variable_options(json_data):
-    if not json_data:
+def populate_contrast_variable_options(design_key):
+    design_df = get_frame(design_key)
+    if design_df is None:
         return []
-    design_df = pd.read_json(json_data, orient="split")
     return [{"label": col, "value": col} for col in design_df.columns]
 
 @callback(
@@ -79,53 +123,153 @@ def populate_contrast_variable_options(json_data):
     Input("contrast-variable", "value"),
     Input("new-stored-design", "data")
 )
-def populate_contrast_levels(var, json_data):
-    if not json_data or not var:
+def populate_contrast_levels(var, design_key):
+    df = get_frame(design_key)
+    if df is None or not var:
         return []
-    df = pd.read_json(json_data, orient="split")
     levels = df[var].dropna().unique().tolist()
     return [{"label": lv, "value": lv} for lv in levels]
 
-@callback(
-    Output("download-dge", "data"),
-    Input("download-button", "n_clicks"),
-    State("dge-result-store", "data"),
-    prevent_initial_call=True
+# The download link follows the volcano plot thresholds in the browser, without a round-trip
+clientside_callback(
+    ClientsideFunction(namespace="dge", function_name="download_url"),
+    Output("download-link", "href"),
+    Input("dge-result-store", "data"),
+    Input("download-format", "value"),
+    Input("download-rows", "value"),
+    Input("download-top", "value"),
+    Input("volcano-fc", "value"),
+    Input("volcano-p", "value"),
+    Input("volcano-pval-type", "value"),
 )
-def download_dge_result(n_clicks, dge_data_json):
-    if not dge_data_json:
-        return dash.no_update
-
-    dge_df = pd.read_json(StringIO(dge_data_json), orient="split")
-    return dcc.send_data_frame(dge_df.to_csv, "dge_results.csv", index=False)
 
 
 @callback(
-    Output("dge-layout-container", "children"),
-    Output("dge-result-store", "data"),
+    Output("dge-job", "data"),
+    Output("dge-job-poll", "disabled"),
+    Output("dge-job-status", "children"),
     Input("run-dge", "n_clicks"),
     State("contrast-levels", "value"),
     State("contrast-variable", "value"),
+    State("all-pairwise", "value"),
+    State("prefilter-min-counts", "value"),
+    State("prefilter-min-cpm", "value"),
     State("new-stored-counts", "data"),
     State("new-stored-design", "data"),
+    State("dge-job", "data"),
+    # a double click does not submit twice
+    running=[(Output("run-dge", "disabled"), True, False)],
+    prevent_initial_call=True
+)
+def update_dge_layout(n_clicks, contrast_levels, contrast_variable, all_pairwise, min_total_counts, min_cpm,
+                      counts_key, design_key, current_job_id):
+
+    # one job per session, it competes with the jobs of the other users for the job slots
+    current_job = get_status(current_job_id)
+    if current_job is not None and current_job["state"] in (QUEUED, RUNNING):
+        return dash.no_update, dash.no_update, "A DGE analysis is still running, cancel it to start another one."
+
+    if not (counts_key and design_key):
+        return None, True, "Missing processed data. Please complete EDA first."
+
+    if all_pairwise:
+        design_matrix = get_frame(design_key)
+        if design_matrix is None or not contrast_variable:
+            return None, True, "Please select the contrast variable."
+        contrasts = pairwise_contrasts(design_matrix, contrast_variable)
+        if not contrasts:
+            return None, True, f"'{contrast_variable}' has less than two levels."
+    elif not contrast_levels or len(contrast_levels) != 2:
+        return None, True, "Please select both tested and control conditions."
+    else:
+        contrasts = [[contrast_variable] + contrast_levels]
+
+    # Run analysis as a background job, progress is polled by poll_dge_job
+    job_id = submit(run_dge_job, counts_key, design_key, contrasts=contrasts,
+                    min_total_counts=min_total_counts, min_cpm=min_cpm)
+
+    return job_id, False, "DGE analysis submitted."
+
+
+@callback(
+    Output("dge-layout-container", "children"),
+    Output("dge-contrast-results", "data"),
+    Output("dge-progress", "value"),
+    Output("dge-progress", "label"),
+    Output("dge-job-status", "children", allow_duplicate=True),
+    Output("dge-job-poll", "disabled", allow_duplicate=True),
+    Output("dge-run", "data"),
+    Output("dge-save-poll", "disabled"),
+    Input("dge-job-poll", "n_intervals"),
+    State("dge-job", "data"),
+    prevent_initial_call=True
+)
+def poll_dge_job(n_intervals, job_id):
+    status = get_status(job_id)
+    if status is None:
+        return dash.no_update, dash.no_update, 0, "", "DGE job not found.", True, dash.no_update, dash.no_update
+
+    percent = int(100 * (status.get("progress") or 0))
+
+    if status["state"] == DONE:
+        # Rendered right away, the results are written to the run store in the background
+        result = status["result"]
+        layout = dge_dashboard_layout(result["messages"])
+        return layout, result["results"], 100, "100 %", "DGE analysis complete.", True, result.get("run"), False
+
+    if status["state"] in (FAILED, CANCELLED):
+        return (html.Div(status["message"]), None, percent, f"{percent} %", status["message"], True,
+                dash.no_update, dash.no_update)
+
+    return (dash.no_update, dash.no_update, percent, f"{percent} %", f"{status['stage']}...", False,
+            dash.no_update, dash.no_update)
+
+
+@callback(
+    Output("dge-save-status", "children"),
+    Output("dge-save-poll", "disabled", allow_duplicate=True),
+    Input("dge-save-poll", "n_intervals"),
+    State("dge-run", "data"),
     prevent_initial_call=True
 )
-def update_dge_layout(n_clicks, contrast_levels, contrast_variable, counts_json, design_json):
+def poll_dge_save(n_intervals, run_id):
+    message, finished = write_status_message(run_id)
+    return message, finished
 
-    contrasts = [contrast_variable] + contrast_levels
-    if not (counts_json and design_json):
-        return html.Div("Missing processed data. Please complete EDA first.")
 
-    if not contrast_levels:
-        return html.Div("Please select both tested and control conditions.")
+@callback(
+    Output("dge-job-status", "children", allow_duplicate=True),
+    Input("cancel-dge", "n_clicks"),
+    State("dge-job", "data"),
+    prevent_initial_call=True
+)
+def cancel_dge_job(n_clicks, job_id):
+    if not cancel(job_id):
+        return dash.no_update
+    return "Cancelling DGE analysis..."
 
-    # Load from stored JSON
-    count_matrix = pd.read_json(counts_json, orient="split")
-    design_matrix = pd.read_json(design_json, orient="split")
 
-    # Run analysis
-    dge_df_clear = main(count_matrix, design_matrix, contrast=contrasts)
+@callback(
+    Output("dge-contrast", "options"),
+    Output("dge-contrast", "value"),
+    Input("dge-contrast-results", "data"),
+)
+def populate_contrast_results(contrast_results):
+    if not contrast_results:
+        return [], None
+    labels = list(contrast_results)
+    return [{"label": label, "value": label} for label in labels], labels[0]
+
 
-    return dge_dashboard_layout(), dge_df_clear.to_json(orient="split")
+@callback(
+    Output("dge-result-store", "data"),
+    Input("dge-contrast", "value"),
+    State("dge-contrast-results", "data"),
+)
+def select_contrast_result(label, contrast_results):
+    if not contrast_results or label not in contrast_results:
+        return None
+    return contrast_results[label]
 
 register_gde_callbacks(dash.get_app())
+register_download_route(dash.get_app())
@@ -1,11 +1,11 @@
 from dash import html, dcc, callback, Input, Output, State
 import dash
-import pandas as pd
 from eda_pipeline.dashboard import eda_dashboard_layout
 from dash_bootstrap_templates import load_figure_template
 import dash_bootstrap_components as dbc
-from io import StringIO
-from eda_pipeline.main import main
+from eda_pipeline.main import main_incremental
+from eda_pipeline.graph import InputUnavailable
+from storage.writer import write_status_message
 
 
 load_figure_template('JOURNAL')
@@ -22,6 +22,9 @@ layout = html.Div([
         fullscreen=False,
     ),
 
+    html.Div(id="eda-save-status", style={"fontSize": "14px", "color": "#555"}),
+    dcc.Interval(id="eda-save-poll", interval=1000, disabled=True),
+
     html.Br(),
     dbc.Button("Continue to DGE", href="/dge", color="secondary", outline=True, size="lg", className="mb-3",
                style={"fontSize": "18px"}),
@@ -32,7 +35,8 @@ layout = html.Div([
     dcc.Store(id="stored-design"),
     dcc.Store(id="contrast-column-output"),
     dcc.Store(id="new-stored-counts"),
-    dcc.Store(id="new-stored-design")
+    dcc.Store(id="new-stored-design"),
+    dcc.Store(id="eda-run")
 ], style={
     "maxWidth": "900px",
     "margin": "auto",
@@ -44,35 +48,44 @@ layout = html.Div([
     Output("eda-output", "children"),
     Output("new-stored-counts", "data"),
     Output("new-stored-design", "data"),
+    Output("eda-run", "data"),
+    Output("eda-save-poll", "disabled"),
 
     Input("stored-counts", "data"),
     Input("stored-design", "data"),
     Input("contrast-column-output", "data"),
+    State("eda-run", "data"),
     prevent_initial_call=True
 )
-def update_eda(counts_data, design_data, contrast_column):
-
-    if not counts_data or not design_data:
-        return dash.no_update, dash.no_update, dash.no_update
-
-    # Convert JSON to DataFrames
-    counts_df = pd.read_json(StringIO(counts_data), orient='split')
-    design_df = pd.read_json(StringIO(design_data), orient='split')
-
-    preprocessed_data = main(counts_df, design_df, contrast_column)
-    new_counts_matrix, new_design_matrix = preprocessed_data[0], preprocessed_data[1]
+def update_eda(counts_key, design_key, contrast_column, previous_run_id):
 
-    # Convert back to JSON to store
-    if (new_counts_matrix is None) or (new_design_matrix is None):
-        new_counts_json, new_design_json = None, None
-    else:
-        new_counts_json = new_counts_matrix.to_json(date_format='iso', orient='split')
-        new_design_json = new_design_matrix.to_json(date_format='iso', orient='split')
+    if not counts_key or not design_key:
+        return dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update
 
-    # Run preprocessing and layout configuration
-    layout = eda_dashboard_layout(*preprocessed_data[2:])
+    # Stages are cached by the keys of their inputs (see eda_pipeline.graph), a new contrast column
+    # only relabels the cached results. They are written to the run in the background, their state
+    # is polled by poll_eda_save.
+    try:
+        new_counts_key, *results, run_id = main_incremental(counts_key, design_key, contrast_column,
+                                                             previous_run_id=previous_run_id)
+    except InputUnavailable:
+        message = "Uploaded data is no longer available on the server. Please upload your files again."
+        return eda_dashboard_layout(None, None, None, None, [message]), None, None, None, True
 
-    return layout, new_counts_json, new_design_json
+    # The processed count matrix is a cached stage result, the design matrix is used unchanged
+    new_design_key = design_key if new_counts_key is not None else None
+    layout = eda_dashboard_layout(*results)
 
+    return layout, new_counts_key, new_design_key, run_id, run_id is None
 
 
+@callback(
+    Output("eda-save-status", "children"),
+    Output("eda-save-poll", "disabled", allow_duplicate=True),
+    Input("eda-save-poll", "n_intervals"),
+    State("eda-run", "data"),
+    prevent_initial_call=True
+)
+def poll_eda_save(n_intervals, run_id):
+    message, finished = write_status_message(run_id)
+    return message, finished
@@ -1,9 +1,14 @@
+import logging
 from dash import html, dcc, callback, Output, Input, dash_table
 import dash
-import base64, io
-import pandas as pd
 from dash_bootstrap_templates import load_figure_template
 import dash_bootstrap_components as dbc
+from storage.dataset_cache import get_frame, put_frame
+from eda_pipeline.parsing import decode_upload, upload_key, parse_count_matrix, parse_table
+from eda_pipeline.eda import clear_not_numerical
+from monitoring import span, payload_size
+
+logger = logging.getLogger(__name__)
 
 load_figure_template('JOURNAL')
 
@@ -118,7 +123,7 @@ layout = html.Div([
         html.Div(id="counts-filename"),
         html.Br(),
 
-        dbc.Input(type="text", id="gene-column", placeholder="Enter name of Gene Names or Genes IDs column"),
+        dbc.Input(type="text", id="gene-column", debounce=True, placeholder="Enter name of Gene Names or Genes IDs column"),
         html.Div(id="gene-message"),
         html.Br(),
 
@@ -129,7 +134,7 @@ layout = html.Div([
         html.Div(id="design-filename"),
         html.Br(),
 
-        dbc.Input(type="text", id="contrast-column", placeholder="Enter name of column specifying main contrasts in design matrix"),
+        dbc.Input(type="text", id="contrast-column", debounce=True, placeholder="Enter name of column specifying main contrasts in design matrix"),
         html.Div(id="contrast-message"),
         html.Br(),
 
@@ -148,6 +153,8 @@ layout = html.Div([
     dcc.Store(id="stored-counts"),
     dcc.Store(id="stored-design"),
     dcc.Store(id="contrast-column-output"),
+    dcc.Store(id="raw-counts"),
+    dcc.Store(id="raw-design"),
 ])
 
 
@@ -163,97 +170,129 @@ def display_filenames(counts_filename, design_filename):
     design_text = f"Uploaded: {design_filename}" if design_filename else ""
     return counts_text, design_text
 
-def identify_file_delimiter(first_line):
-    possible_del = ['\t', ';', ',', '|', ' ']
-    for delim in possible_del:
-        if delim in first_line:
-            return delim
-
-# Read count matrix with gene column validation
-def read_count_matrix(contents, gene_column=None):
-    content_type, content_string = contents.split(',')
-    decoded = base64.b64decode(content_string)
-    text = decoded.decode('utf-8')
-    first_line = text.splitlines()[0]
-    delimiter = identify_file_delimiter(first_line)
-
+# Read count matrix, all columns are kept so that the gene column can be chosen later (see store_counts)
+def read_count_matrix(raw):
     try:
-        count_matrix = pd.read_csv(io.StringIO(text), delimiter=delimiter)
+        count_matrix = parse_count_matrix(raw)
     except Exception as e:
-        return None, f"Failed to parse design matrix: {e}"
+        return None, f"Failed to parse count matrix: {e}"
 
     if count_matrix.empty:
         return None, f"The file format may be incorrect or unsupported. Please check the file and try again."
 
-    if gene_column:
-        gene_column = gene_column.strip()
-        if gene_column not in count_matrix.columns:
-            return None, f"Gene column '{gene_column}' not found in uploaded count matrix."
-        try:
-            count_matrix.set_index(gene_column, inplace=True)
-            count_matrix.index.name = None
-        except Exception as e:
-            print(f"Gene column parsing failed: {e}")
-            return None, str(e)
-
     return count_matrix, None
 
 # Read design matrix
-def read_design_matrix(contents, contrast_column):
-    content_type, content_string = contents.split(',')
-    decoded = base64.b64decode(content_string)
-    text = decoded.decode('utf-8')
-    first_line = text.splitlines()[0]
-    delimiter = identify_file_delimiter(first_line)
-
+def read_design_matrix(raw):
     try:
-        design_matrix = pd.read_csv(io.StringIO(text), delimiter=delimiter, index_col=0)
+        design_matrix = parse_table(raw, index_col=0)
     except Exception as e:
         return None, f"Failed to parse design matrix: {e}"
 
     if design_matrix.empty:
         return None, f"The file format may be incorrect or unsupported. Please check the file and try again."
 
-    if contrast_column:
-        contrast_column = contrast_column.strip()
-        if contrast_column not in design_matrix.columns:
-            return None, f"Contrast column '{contrast_column}' not found in design matrix."
-
     return design_matrix, None
 
-# Process uploaded data
+def parse_upload(contents, kind, read_file):
+    '''
+    Parses an uploaded file once. The parsed frame is cached under the content hash of the file,
+    so uploading the same file again or changing the column fields does not parse it again.
+
+    Args:
+        contents: dcc.Upload contents
+        kind: 'counts' or 'design'
+        read_file: read_count_matrix or read_design_matrix
+
+    Returns:
+        dictionary with the cache 'key' and the 'columns' of the parsed frame or with an 'error' message
+    '''
+    key = upload_key(contents, kind)
+    data = get_frame(key)
+    if data is None:
+        with span(f"upload.parse_{kind}", data_in=contents) as stage:
+            data, error_message = read_file(decode_upload(contents))
+            stage.payload_out = payload_size(data)
+        if data is None:
+            return {"error": error_message}
+        put_frame(data, key=key)
+
+    return {"key": key, "columns": list(data.columns)}
+
+# Parse uploaded files, once per file
+@callback(
+    Output("raw-counts", "data"),
+    Input("upload-counts", "contents"),
+    prevent_initial_call=True
+)
+def parse_counts_upload(counts_content):
+    return parse_upload(counts_content, "counts", read_count_matrix) if counts_content else None
+
+@callback(
+    Output("raw-design", "data"),
+    Input("upload-design", "contents"),
+    prevent_initial_call=True
+)
+def parse_design_upload(design_content):
+    return parse_upload(design_content, "design", read_design_matrix) if design_content else None
+
+# Gene column: validated against the parsed header, the cached frame is re-indexed
 @callback(
     Output("stored-counts", "data"),
+    Output("gene-message", "children"),
+
+    Input("raw-counts", "data"),
+    Input("gene-column", "value"),
+    prevent_initial_call=True
+)
+def store_counts(raw_counts, gene_column):
+    if not raw_counts:
+        return None, html.Div()
+    if "error" in raw_counts:
+        return None, html.Div([raw_counts["error"]])
+
+    gene_column = gene_column.strip() if gene_column else None
+    if gene_column and gene_column not in raw_counts["columns"]:
+        return None, html.Div([f"Gene column '{gene_column}' not found in uploaded count matrix."])
+    if not gene_column:
+        return raw_counts["key"], html.Div()
+
+    count_matrix = get_frame(raw_counts["key"])
+    if count_matrix is None:
+        return None, html.Div(["The uploaded file is no longer available on the server. Please upload it again."])
+
+    try:
+        # same projection as parse_count_matrix with a known gene column: gene labels and numerical
+        # columns, annotation columns would keep the matrix from being memory-mapped
+        count_matrix = clear_not_numerical(count_matrix.set_index(gene_column))
+        count_matrix.index.name = None
+    except Exception as e:
+        logger.exception("Gene column parsing failed: %s", e)
+        return None, html.Div([str(e)])
+
+    # Frames stay on the server, the stores only hold the cache keys. The count matrix is memory-mapped,
+    # the stages and sessions using it read zero-copy views of one file.
+    return put_frame(count_matrix, mapped=True), html.Div()
+
+# Contrast column: validated against the parsed header
+@callback(
     Output("stored-design", "data"),
     Output("contrast-column-output", "data"),
-    Output("gene-message", "children"),
     Output("contrast-message", "children"),
 
-    Input("upload-counts", "contents"),
-    Input("upload-design", "contents"),
-    Input("gene-column", "value"),
+    Input("raw-design", "data"),
     Input("contrast-column", "value"),
     prevent_initial_call=True
 )
-def store_files(counts_content, design_content, gene_column, contrast_column):
-    if counts_content:
-        counts_df, error_message = read_count_matrix(counts_content, gene_column)
-        if counts_df is None:
-            return None, None, None, html.Div([error_message]), html.Div()
-    else:
-        counts_df = None
-
-    if design_content:
-        design_df, error_message = read_design_matrix(design_content, contrast_column)
-        if design_df is None:
-            return None, None, None, html.Div(), html.Div([error_message])
-    else:
-        design_df = None
-
-    return (
-        counts_df.to_json(date_format='iso', orient='split') if counts_df is not None else None,
-        design_df.to_json(date_format='iso', orient='split') if design_df is not None else None,
-        contrast_column,
-        html.Div(),
-        html.Div()
-    )
+def store_design(raw_design, contrast_column):
+    if not raw_design:
+        return None, contrast_column, html.Div()
+    if "error" in raw_design:
+        return None, None, html.Div([raw_design["error"]])
+
+    if contrast_column:
+        contrast_column = contrast_column.strip()
+        if contrast_column not in raw_design["columns"]:
+            return None, None, html.Div([f"Contrast column '{contrast_column}' not found in design matrix."])
+
+    return raw_design["key"], contrast_column, html.Div()
@@ -0,0 +1,85 @@
+'''
+Startup helpers: per-module import timing and warm-up of the heavy analysis modules.
+
+The pipelines import umap, sklearn, pydeseq2 / anndata and plotly.express on first use. warm_up()
+imports them ahead of time (in fast-start mode in a background thread once the server is listening)
+and logs how long each import took.
+'''
+import importlib
+import logging
+import socket
+import sys
+import time
+
+# Imported in this order, so each entry reports the cost it adds on top of the previous ones
+HEAVY_MODULES = [
+    "plotly.express",
+    "sklearn.decomposition",
+    "sklearn.neighbors",
+    "umap.umap_",
+    "anndata",
+    "pydeseq2.dds",
+    "pydeseq2.ds",
+]
+
+logger = logging.getLogger(__name__)
+
+STARTUP_TIMES = {}  # step -> seconds
+
+
+def record(step, seconds):
+    STARTUP_TIMES[step] = seconds
+
+
+def timed_import(module_name):
+    if module_name in sys.modules:
+        STARTUP_TIMES.setdefault(module_name, 0.0)
+        return
+    start = time.perf_counter()
+    importlib.import_module(module_name)
+    record(module_name, time.perf_counter() - start)
+
+
+def startup_report():
+    lines = ["Startup time report:"]
+    lines += [f"  {step:<30} {seconds:7.2f} s" for step, seconds in STARTUP_TIMES.items()]
+    lines.append(f"  {'total':<30} {sum(STARTUP_TIMES.values()):7.2f} s")
+    return "\n".join(lines)
+
+
+def wait_until_listening(port, host="127.0.0.1", timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def warm_up(port=None, kernels=True):
+    '''
+    Imports the heavy analysis modules and compiles UMAP's numba kernels.
+
+    Args:
+        port: if given, wait until the server accepts connections on this port first
+        kernels: compile (or load) the numba kernels. The production server imports the modules once before
+            it forks the workers, each worker loads the kernels itself (numba's thread pool is not fork-safe).
+    '''
+    if port is not None:
+        wait_until_listening(port)
+
+    try:
+        for module_name in HEAVY_MODULES:
+            timed_import(module_name)
+
+        if kernels:
+            from eda_pipeline.eda import warm_up_umap
+            start = time.perf_counter()
+            warm_up_umap()
+            record("UMAP numba warm-up", time.perf_counter() - start)
+    except Exception as e:
+        logger.exception("[warm_up] Error: %s", e)
+
+    logger.info(startup_report())
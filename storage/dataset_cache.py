@@ -0,0 +1,174 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+from config.config import CACHE_PATH, CACHE_MEMORY_LIMIT, CACHE_DISK_LIMIT
+from . import mmap_store
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_memory = OrderedDict()  # key -> (frame, size in bytes), least recently used first
+_memory_bytes = 0
+
+
+def frame_key(data):
+    '''
+    Content address of a data frame. Equal frames (values, index, columns and dtypes) get equal keys.
+
+    Args:
+        data: pandas DataFrame
+
+    Returns:
+        short hexadecimal key
+    '''
+    hasher = hashlib.sha1()
+    hasher.update(pd.util.hash_pandas_object(data, index=True).values.tobytes())
+    hasher.update(repr(list(data.columns)).encode('utf-8'))
+    hasher.update(repr([str(dtype) for dtype in data.dtypes]).encode('utf-8'))
+    return hasher.hexdigest()[:24]
+
+
+def _frame_path(key):
+    return CACHE_PATH / f"{key}.parquet"
+
+
+def _remember(key, data):
+    global _memory_bytes
+
+    if key in _memory:
+        _memory.move_to_end(key)
+        return
+
+    size = int(data.memory_usage(index=True, deep=False).sum())
+    _memory[key] = (data, size)
+    _memory_bytes += size
+
+    # Size based LRU eviction, the most recent frame is always kept
+    while _memory_bytes > CACHE_MEMORY_LIMIT and len(_memory) > 1:
+        _, (_, evicted_size) = _memory.popitem(last=False)
+        _memory_bytes -= evicted_size
+
+
+def _evict_disk():
+    files = []
+    for path in CACHE_PATH.glob("*.parquet"):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:  # evicted by another writer in between
+            continue
+        files.append((stat.st_atime, stat.st_size, path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= CACHE_DISK_LIMIT:
+            break
+        try:
+            path.unlink()
+            total -= size
+        except OSError:
+            pass
+
+
+def write_parquet(data, path):
+    '''
+    Writes a frame as parquet file atomically (temporary file + rename), readers never see a partial file.
+    Sparse frames are written dense, parquet has no sparse columns but compresses runs of zeros well.
+    '''
+    if len(data.columns) and all(isinstance(dtype, pd.SparseDtype) for dtype in data.dtypes):
+        attrs = data.attrs
+        data = data.sparse.to_dense()
+        data.attrs = attrs
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        data.to_parquet(tmp_path, engine="pyarrow", index=True)
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+def _write_parquet(key, data):
+    path = _frame_path(key)
+    if path.exists():
+        os.utime(path)
+        return
+
+    write_parquet(data, path)
+    _evict_disk()
+
+
+def put_frame(data, key=None, mapped=False):
+    '''
+    Stores a data frame in the cache. Frames are kept in memory (LRU) and as parquet files on disk.
+
+    Args:
+        data: pandas DataFrame
+        key: explicit key, by default the content address of the frame
+        mapped: store a numerical matrix (count matrix) memory-mapped instead (see storage.mmap_store),
+            get_frame returns zero-copy views of it
+
+    Returns:
+        key to be kept in dcc.Store instead of the serialised frame
+    '''
+    if data is None:
+        return None
+    if key is None:
+        key = frame_key(data)
+
+    if mapped and mmap_store.is_mappable(data):
+        try:
+            mmap_store.write_counts(key, data)
+            return key
+        except Exception as e:
+            logger.exception("[put_frame] Error: matrix could not be mapped, it is cached as parquet: %s", e)
+
+    with _lock:
+        _remember(key, data)
+
+    # Written outside the lock, so other callbacks are not blocked by a large write. The temporary
+    # file + rename of write_parquet keeps concurrent writes of the same key safe.
+    try:
+        _write_parquet(key, data)
+    except Exception as e:
+        logger.exception("[put_frame] Error: %s", e)
+
+    return key
+
+
+def get_frame(key):
+    '''
+    Returns the frame stored under key or None if it is unknown or was evicted.
+    Returned frames are shared between callbacks and must not be modified in place (memory-mapped
+    matrices are read-only).
+    '''
+    if not key:
+        return None
+
+    with _lock:
+        if key in _memory:
+            _memory.move_to_end(key)
+            return _memory[key][0]
+
+    data = mmap_store.read_counts(key)
+    if data is not None:
+        return data
+
+    path = _frame_path(key)
+    try:
+        data = pd.read_parquet(path, engine="pyarrow")
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.exception("[get_frame] Error: %s", e)
+        return None
+
+    with _lock:
+        _remember(key, data)
+    return data
+
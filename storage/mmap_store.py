@@ -0,0 +1,162 @@
+'''
+Memory-mapped count matrices.
+
+A count matrix is stored once as a directory with values.npy (genes x samples in Fortran order, i.e. the
+counts of a sample are contiguous) and meta.json (gene index, sample index, attrs). read_counts() maps
+values.npy read-only, the returned frame is a zero-copy view: stages only read the pages they touch and
+all processes and sessions using the same matrix share one copy of it in the page cache.
+'''
+import json
+import logging
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from config.config import COUNTS_STORE_PATH, COUNTS_DISK_LIMIT
+
+logger = logging.getLogger(__name__)
+
+MAX_OPEN_MATRICES = 16  # mapped frames kept open per process, only their indexes take memory
+
+_lock = threading.Lock()
+_open = OrderedDict()  # key -> mapped frame, least recently used first
+
+
+def _counts_path(key):
+    return COUNTS_STORE_PATH / key
+
+
+def _dtype(data):
+    # common numerical dtype of the columns or None if the frame cannot be mapped
+    dtypes = [dtype.subtype if isinstance(dtype, pd.SparseDtype) else dtype for dtype in data.dtypes]
+    if not dtypes or not all(isinstance(dtype, np.dtype) and dtype.kind in "uif" for dtype in dtypes):
+        return None
+    return np.result_type(*dtypes)
+
+
+def is_mappable(data):
+    '''
+    Returns:
+        True if the frame is a non-empty matrix of numbers (dense or sparse columns)
+    '''
+    return data is not None and data.shape[0] > 0 and _dtype(data) is not None
+
+
+def _mapped_file(values):
+    # values.npy file values is the full view of, None if values is not a mapped matrix
+    base = values
+    while base is not None and not isinstance(base, np.memmap):
+        base = getattr(base, "base", None)
+    root = None
+    while isinstance(base, np.memmap):
+        root, base = base, base.base
+    if root is None or getattr(root, "filename", None) is None:
+        return None
+    same = (values.shape == root.shape and values.strides == root.strides and values.dtype == root.dtype
+            and values.__array_interface__["data"][0] == root.__array_interface__["data"][0])
+    return root.filename if same else None
+
+
+def _write_values(data, path):
+    dtype = _dtype(data)
+    if len(set(data.dtypes)) == 1 and not isinstance(data.dtypes.iloc[0], pd.SparseDtype):
+        # frames read from the store: the matrix file is linked, not written again
+        source = _mapped_file(data.to_numpy())
+        if source is not None:
+            try:
+                os.link(source, path)
+                return
+            except OSError:
+                pass
+
+    values = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=data.shape, fortran_order=True)
+    for position in range(data.shape[1]):
+        # one column at a time, sparse columns are never dense in memory as a whole
+        values[:, position] = data.iloc[:, position].to_numpy()
+    values.flush()
+    del values
+
+
+def _evict():
+    entries = []
+    for path in COUNTS_STORE_PATH.glob("*/values.npy"):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_atime, stat.st_size, path.parent))
+    total = sum(size for _, size, _ in entries)
+    for _, size, directory in sorted(entries):
+        if total <= COUNTS_DISK_LIMIT:
+            break
+        # processes that mapped the matrix keep reading it until they close it (POSIX)
+        shutil.rmtree(directory, ignore_errors=True)
+        total -= size
+
+
+def write_counts(key, data):
+    '''
+    Stores a numerical matrix under key (see is_mappable), unless it is stored already. The directory is
+    written under a temporary name and renamed, readers never see a partial matrix. Columns are stored
+    in their common dtype.
+    '''
+    path = _counts_path(key)
+    if (path / "values.npy").exists():
+        os.utime(path / "values.npy")
+        return
+
+    tmp_path = COUNTS_STORE_PATH / f"{key}.{os.getpid()}.{threading.get_ident()}.tmp"
+    tmp_path.mkdir(parents=True, exist_ok=True)
+    try:
+        _write_values(data, tmp_path / "values.npy")
+        meta = {
+            "genes": data.index.tolist(),
+            "samples": data.columns.tolist(),
+            "index_name": data.index.name,
+            "columns_name": data.columns.name,
+            "attrs": data.attrs,
+        }
+        with open(tmp_path / "meta.json", "w", encoding="utf-8") as f:
+            json.dump(meta, f, default=str)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            if not (path / "values.npy").exists():  # otherwise stored by another process in between
+                raise
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    _evict()
+
+
+def read_counts(key):
+    '''
+    Returns:
+        zero-copy, read-only frame of the matrix stored under key or None if it is unknown or was evicted
+    '''
+    with _lock:
+        if key in _open:
+            _open.move_to_end(key)
+            return _open[key]
+
+    path = _counts_path(key)
+    try:
+        with open(path / "meta.json", "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        values = np.load(path / "values.npy", mmap_mode="r")
+        os.utime(path / "values.npy")
+    except FileNotFoundError:
+        return None
+
+    data = pd.DataFrame(values, index=pd.Index(meta["genes"], name=meta["index_name"]),
+                        columns=pd.Index(meta["samples"], name=meta["columns_name"]), copy=False)
+    data.attrs = meta["attrs"]
+
+    with _lock:
+        _open[key] = data
+        if len(_open) > MAX_OPEN_MATRICES:
+            _open.popitem(last=False)
+    return data
+
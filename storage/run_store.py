@@ -0,0 +1,215 @@
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import pandas as pd
+from config.config import OUTPUT_PATH
+from .dataset_cache import write_parquet
+
+_lock = threading.Lock()  # manifest read-modify-write within this process
+
+
+def _run_path(run_id):
+    return OUTPUT_PATH / run_id
+
+
+def _manifest_path(run_id):
+    return _run_path(run_id) / "manifest.json"
+
+
+def _write_manifest(run_id, manifest):
+    path = _manifest_path(run_id)
+    tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, default=str)
+    os.replace(tmp_path, path)  # atomic, readers never see a partial manifest
+
+
+@contextmanager
+def _manifest_lock(run_id):
+    # manifest read-modify-write, also against other server processes (workers of gunicorn.conf.py)
+    with _lock, open(_run_path(run_id) / "manifest.lock", "w") as lock_file:
+        try:
+            import fcntl
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        except ImportError:
+            pass
+        yield
+
+
+def read_manifest(run_id):
+    '''
+    Returns:
+        manifest of the run ('run_id', 'kind', 'created', 'parameters', 'frames') or None for unknown runs
+    '''
+    try:
+        with open(_manifest_path(run_id), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def new_run(kind, parameters=None, run_id=None):
+    '''
+    Creates the output directory of one analysis run. Every run gets its own directory,
+    so concurrent users and repeated runs never overwrite each other's results.
+
+    Args:
+        kind: 'eda' or 'dge'
+        parameters: JSON serialisable run parameters recorded in the manifest
+        run_id: explicit run id or absolute output directory (batch jobs), an existing run is started anew
+
+    Returns:
+        run id (directory name below OUTPUT_PATH)
+    '''
+    if run_id is None:
+        run_id = f"{kind}-{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        _run_path(run_id).mkdir(parents=True, exist_ok=False)
+    else:
+        _run_path(run_id).mkdir(parents=True, exist_ok=True)
+    _write_manifest(run_id, {"run_id": run_id, "kind": kind, "created": time.time(),
+                             "parameters": parameters or {}, "frames": {}, "finished": None, "error": None})
+    return run_id
+
+
+def finish_run(run_id, **summary):
+    '''
+    Marks the run as complete once all of its frames are written, summary items are added to the manifest.
+    '''
+    with _manifest_lock(run_id):
+        manifest = read_manifest(run_id)
+        manifest.update(summary, finished=time.time())
+        _write_manifest(run_id, manifest)
+
+
+def fail_run(run_id, error):
+    '''
+    Marks the run as failed, e.g. when the analysis raised or was cancelled before its results were
+    queued. Failed runs are never finished, list_runs shows the error in their manifest.
+    '''
+    with _manifest_lock(run_id):
+        manifest = read_manifest(run_id)
+        manifest.update(error=str(error), failed=time.time())
+        _write_manifest(run_id, manifest)
+
+
+def update_parameters(run_id, **parameters):
+    '''
+    Changes recorded run parameters, e.g. when results of the run are recomputed with another setting.
+    '''
+    with _manifest_lock(run_id):
+        manifest = read_manifest(run_id)
+        manifest["parameters"].update(parameters)
+        _write_manifest(run_id, manifest)
+
+
+def is_finished(run_id):
+    '''
+    Returns:
+        True if the run was finished, did not fail and none of its frames failed
+    '''
+    status = run_status(run_id)
+    return bool(status and status["finished"] and not status["error"] and not status["pending"]
+                and not status["failed"])
+
+
+def _update_frame(run_id, name, **entry):
+    with _manifest_lock(run_id):
+        manifest = read_manifest(run_id)
+        if manifest is None:
+            raise FileNotFoundError(f"Run '{run_id}' does not exist.")
+        manifest["frames"][name] = entry
+        _write_manifest(run_id, manifest)
+
+
+def mark_pending(run_id, name):
+    '''
+    Records in the manifest that the frame is going to be written (see storage.writer).
+    '''
+    _update_frame(run_id, name, state="pending", file=None, format="parquet")
+
+
+def mark_failed(run_id, name, error):
+    _update_frame(run_id, name, state="failed", file=None, format="parquet", error=str(error))
+
+
+def save_frame(run_id, name, data):
+    '''
+    Stores a frame of the run as parquet file and records it in the manifest. Both writes are atomic.
+
+    Args:
+        run_id: run id from new_run
+        name: frame name, e.g. 'pca_result'
+        data: pandas DataFrame
+
+    Returns:
+        path of the parquet file
+    '''
+    path = _run_path(run_id) / f"{name}.parquet"
+    write_parquet(data, path)
+    _update_frame(run_id, name, state="written", file=path.name, format="parquet", rows=int(data.shape[0]),
+                  columns=int(data.shape[1]), bytes=path.stat().st_size, written=time.time())
+    return path
+
+
+def run_status(run_id):
+    '''
+    Returns:
+        dictionary state -> names of the frames in that state ('pending', 'written', 'failed'),
+        'errors' (name -> error message), 'finished' (time or None) and 'error' (error of a failed run or
+        None), None for unknown runs
+    '''
+    manifest = read_manifest(run_id) if run_id else None
+    if manifest is None:
+        return None
+
+    status = {"pending": [], "written": [], "failed": [], "errors": {}, "finished": manifest.get("finished"),
+              "error": manifest.get("error")}
+    for name, entry in manifest["frames"].items():
+        state = entry.get("state", "written")
+        status[state].append(name)
+        if state == "failed":
+            status["errors"][name] = entry.get("error")
+    return status
+
+
+def load_frame(run_id, name):
+    '''
+    Returns the frame stored under name in the run or None if it does not exist.
+    '''
+    manifest = read_manifest(run_id)
+    if manifest is None or manifest["frames"].get(name, {}).get("state", "written") != "written":
+        return None
+    return pd.read_parquet(_run_path(run_id) / manifest["frames"][name]["file"], engine="pyarrow")
+
+
+def export_csv(run_id, name, path=None):
+    '''
+    Exports a stored frame as CSV, by default next to its parquet file.
+
+    Returns:
+        path of the CSV file or None if the frame does not exist
+    '''
+    data = load_frame(run_id, name)
+    if data is None:
+        return None
+    path = path or _run_path(run_id) / f"{name}.csv"
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    data.to_csv(tmp_path, sep=',')
+    os.replace(tmp_path, path)
+    return path
+
+
+def list_runs(kind=None):
+    '''
+    Returns:
+        manifests of all runs (optionally of one kind), newest first
+    '''
+    if not OUTPUT_PATH.exists():
+        return []
+    manifests = [read_manifest(path.name) for path in OUTPUT_PATH.iterdir() if path.is_dir()]
+    manifests = [m for m in manifests if m is not None and (kind is None or m["kind"] == kind)]
+    return sorted(manifests, key=lambda m: m["created"], reverse=True)
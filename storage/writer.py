@@ -0,0 +1,120 @@
+import atexit
+import logging
+import queue
+import threading
+
+from config.config import WRITER_THREADS, WRITER_QUEUE_SIZE
+from .run_store import mark_pending, mark_failed, save_frame, run_status, finish_run
+
+logger = logging.getLogger(__name__)
+
+_queue = queue.Queue(maxsize=WRITER_QUEUE_SIZE)
+_start_lock = threading.Lock()
+_threads = []
+_runs_lock = threading.Lock()
+_queued = {}  # run id -> frames queued and not yet written
+_finish = {}  # run id -> summary of finish_run_when_written, applied after its last queued frame
+
+
+def _worker():
+    while True:
+        run_id, name, data = _queue.get()
+        try:
+            save_frame(run_id, name, data)
+        except Exception as e:
+            logger.exception("[write_frame] Error: %s could not be saved to run '%s': %s", name, run_id, e)
+            try:
+                mark_failed(run_id, name, e)
+            except Exception:
+                pass
+        finally:
+            _frame_done(run_id)
+            _queue.task_done()
+
+
+def _frame_done(run_id):
+    with _runs_lock:
+        _queued[run_id] -= 1
+        if _queued[run_id]:
+            return
+        del _queued[run_id]
+        summary = _finish.pop(run_id, None)
+    if summary is not None:
+        _finish_run(run_id, summary)
+
+
+def _finish_run(run_id, summary):
+    try:
+        finish_run(run_id, **summary)
+    except Exception as e:
+        logger.exception("[finish_run_when_written] Error: run '%s' could not be finished: %s", run_id, e)
+
+
+def _ensure_started():
+    with _start_lock:
+        if _threads:
+            return
+        for _ in range(WRITER_THREADS):
+            thread = threading.Thread(target=_worker, daemon=True, name="run-writer")
+            thread.start()
+            _threads.append(thread)
+        atexit.register(flush)
+
+
+def write_frame(run_id, name, data):
+    '''
+    Queues a frame to be stored in the run by a background writer thread, so results can be shown before
+    they are persisted. If WRITER_QUEUE_SIZE frames are already waiting the call blocks (backpressure).
+    Failed writes are recorded in the run manifest (see write_status_message).
+
+    Args:
+        run_id: run id from storage.run_store.new_run
+        name: frame name
+        data: pandas DataFrame, must not be modified afterwards
+    '''
+    _ensure_started()
+    mark_pending(run_id, name)
+    with _runs_lock:
+        _queued[run_id] = _queued.get(run_id, 0) + 1
+    _queue.put((run_id, name, data))
+
+
+def finish_run_when_written(run_id, **summary):
+    '''
+    Marks the run as finished (storage.run_store.finish_run) once the frames queued for it so far are
+    written, without blocking the caller. Runs without queued frames are finished right away.
+
+    Args:
+        run_id: run id from storage.run_store.new_run
+        summary: items added to the run manifest
+    '''
+    with _runs_lock:
+        if run_id in _queued:
+            _finish[run_id] = summary
+            return
+    _finish_run(run_id, summary)
+
+
+def flush():
+    '''
+    Blocks until all queued frames are written and the runs waiting for them are finished. Called at
+    interpreter exit and before job processes end.
+    '''
+    if _threads:
+        _queue.join()
+
+
+def write_status_message(run_id):
+    '''
+    Returns:
+        status message of the run's writes and True once no write is pending
+    '''
+    status = run_status(run_id)
+    if status is None or not (status["pending"] or status["written"] or status["failed"]):
+        return "", True
+    if status["pending"]:
+        return f"Saving results to run '{run_id}' ({len(status['pending'])} pending)...", False
+    if status["failed"]:
+        errors = "; ".join(f"{name}: {error}" for name, error in status["errors"].items())
+        return f"Error: Some results of run '{run_id}' could not be saved ({errors}).", True
+    return f"Results saved to run '{run_id}'.", True
@@ -0,0 +1,16 @@
+'''
+WSGI entry point of the production server, e.g.
+
+    gunicorn -c gunicorn.conf.py wsgi:server
+
+gunicorn.conf.py preloads this module once and forks the worker processes from it, so the Dash app and the
+heavy analysis modules are imported only once. Workers share everything a session needs on disk: the
+dataset cache (CACHE_PATH), the runs (OUTPUT_PATH) and the job states, any worker can serve any callback.
+'''
+import startup
+from app import app
+
+server = app.server
+
+# Imports only, numba's kernels are loaded by every worker after the fork (see gunicorn.conf.py)
+startup.warm_up(kernels=False)